@@ -0,0 +1,148 @@
+'''
+Small in-process caches, safe to share between FastAPI's threadpool workers.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Bounded least-recently-used cache with an optional time to live.
+
+    on_evict, if given, is called with (key, value) for every entry that
+    leaves the cache, whether it was pushed out, expired or invalidated.
+    maxbytes, if given, also bounds the total of sizeof(value) over all entries.
+    '''
+
+    def __init__(
+            self, maxsize: int, ttl: float = None, on_evict=None,
+            maxbytes: int = None, sizeof=len,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evicted(self, evicted):
+        if self._on_evict:
+            for key, value in evicted:
+                self._on_evict(key, value)
+
+    def get(self, key, default=None):
+        '''
+        Get a live entry, marking it as recently used.
+        '''
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                evicted.append((key, value))
+            self.misses += 1
+        self._evicted(evicted)
+        return default
+
+    def put(self, key, value, ttl: float = None):
+        '''
+        Store an entry, pushing out the least recently used ones if full.
+        '''
+        with self._lock:
+            evicted = self._store(key, value, ttl)
+        self._evicted(evicted)
+        return value
+
+    def _store(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        evicted = []
+        previous = self._remove(key)
+        if previous is not None and previous[0] is not value:
+            evicted.append((key, previous[0]))
+        self._entries[key] = (value, expires_at)
+        if self.maxbytes is not None:
+            self._sizes[key] = self._sizeof(value)
+            self.bytes += self._sizes[key]
+        while len(self._entries) > self.maxsize or (
+                self.maxbytes is not None and self.bytes > self.maxbytes and self._entries
+        ):
+            evicted.append(self._pop_oldest())
+        return evicted
+
+    def _remove(self, key):
+        self.bytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, None)
+
+    def get_or_create(self, key, factory, ttl: float = None):
+        '''
+        Get an entry, building and storing it with factory() on a miss.
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = factory()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+                evicted = self._store(key, value, ttl)
+            else:
+                # Another thread won the race, keep theirs and drop ours.
+                evicted = [(key, value)]
+                value = entry[0]
+        self._evicted(evicted)
+        return value
+
+    def invalidate(self, key):
+        '''
+        Drop an entry if present.
+        '''
+        with self._lock:
+            entry = self._remove(key)
+        if entry is not None:
+            self._evicted([(key, entry[0])])
+
+    def clear(self):
+        '''
+        Drop every entry.
+        '''
+        with self._lock:
+            evicted = [(key, value) for key, (value, _) in self._entries.items()]
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+        self._evicted(evicted)
+
+    def _pop_oldest(self):
+        key, (value, _) = self._entries.popitem(last=False)
+        self.bytes -= self._sizes.pop(key, 0)
+        self.evictions += 1
+        return key, value
+
+    def stats(self):
+        '''
+        Counters describing how well the cache is doing.
+        '''
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
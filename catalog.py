@@ -0,0 +1,266 @@
+'''
+One row per directory user and watchlist, so listings never scan the directory.
+
+The catalog is derived from the databases themselves. Ingests and refreshes update
+their entries as they finish, and a reconciliation job at startup catches anything
+written while Cecil was down.
+'''
+
+import json
+import sqlite3
+from pathlib import Path
+from datetime import datetime
+from contextlib import closing
+from fastapi.logger import logger
+
+import helpers
+import jobs
+from constants import CecilConstants
+
+# Columns users can be sorted or filtered on. The whole user row is kept as JSON in data.
+USER_COLUMNS = [
+    "screen_name", "name", "followers_count", "friends_count",
+    "favorites_count", "statuses_count", "last_updated",
+]
+
+
+def _create_schema(conn):
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "user_id TEXT PRIMARY KEY, screen_name TEXT COLLATE NOCASE, name TEXT, "
+        "followers_count INTEGER, friends_count INTEGER, favorites_count INTEGER, "
+        "statuses_count INTEGER, last_updated TEXT, file_size INTEGER, stamp TEXT);"
+        "CREATE INDEX IF NOT EXISTS ix_users_screen_name ON users (screen_name);"
+        "CREATE INDEX IF NOT EXISTS ix_users_followers_count ON users (followers_count);"
+        "CREATE INDEX IF NOT EXISTS ix_users_friends_count ON users (friends_count);"
+        "CREATE INDEX IF NOT EXISTS ix_users_last_updated ON users (last_updated);"
+        "CREATE INDEX IF NOT EXISTS ix_users_file_size ON users (file_size);"
+        "CREATE TABLE IF NOT EXISTS watchlists ("
+        "watchlist_id TEXT PRIMARY KEY, watchlist_count INTEGER, watchword_count INTEGER, "
+        "last_updated TEXT, file_size INTEGER, stamp TEXT);"
+        "CREATE INDEX IF NOT EXISTS ix_watchlists_watchlist_count "
+        "ON watchlists (watchlist_count);"
+        "CREATE INDEX IF NOT EXISTS ix_watchlists_last_updated ON watchlists (last_updated);"
+        "CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT);"
+    )
+    if not _has_data(conn):
+        # Entries from before data was kept are re-catalogued by the next reconcile.
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not _has_data(conn):
+                conn.execute("ALTER TABLE users ADD COLUMN data TEXT")
+                conn.execute("UPDATE users SET stamp = NULL")
+                conn.execute("DELETE FROM catalog_info WHERE key = 'reconciled_at'")
+
+
+def _connect():
+    conn = helpers.cecil_db(CecilConstants.CATALOG_DB_PATH, _create_schema)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _has_data(conn):
+    return "data" in {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+
+
+def _stamp(conn, table: str, key: str, entity_id: str):
+    row = conn.execute(
+        f"SELECT stamp FROM {table} WHERE {key} = ?", (entity_id,)).fetchone()
+    return row["stamp"] if row else None
+
+
+def catalog_user(user_id: str):
+    '''
+    Bring a user's catalog entry up to date with their database.
+    '''
+    path = helpers.db_path("users", user_id)
+    stamp = str(helpers.db_stamp(path))
+    with closing(_connect()) as conn:
+        if _stamp(conn, "users", "user_id", user_id) == stamp:
+            return
+
+        with closing(helpers.read_only(path)) as user_conn:
+            cursor = user_conn.execute(f"SELECT * FROM {CecilConstants.USER_TABLE} LIMIT 1")
+            columns = [column[0] for column in cursor.description]
+            row = cursor.fetchone()
+        user = dict(zip(columns, row)) if row else {}
+
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO users (user_id, {', '.join(USER_COLUMNS)}, "
+                f"file_size, stamp, data) VALUES ({', '.join('?' * (len(USER_COLUMNS) + 4))})",
+                [user_id] + [user.get(column) for column in USER_COLUMNS] +
+                [path.stat().st_size, stamp, json.dumps(user, default=str)]
+            )
+
+
+def catalog_watchlist(watchlist_id: str):
+    '''
+    Bring a watchlist's catalog entry up to date with its database.
+    '''
+    path = helpers.db_path("watchlists", watchlist_id)
+    stamp = str(helpers.db_stamp(path))
+    with closing(_connect()) as conn:
+        if _stamp(conn, "watchlists", "watchlist_id", watchlist_id) == stamp:
+            return
+
+        watchlist = helpers.wl_getter(watchlist_id)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO watchlists (watchlist_id, watchlist_count, "
+                "watchword_count, last_updated, file_size, stamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    watchlist_id,
+                    watchlist.get_watchlist_count(),
+                    watchlist.get_watchwords_count(),
+                    datetime.utcfromtimestamp(path.stat().st_mtime).isoformat(sep=" "),
+                    path.stat().st_size,
+                    stamp,
+                )
+            )
+
+
+@jobs.job("reconcile_catalog")
+def reconcile(context: jobs.JobContext):
+    '''
+    Catalog every changed user and watchlist, and drop entries whose database is gone.
+    '''
+    user_ids, watchlist_ids = helpers.db_ids("users"), helpers.db_ids("watchlists")
+    with closing(_connect()) as conn, conn:
+        for table, key, present in [
+                ("users", "user_id", user_ids),
+                ("watchlists", "watchlist_id", watchlist_ids),
+        ]:
+            catalogued = {row[0] for row in conn.execute(f"SELECT {key} FROM {table}")}
+            for removed in catalogued - present:
+                conn.execute(f"DELETE FROM {table} WHERE {key} = ?", (removed,))
+
+    total = len(user_ids) + len(watchlist_ids)
+    for done, (update, entity_id) in enumerate(
+            [(catalog_user, user_id) for user_id in sorted(user_ids)] +
+            [(catalog_watchlist, watchlist_id) for watchlist_id in sorted(watchlist_ids)],
+            start=1
+    ):
+        try:
+            update(entity_id)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to catalog: %s', entity_id)
+        if done % 100 == 0 or done == total:
+            context.report(done * 100 // total)
+
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO catalog_info (key, value) VALUES ('reconciled_at', ?)",
+            (datetime.utcnow().isoformat(),)
+        )
+
+
+def queue_reconcile():
+    '''
+    Queue a reconciliation of the catalog with the directory.
+    '''
+    return jobs.enqueue("reconcile_catalog", {}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def is_reconciled():
+    '''
+    Whether a reconcile has finished, so the catalog lists the whole directory.
+    '''
+    with closing(_connect()) as conn:
+        return conn.execute(
+            "SELECT 1 FROM catalog_info WHERE key = 'reconciled_at'").fetchone() is not None
+
+
+def get_stamp():
+    '''
+    Version of the catalog as a whole, changing whenever any entry does.
+    '''
+    path = Path(CecilConstants.CATALOG_DB_PATH)
+    return helpers.db_stamp(path) if path.exists() else (0, 0, None, None)
+
+
+def get_last_updated(directoryname: str, entity_id: str = None):
+    '''
+    When an entry's data was last updated, or the latest of any entry's if no id is given.
+    '''
+    key = "user_id" if directoryname == "users" else "watchlist_id"
+    with closing(_connect()) as conn:
+        if entity_id is None:
+            row = conn.execute(f"SELECT MAX(last_updated) FROM {directoryname}").fetchone()
+        else:
+            row = conn.execute(
+                f"SELECT last_updated FROM {directoryname} WHERE {key} = ?", (entity_id,)
+            ).fetchone()
+    if not row or not row[0]:
+        return None
+    try:
+        return datetime.fromisoformat(str(row[0]).replace("T", " ").split(".")[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def get_entry(directoryname: str, entity_id: str):
+    '''
+    An entry's catalogued columns, or None if it has not been catalogued.
+    '''
+    key = "user_id" if directoryname == "users" else "watchlist_id"
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            f"SELECT * FROM {directoryname} WHERE {key} = ?", (entity_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _order(sort: str, descending: bool, key: str):
+    direction = "DESC" if descending else "ASC"
+    return f"{sort} {direction}, {key} {direction}"
+
+
+def get_users(
+        sort: str = "user_id",
+        descending: bool = False,
+        screen_name: str = None,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    A page of catalogued users, optionally filtered by screen name prefix.
+    '''
+    where, params = "", []
+    if screen_name:
+        where = "WHERE screen_name LIKE ? ESCAPE '\\'"
+        params.append(
+            screen_name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    with closing(_connect()) as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+        items = [
+            {**json.loads(row["data"] or "{}"), **dict(row)} for row in conn.execute(
+                f"SELECT user_id, file_size, data FROM users {where} "
+                f"ORDER BY {_order(sort, descending, 'user_id')} LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            )
+        ]
+    for item in items:
+        item.pop("data")
+    return helpers.paginated(items, total, page, page_size)
+
+
+def get_watchlists(
+        sort: str = "watchlist_id",
+        descending: bool = False,
+        min_users: int = None,
+):
+    '''
+    Ids of the catalogued watchlists, optionally only those with at least min_users.
+    '''
+    where, params = "", []
+    if min_users is not None:
+        where = "WHERE watchlist_count >= ?"
+        params.append(min_users)
+    with closing(_connect()) as conn:
+        return [
+            row[0] for row in conn.execute(
+                f"SELECT watchlist_id FROM watchlists {where} "
+                f"ORDER BY {_order(sort, descending, 'watchlist_id')}",
+                params
+            )
+        ]
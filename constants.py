@@ -12,9 +12,108 @@ class CecilConstants:
     NON_PRIVILEGED_ROLE = 2
     SECRET_KEY = "secret_key"
     ACCESS_TOKEN_EXPIRE_MINUTES = "access_token_expire_minutes"
+    PRINCIPAL_CACHE_SIZE = "principal_cache_size"
+    PRINCIPAL_CACHE_TTL_SECONDS = "principal_cache_ttl_seconds"
+    MAX_OPEN_HANDLES = "max_open_handles"
+    WATCHLIST_REFRESH_INTERVAL_MINUTES = "watchlist_refresh_interval_minutes"
+    WATCHLIST_STALE_AFTER_MINUTES = "watchlist_stale_after_minutes"
+    STATS_CACHE_SIZE = "stats_cache_size"
+    RELATIONSHIP_CACHE_SIZE = "relationship_cache_size"
+    STATS_MATRIX_PROCESSES = "stats_matrix_processes"
+    JOB_WORKERS = "job_workers"
+    JOB_MAX_ATTEMPTS = "job_max_attempts"
+    JOB_RETRY_BACKOFF_SECONDS = "job_retry_backoff_seconds"
+    JOB_LEASE_SECONDS = "job_lease_seconds"
+    TWITTER_BOUND_JOB_LIMIT = "twitter_bound_job_limit"
+    TWITTER_RATE_LIMITS = "twitter_rate_limits"
+    TWITTER_RATE_LIMIT_WINDOW_SECONDS = "twitter_rate_limit_window_seconds"
+    TWITTER_RATE_LIMIT_GRACE_SECONDS = "twitter_rate_limit_grace_seconds"
+    INTERACTIVE_RESERVE_FRACTION = "interactive_reserve_fraction"
+    RATELIMIT_DB_PATH = "./ratelimit.db"
+    SNAPSHOT_PATH = "./snapshots"
+    SEARCH_DB_PATH = "./search.db"
+    CATALOG_DB_PATH = "./catalog.db"
+    SIMILARITY_DB_PATH = "./similarity.db"
+    GRAPH_DB_PATH = "./graph.db"
+    LEADERBOARD_DB_PATH = "./leaderboard.db"
+    VERSIONS_DB_PATH = "./versions.db"
+    RESPONSE_CACHE_DB_PATH = "./responsecache.db"
+    LAYOUT_LOCK_PATH = "./cecil.lock"
+    RESPONSE_CACHE_SIZE = "response_cache_size"
+    RESPONSE_CACHE_BYTES = "response_cache_bytes"
+    RESPONSE_CACHE_DISK_BYTES = "response_cache_disk_bytes"
+    SINGLE_FLIGHT_ROUTES = "single_flight_routes"
+    PROFILE_SAMPLE_RATE = "profile_sample_rate"
+    PROFILE_DUMP_SECONDS = "profile_dump_seconds"
+    PROFILE_BUFFER_SIZE = "profile_buffer_size"
+    METRICS_SAMPLE_SECONDS = "metrics_sample_seconds"
+    PROFILE_HEADER = "X-Cecil-Profile"
+    PAGERANK_DAMPING = "pagerank_damping"
+    SIMILARITY_RERANK_FACTOR = "similarity_rerank_factor"
+    SNAPSHOT_PROCESSES = "snapshot_processes"
+    DB_LAYOUT = "db_layout"
+    LAYOUT_FLAT = "flat"
+    LAYOUT_SHARDED = "sharded"
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BULK = 1
+    JOB_PENDING = "pending"
+    JOB_RUNNING = "running"
+    JOB_SUCCEEDED = "succeeded"
+    JOB_FAILED = "failed"
     HASHING_ALGORITHM = "HS256"
     WL_PATH = "./watchlists"
+    USERS_PATH = "./users"
+    USER_TABLE = "user"
+    FOLLOWERS_TABLE = "followers"
+    FRIENDS_TABLE = "friends"
+    FAVORITES_TABLE = "favorites"
+    TIMELINE_TABLE = "timeline"
+    WATCHLIST_TABLE = "watchlist"
+    WATCHLIST_USERS_TABLE = "users"
     CONFIG_PATH = "./config.json"
     MESSAGE_PROCESSING_IN_BACKGROUND = {
         "message": "Processing request in the background"
     }
+    CONFIG_DEFAULTS = {
+        PRINCIPAL_CACHE_SIZE: 1024,
+        PRINCIPAL_CACHE_TTL_SECONDS: 30,
+        MAX_OPEN_HANDLES: 256,
+        WATCHLIST_REFRESH_INTERVAL_MINUTES: 15,
+        WATCHLIST_STALE_AFTER_MINUTES: 60,
+        STATS_CACHE_SIZE: 1024,
+        RELATIONSHIP_CACHE_SIZE: 64,
+        STATS_MATRIX_PROCESSES: 4,
+        JOB_WORKERS: 4,
+        JOB_MAX_ATTEMPTS: 3,
+        JOB_RETRY_BACKOFF_SECONDS: 30,
+        JOB_LEASE_SECONDS: 120,
+        TWITTER_BOUND_JOB_LIMIT: 2,
+        # Requests per window for each Twitter API endpoint family.
+        TWITTER_RATE_LIMITS: {
+            "users": 900,
+            "followers": 15,
+            "friends": 15,
+            "timeline": 900,
+            "favorites": 75,
+            "lists": 900,
+        },
+        TWITTER_RATE_LIMIT_WINDOW_SECONDS: 900,
+        TWITTER_RATE_LIMIT_GRACE_SECONDS: 30,
+        INTERACTIVE_RESERVE_FRACTION: 0.2,
+        SNAPSHOT_PROCESSES: 4,
+        DB_LAYOUT: LAYOUT_FLAT,
+        SIMILARITY_RERANK_FACTOR: 3,
+        PAGERANK_DAMPING: 0.85,
+        RESPONSE_CACHE_SIZE: 4096,
+        RESPONSE_CACHE_BYTES: 64 * 1024 * 1024,
+        # 0 turns the on-disk tier off.
+        RESPONSE_CACHE_DISK_BYTES: 0,
+        # Route names mapped to false are not coalesced; all others are.
+        SINGLE_FLIGHT_ROUTES: {},
+        # Fraction of requests profiled without being asked to; admins can always ask.
+        PROFILE_SAMPLE_RATE: 0.0,
+        # Profiled requests slower than this keep a cProfile dump; 0 turns dumps off.
+        PROFILE_DUMP_SECONDS: 1.0,
+        PROFILE_BUFFER_SIZE: 200,
+        METRICS_SAMPLE_SECONDS: 1.0,
+    }
@@ -0,0 +1,79 @@
+'''
+Streams whole baquet tables out as NDJSON or CSV, in constant memory.
+'''
+
+import io
+import csv
+import json
+import zlib
+from contextlib import closing
+from fastapi.responses import StreamingResponse
+
+import helpers
+
+# Rows fetched from SQLite, and written out, at a time.
+BATCH_SIZE = 1000
+
+
+def _batches(path, table: str, order_by: str):
+    # StreamingResponse advances this on whichever threadpool thread is free, one batch at
+    # a time, so the read-only connection is never used by two threads at once.
+    with closing(helpers.read_only(path, check_same_thread=False)) as conn:
+        cursor = conn.execute(f"SELECT * FROM {table} ORDER BY {order_by}")
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                return
+            yield columns, rows
+
+
+def _ndjson(batches):
+    for columns, rows in batches:
+        yield "".join(
+            json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows
+        ).encode()
+
+
+def _csv(batches):
+    header = True
+    for columns, rows in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+            header = False
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(path, table: str, order_by: str, filename: str, export_format: str, gzip: bool):
+    '''
+    Stream a table as a file download.
+    '''
+    writers = {
+        "ndjson": (_ndjson, "application/x-ndjson"),
+        "csv": (_csv, "text/csv"),
+    }
+    writer, media_type = writers[export_format]
+    chunks = writer(_batches(path, table, order_by))
+    filename = f"{filename}.{export_format}"
+    if gzip:
+        chunks = _gzipped(chunks)
+        media_type = "application/gzip"
+        filename = f"{filename}.gz"
+
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
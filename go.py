@@ -1,18 +1,89 @@
 '''
 Cecil, it all starts here.
 '''
+import random
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm
 
+import catalog
 import helpers
 import orm_models
 import json_models
 import internal_users
+import jobs
+import layout
+import metrics
+import profiling
+import refreshes
 from constants import CecilConstants
-from routers import users, watchlists, admin
+from routers import users, watchlists, admin, search, graph
+from routers import jobs as jobs_router
 
 CECIL = FastAPI()
+CECIL.router.route_class = profiling.ProfiledRoute
+CECIL.middleware("http")(metrics.middleware)
+
+
+@CECIL.middleware("http")
+async def profile_requests(request: Request, call_next):
+    '''
+    Profile the requests an admin asks for with the profiling header, and a sample of the rest.
+    '''
+    if request.headers.get(CecilConstants.PROFILE_HEADER) and \
+            await internal_users.is_admin_token(request.headers.get("Authorization")):
+        trigger = "header"
+    elif random.random() < CONFIG.get(CecilConstants.PROFILE_SAMPLE_RATE):
+        trigger = "sample"
+    else:
+        return await call_next(request)
+
+    with profiling.profiled(
+            request,
+            trigger,
+            CONFIG.get(CecilConstants.PROFILE_DUMP_SECONDS),
+            CONFIG.get(CecilConstants.PROFILE_BUFFER_SIZE),
+    ) as profile:
+        response = await call_next(request)
+        profile['status'] = response.status_code
+    return response
+
+
+@CECIL.on_event("startup")
+def startup():
+    '''
+    Start Cecil's background work.
+    '''
+    layout.hold()
+    jobs.start_workers()
+    catalog.queue_reconcile()
+    refreshes.start_periodic_refresh()
+    metrics.start_sampler(CONFIG.get(CecilConstants.METRICS_SAMPLE_SECONDS))
+
+
+@CECIL.on_event("shutdown")
+def shutdown():
+    '''
+    Stop Cecil's background work.
+    '''
+    jobs.STOP.set()
+    refreshes.STOP.set()
+    helpers.shutdown_pools()
+    metrics.stop_sampler()
+    metrics.retire()
+
+
+@CECIL.get(
+    "/metrics",
+    include_in_schema=False,
+    dependencies=[Depends(internal_users.get_current_admin_user)]
+)
+async def get_metrics():
+    '''
+    Prometheus metrics for every worker process.
+    '''
+    return Response(metrics.render(), headers={"Content-Type": metrics.content_type()})
+
 
 # INTERNAL USER OPERATIONS
 @CECIL.post("/register")
@@ -21,17 +92,15 @@ def register(registration_data: json_models.RegistrationData):
     Register with an invite code.
     '''
     with internal_users.sess() as session:
-        invite_codes = session.query(orm_models.InviteCode).all()
-        invited = False
-        for invite in invite_codes:
-            if internal_users.verify_password(
-                    registration_data.invite_code,
-                    invite.hashed_invite_code
-            ):
-                invited = True
-                chosen = invite
-
-        if invited:
+        if session.query(orm_models.User).filter(
+                orm_models.User.username == registration_data.username
+        ).first():
+            raise HTTPException(status_code=400, detail="Username is taken.")
+
+        chosen = internal_users.find_invite(
+            session, registration_data.invite_code)
+
+        if chosen:
             new_user = orm_models.User(
                 username=registration_data.username,
                 hashed_password=internal_users.get_password_hash(
@@ -85,12 +154,14 @@ def update_password(
 
     if authuser:
         with internal_users.sess() as session:
-            user = internal_users.get_authuser(current_user.username)
-            user.hashed_password = internal_users.PWD_CONTEXT.hash(
+            user = session.query(orm_models.User).filter(
+                orm_models.User.user_id == authuser.user_id
+            ).first()
+            user.hashed_password = internal_users.get_password_hash(
                 update_password_request.new_password
             )
-            session.merge(user)
             session.commit()
+        internal_users.invalidate_principal(current_user.username)
     else:
         raise HTTPException(
             status_code=401, detail="Current password does not match.")
@@ -119,4 +190,25 @@ CECIL.include_router(
     dependencies=[Depends(internal_users.get_current_active_user)]
 )
 
+CECIL.include_router(
+    search.ROUTER,
+    prefix="/search",
+    tags=["Search"],
+    dependencies=[Depends(internal_users.get_current_active_user)]
+)
+
+CECIL.include_router(
+    graph.ROUTER,
+    prefix="/graph",
+    tags=["Graph"],
+    dependencies=[Depends(internal_users.get_current_active_user)]
+)
+
+CECIL.include_router(
+    jobs_router.ROUTER,
+    prefix="/jobs",
+    tags=["Jobs"],
+    dependencies=[Depends(internal_users.get_current_active_user)]
+)
+
 CONFIG = helpers.make_config()
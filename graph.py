@@ -0,0 +1,318 @@
+'''
+Relationship graph of the directory: mutual follows, PageRank and connected components.
+
+Each user's database contributes the edges between them and other directory users,
+stored in graph.db and replaced only when that user's database changes. Whole-graph
+results are then computed from the stored edges as a sparse adjacency matrix, and
+written to tables that the /graph endpoints read.
+
+Computing needs the optional scipy package.
+'''
+
+from datetime import datetime
+from contextlib import closing
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+import helpers
+import jobs
+from constants import CecilConstants
+
+try:
+    import numpy
+    import scipy.sparse
+    import scipy.sparse.csgraph
+except ImportError:
+    scipy = None
+
+
+def require_scipy():
+    '''
+    Throw error if the optional scipy package is missing.
+    '''
+    if scipy is None:
+        raise HTTPException(
+            status_code=501, detail="Graph analytics need the scipy package installed.")
+
+
+def _create_schema(conn):
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "CREATE TABLE IF NOT EXISTS graphed_users (user_id TEXT PRIMARY KEY, stamp TEXT);"
+        "CREATE TABLE IF NOT EXISTS edges "
+        "(owner_id TEXT NOT NULL, source TEXT NOT NULL, target TEXT NOT NULL);"
+        "CREATE INDEX IF NOT EXISTS ix_edges_owner_id ON edges (owner_id);"
+        "CREATE INDEX IF NOT EXISTS ix_edges_source ON edges (source);"
+        "CREATE INDEX IF NOT EXISTS ix_edges_target ON edges (target);"
+        "CREATE TABLE IF NOT EXISTS nodes (user_id TEXT PRIMARY KEY, pagerank REAL, "
+        "component INTEGER, in_degree INTEGER, out_degree INTEGER);"
+        "CREATE INDEX IF NOT EXISTS ix_nodes_pagerank ON nodes (pagerank);"
+        "CREATE INDEX IF NOT EXISTS ix_nodes_component ON nodes (component, user_id);"
+        "CREATE TABLE IF NOT EXISTS mutuals "
+        "(user_id TEXT NOT NULL, other_id TEXT NOT NULL, PRIMARY KEY (user_id, other_id));"
+        "CREATE TABLE IF NOT EXISTS components (component INTEGER PRIMARY KEY, size INTEGER);"
+        "CREATE INDEX IF NOT EXISTS ix_components_size ON components (size);"
+        "CREATE TABLE IF NOT EXISTS graph_info "
+        "(graph_id INTEGER PRIMARY KEY CHECK (graph_id = 1), nodes INTEGER, edges INTEGER, "
+        "mutuals INTEGER, components INTEGER, computed_at TEXT);"
+    )
+
+
+def _connect():
+    return helpers.cecil_db(CecilConstants.GRAPH_DB_PATH, _create_schema)
+
+
+@jobs.job("graph_user")
+def graph_user(context: jobs.JobContext, user_id: str):  # pylint: disable=unused-argument
+    '''
+    Replace the edges a user contributes to the graph, if their database changed.
+    '''
+    path = helpers.db_path("users", user_id)
+    stamp = str(helpers.db_stamp(path))
+    with closing(_connect()) as conn:
+        graphed = conn.execute(
+            "SELECT stamp FROM graphed_users WHERE user_id = ?", (user_id,)).fetchone()
+        if graphed and graphed[0] == stamp:
+            return
+
+        conn.execute(
+            "ATTACH DATABASE ? AS user_db", (f"file:{path.resolve()}?mode=ro",))
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO graphed_users (user_id, stamp) VALUES (?, ?)",
+                (user_id, stamp)
+            )
+            conn.execute("DELETE FROM edges WHERE owner_id = ?", (user_id,))
+            # Only edges to other directory users; theirs fill in any that arrive later.
+            conn.execute(
+                "INSERT INTO edges (owner_id, source, target) "
+                f"SELECT ?, user_id, ? FROM user_db.{CecilConstants.FOLLOWERS_TABLE} "
+                "WHERE user_id IN (SELECT user_id FROM graphed_users) AND user_id != ?",
+                (user_id, user_id, user_id)
+            )
+            conn.execute(
+                "INSERT INTO edges (owner_id, source, target) "
+                f"SELECT ?, ?, user_id FROM user_db.{CecilConstants.FRIENDS_TABLE} "
+                "WHERE user_id IN (SELECT user_id FROM graphed_users) AND user_id != ?",
+                (user_id, user_id, user_id)
+            )
+    logger.info('Graphed user: %s', user_id)
+    queue_compute()
+
+
+@jobs.job("graph_directory")
+def graph_directory(context: jobs.JobContext):
+    '''
+    Queue graphing of changed users, and drop users no longer in the directory.
+    '''
+    user_ids = helpers.db_ids("users")
+    with closing(_connect()) as conn, conn:
+        graphed = {row[0] for row in conn.execute("SELECT user_id FROM graphed_users")}
+        for removed in graphed - user_ids:
+            conn.execute(
+                "DELETE FROM edges WHERE owner_id = ? OR source = ? OR target = ?",
+                (removed, removed, removed)
+            )
+            conn.execute("DELETE FROM graphed_users WHERE user_id = ?", (removed,))
+
+    for done, user_id in enumerate(sorted(user_ids), start=1):
+        queue_graph(user_id)
+        context.report(done * 100 // len(user_ids))
+    queue_compute()
+
+
+def queue_graph(user_id: str):
+    '''
+    Queue an update of the edges a user contributes.
+    '''
+    return jobs.enqueue(
+        "graph_user", {"user_id": user_id}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def queue_compute():
+    '''
+    Queue a recompute of the whole-graph tables, unless one is already waiting.
+    '''
+    if scipy is None:
+        return None
+    return jobs.enqueue("compute_graph", {}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def _pagerank(adjacency, damping: float, tolerance: float = 1e-10, iterations: int = 100):
+    '''
+    PageRank by power iteration, spreading dangling nodes' rank evenly.
+    '''
+    size = adjacency.shape[0]
+    out_degree = numpy.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = out_degree == 0
+    inverse = numpy.divide(1.0, out_degree, out=numpy.zeros(size), where=~dangling)
+    transposed = adjacency.T.tocsr()
+    rank = numpy.full(size, 1.0 / size)
+    for _ in range(iterations):
+        previous = rank
+        rank = damping * (transposed @ (rank * inverse)) + \
+            (damping * rank[dangling].sum() + 1.0 - damping) / size
+        if numpy.abs(rank - previous).sum() < tolerance:
+            break
+    return rank
+
+
+@jobs.job("compute_graph")
+def compute_graph(context: jobs.JobContext):
+    '''
+    Recompute mutual follows, PageRank and components from the stored edges.
+    '''
+    require_scipy()
+    with closing(_connect()) as conn:
+        user_ids = [row[0] for row in conn.execute(
+            "SELECT user_id FROM graphed_users ORDER BY user_id")]
+        index = {user_id: number for number, user_id in enumerate(user_ids)}
+        pairs = [
+            (index[source], index[target]) for source, target in conn.execute(
+                "SELECT DISTINCT source, target FROM edges")
+            if source in index and target in index
+        ]
+        context.report(25, f"{len(user_ids)} nodes, {len(pairs)} edges")
+
+        size = len(user_ids)
+        rows = numpy.fromiter((pair[0] for pair in pairs), dtype=numpy.int64, count=len(pairs))
+        columns = numpy.fromiter((pair[1] for pair in pairs), dtype=numpy.int64, count=len(pairs))
+        adjacency = scipy.sparse.csr_matrix(
+            (numpy.ones(len(pairs)), (rows, columns)), shape=(size, size))
+
+        ranks = _pagerank(adjacency, CONFIG.get(CecilConstants.PAGERANK_DAMPING)) \
+            if size else numpy.zeros(0)
+        component_count, labels = scipy.sparse.csgraph.connected_components(
+            adjacency, directed=True, connection="weak")
+        mutual = scipy.sparse.triu(adjacency.multiply(adjacency.T), k=1).tocoo()
+        in_degree = numpy.asarray(adjacency.sum(axis=0)).ravel()
+        out_degree = numpy.asarray(adjacency.sum(axis=1)).ravel()
+        context.report(75, "Writing results")
+
+        with conn:
+            for table in ("nodes", "mutuals", "components"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany(
+                "INSERT INTO nodes (user_id, pagerank, component, in_degree, out_degree) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (user_id, float(ranks[number]), int(labels[number]),
+                     int(in_degree[number]), int(out_degree[number]))
+                    for number, user_id in enumerate(user_ids)
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO mutuals (user_id, other_id) VALUES (?, ?)",
+                [
+                    pair for left, right in zip(mutual.row, mutual.col)
+                    for pair in ((user_ids[left], user_ids[right]),
+                                 (user_ids[right], user_ids[left]))
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO components (component, size) VALUES (?, ?)",
+                [(int(label), int(count)) for label, count in
+                 enumerate(numpy.bincount(labels, minlength=component_count))]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO graph_info "
+                "(graph_id, nodes, edges, mutuals, components, computed_at) "
+                "VALUES (1, ?, ?, ?, ?, ?)",
+                (size, len(pairs), len(mutual.row), component_count,
+                 datetime.utcnow().isoformat())
+            )
+    logger.info('Computed graph: %s nodes, %s edges.', size, len(pairs))
+
+
+def get_info():
+    '''
+    Size of the graph as of the last compute. Throw error if it was never computed.
+    '''
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT nodes, edges, mutuals, components, computed_at FROM graph_info"
+        ).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail='Graph: has not been computed.')
+    return dict(zip(["nodes", "edges", "mutuals", "components", "computed_at"], row))
+
+
+def _node(row):
+    return dict(zip(["user_id", "pagerank", "component", "in_degree", "out_degree"], row))
+
+
+def get_node(user_id: str):
+    '''
+    A user's place in the graph. Throw error if they are not in it.
+    '''
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT user_id, pagerank, component, in_degree, out_degree "
+            "FROM nodes WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail=f'Node: {user_id}, does not exist.')
+    return _node(row)
+
+
+def get_pagerank(page: int = 1, page_size: int = 20):
+    '''
+    Directory users by PageRank, highest first.
+    '''
+    with closing(_connect()) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        items = [_node(row) for row in conn.execute(
+            "SELECT user_id, pagerank, component, in_degree, out_degree FROM nodes "
+            "ORDER BY pagerank DESC LIMIT ? OFFSET ?", (page_size, (page - 1) * page_size)
+        )]
+    return helpers.paginated(items, total, page, page_size)
+
+
+def get_mutuals(user_id: str, page: int = 1, page_size: int = 100):
+    '''
+    Directory users who follow this user and are followed back.
+    '''
+    get_node(user_id)
+    with closing(_connect()) as conn:
+        total = conn.execute(
+            "SELECT COUNT(*) FROM mutuals WHERE user_id = ?", (user_id,)).fetchone()[0]
+        items = [row[0] for row in conn.execute(
+            "SELECT other_id FROM mutuals WHERE user_id = ? ORDER BY other_id "
+            "LIMIT ? OFFSET ?", (user_id, page_size, (page - 1) * page_size)
+        )]
+    return helpers.paginated(items, total, page, page_size)
+
+
+def get_components(page: int = 1, page_size: int = 20):
+    '''
+    Connected components, largest first.
+    '''
+    with closing(_connect()) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM components").fetchone()[0]
+        items = [
+            {'component': component, 'size': size} for component, size in conn.execute(
+                "SELECT component, size FROM components ORDER BY size DESC, component "
+                "LIMIT ? OFFSET ?", (page_size, (page - 1) * page_size)
+            )
+        ]
+    return helpers.paginated(items, total, page, page_size)
+
+
+def get_component_members(component: int, page: int = 1, page_size: int = 100):
+    '''
+    The users in one connected component. Throw error if it does not exist.
+    '''
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT size FROM components WHERE component = ?", (component,)).fetchone()
+        if row is None:
+            raise HTTPException(
+                status_code=404, detail=f'Component: {component}, does not exist.')
+        items = [row[0] for row in conn.execute(
+            "SELECT user_id FROM nodes WHERE component = ? ORDER BY user_id "
+            "LIMIT ? OFFSET ?", (component, page_size, (page - 1) * page_size)
+        )]
+    return helpers.paginated(items, row[0], page, page_size)
+
+
+CONFIG = helpers.make_config()
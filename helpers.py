@@ -2,44 +2,231 @@
 Methods that are common to one or more files, to be imported willy-nilly.
 '''
 
+import os
 import json
+import hashlib
+import sqlite3
+import threading
+import weakref
+import multiprocessing
+from math import ceil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from fastapi import HTTPException
+from fastapi.logger import logger
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import NullPool
 from baquet.user import User
 from baquet.watchlist import Watchlist
 
+import profiling
+from cache import LRUCache
 from constants import CecilConstants
 
 
+def flat_path(directoryname, filename):
+    '''
+    Where baquet keeps a database: straight under the users or watchlists directory.
+    '''
+    return Path(f"./{directoryname}/{filename}.db")
+
+
+def shard_path(directoryname, filename):
+    '''
+    Where the sharded layout keeps a database, two directory levels down by hash.
+    '''
+    digest = hashlib.sha1(filename.encode()).hexdigest()
+    return Path(f"./{directoryname}/{digest[:2]}/{digest[2:4]}/{filename}.db")
+
+
 def _exists(directoryname, filename):
     '''
-    Test existance of a file.
+    Find a database in either layout. Throw error if it is in neither.
+    '''
+    for path in (shard_path(directoryname, filename), flat_path(directoryname, filename)):
+        if path.exists():
+            return path
+    raise HTTPException(
+        status_code=404,
+        detail=f'{directoryname[0].upper() + directoryname[1:-1]}: {filename}, does not exist.'
+    )
+
+
+def db_path(directoryname, filename):
+    '''
+    Path to a user or watchlist database. Throw error if it does not exist.
+    '''
+    return _exists(directoryname, filename)
+
+
+def db_ids(directoryname):
+    '''
+    Ids of every database in a directory, in either layout.
+
+    Once the directory is fully sharded the flat listing is skipped, since nothing
+    is kept there any longer.
+    '''
+    root = Path(f"./{directoryname}")
+    if not root.exists():
+        return set()
+    ids = {path.stem for path in root.glob("*/*/*.db")}
+    if CONFIG.get(CecilConstants.DB_LAYOUT) != CecilConstants.LAYOUT_SHARDED:
+        ids.update(path.stem for path in root.glob("*.db"))
+    return ids
+
+
+def db_stamp(path):
+    '''
+    Cheap version of a database file, changing whenever the file is written.
+    '''
+    stamp = Path(path).stat()
+    wal = Path(f"{path}-wal")
+    wal_stamp = wal.stat() if wal.exists() else None
+    return (
+        stamp.st_mtime_ns,
+        stamp.st_size,
+        wal_stamp.st_mtime_ns if wal_stamp else None,
+        wal_stamp.st_size if wal_stamp else None,
+    )
+
+
+def read_only(path, check_same_thread: bool = True):
+    '''
+    Open a read-only connection straight to a baquet database.
+    '''
+    return sqlite3.connect(
+        f"file:{Path(path).resolve()}?mode=ro", uri=True, check_same_thread=check_same_thread,
+        factory=profiling.connection_factory()
+    )
+
+
+def cecil_db(path, create_schema, **kwargs):
+    '''
+    Connect to one of Cecil's own SQLite files, creating its schema once per process.
+    '''
+    conn = sqlite3.connect(
+        Path(path), timeout=30, factory=profiling.connection_factory(), **kwargs)
+    key = str(Path(path).resolve())
+    if key not in _SCHEMAS:
+        with _SCHEMAS_LOCK:
+            if key not in _SCHEMAS:
+                create_schema(conn)
+                _SCHEMAS.add(key)
+    return conn
+
+
+def paginated(items: list, total: int, page: int, page_size: int):
+    '''
+    A page of items shaped like baquet's paginate objects.
     '''
+    pages = ceil(total / page_size) if page_size else 0
+    return {
+        'items': items,
+        'total': total,
+        'pages': pages,
+        'has_next': page < pages,
+        'has_previous': page > 1,
+        'next_page': page + 1 if page < pages else None,
+        'previous_page': page - 1 if page > 1 else None,
+    }
 
-    try:
-        if not Path(f"./{directoryname}/{filename}.db").exists():
-            raise FileNotFoundError
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=404,
-            detail=f'{directoryname[0].upper() + directoryname[1:-1]}: {filename}, does not exist.'
-        )
+
+def _close_handle(key, handle):
+    '''
+    baquet has no close(), so close the session of every thread that used a handle; its
+    engine keeps no pool, so that closes their connections.
+    '''
+    for attribute in vars(handle).values():
+        if isinstance(attribute, scoped_session):
+            try:
+                for session in list(_SESSIONS.pop(attribute, ())):
+                    session.close()
+                attribute.remove()
+                attribute.get_bind().dispose()
+            except Exception:  # pylint: disable=broad-except
+                logger.warning('Failed to close handle: %s', key)
+
+
+def _rebind(handle, path):
+    '''
+    Point a baquet handle's sessions at path, since baquet itself only knows the flat one,
+    and track each thread's session so the handle can be closed from any thread.
+    '''
+    for attribute in vars(handle).values():
+        if isinstance(attribute, scoped_session):
+            engine = attribute.get_bind()
+            attribute.remove()
+            attribute.configure(bind=create_engine(
+                f"sqlite:///{path}",
+                poolclass=NullPool,
+                connect_args={"check_same_thread": False},
+            ))
+            engine.dispose()
+            sessions = _SESSIONS.setdefault(attribute, weakref.WeakSet())
+            event.listen(
+                attribute.session_factory, "after_begin",
+                lambda session, *_, sessions=sessions: sessions.add(session)
+            )
+
+
+def open_handle(directoryname, filename, factory):
+    '''
+    Construct a baquet object on its database, wherever the configured layout keeps it.
+
+    In the sharded layout a new database is moved to its sharded path as soon as baquet
+    has created it, so the flat directory never holds an entry per database.
+    '''
+    flat, sharded = flat_path(directoryname, filename), shard_path(directoryname, filename)
+    legacy = flat.exists()
+    handle = factory(filename)
+    if CONFIG.get(CecilConstants.DB_LAYOUT) != CecilConstants.LAYOUT_SHARDED or \
+            legacy and not sharded.exists():
+        # Flat, or not migrated yet: keep using it where it is.
+        _rebind(handle, flat)
+        return handle
+
+    _rebind(handle, sharded)
+    if not legacy and flat.exists():
+        if sharded.exists():
+            flat.unlink()
+        else:
+            sharded.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(flat, sharded)
+    return handle
+
+
+def _handle(directoryname, filename, factory):
+    '''
+    Get an open handle from the registry, opening it if it exists on disk.
+    '''
+    def _open():
+        _exists(directoryname, filename)
+        with profiling.phase("handle_open"):
+            return open_handle(directoryname, filename, factory)
+
+    return HANDLES.get_or_create((directoryname, filename), _open)
 
 
 def user_getter(user_id):
     '''
     If the user exists, retrieve it. Otherwise throw error.
     '''
-    _exists("users", user_id)
-    return User(user_id)
+    return _handle("users", user_id, User)
 
 
 def wl_getter(watchlist_id):
     '''
     If the watchlist exists, retrieve it. Otherwise throw error.
     '''
-    _exists("watchlists", watchlist_id)
-    return Watchlist(watchlist_id)
+    return _handle("watchlists", watchlist_id, Watchlist)
+
+
+def handle_stats():
+    '''
+    Hit, miss and eviction counters for the open handle registry.
+    '''
+    return HANDLES.stats()
 
 
 def wl_path():
@@ -49,9 +236,45 @@ def wl_path():
     return Path(CecilConstants.WL_PATH)
 
 
+def process_pool(name: str, max_workers: int):
+    '''
+    A long-lived process pool for CPU-heavy work, started on first use.
+
+    Workers are spawned rather than forked: forking a server with job, heartbeat and
+    refresh threads running could copy a lock some thread held and deadlock the child.
+    '''
+    with _POOLS_LOCK:
+        if name not in _POOLS:
+            _POOLS[name] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _POOLS[name]
+
+
+def shutdown_pools():
+    '''
+    Stop every process pool, dropping work not yet started.
+    '''
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _POOLS.clear()
+
+
 def make_config():
     '''
-    Open and parse config.
+    Open and parse config, falling back to defaults for missing settings.
     '''
     config = open(Path(CecilConstants.CONFIG_PATH))
-    return json.load(config)
+    return {**CecilConstants.CONFIG_DEFAULTS, **json.load(config)}
+
+
+CONFIG = make_config()
+HANDLES = LRUCache(
+    CONFIG.get(CecilConstants.MAX_OPEN_HANDLES),
+    on_evict=_close_handle
+)
+_SESSIONS = weakref.WeakKeyDictionary()
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_SCHEMAS = set()
+_SCHEMAS_LOCK = threading.Lock()
@@ -2,19 +2,26 @@
 Holds methods for dealing with users internal to Cecil, i.e, users that can log in.
 '''
 
+import hmac
+import hashlib
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 from contextlib import contextmanager
 from passlib.context import CryptContext
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from fastapi import HTTPException, Depends
+from fastapi.logger import logger
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 
 import orm_models
 import json_models
+import metrics
+import profiling
 from constants import CecilConstants
+from cache import LRUCache
 import helpers
 
 
@@ -45,7 +52,7 @@ def _init_admin(session):
     try:
         admin = orm_models.User(
             username="admin",
-            hashed_password=PWD_CONTEXT.hash("password"),
+            hashed_password=get_password_hash("password"),
             role=CecilConstants.ADMIN_ROLE,
             created_at=datetime.utcnow(),
         )
@@ -68,10 +75,72 @@ def _init_db(database, engine, session):
     session.close()
 
 
+# Columns added to tables after they first shipped, as (table, column, definition).
+_ADDED_COLUMNS = [
+    ("invite_codes", "invite_lookup", "VARCHAR"),
+    ("jobs", "priority", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def _migrate_db(engine):
+    '''
+    Bring an existing cecil DB up to date with the current models.
+    '''
+    orm_models.BASE.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, column, definition in _ADDED_COLUMNS:
+            if column not in [existing["name"] for existing in inspector.get_columns(table)]:
+                conn.execute(
+                    text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_invite_codes_invite_lookup "
+            "ON invite_codes (invite_lookup)"
+        ))
+        # Only one live job per dedupe key; older databases could queue the same job twice.
+        conn.execute(text(
+            "UPDATE jobs SET status = :failed, message = :message "
+            "WHERE status IN (:pending, :running) AND job_id NOT IN ("
+            "SELECT MIN(job_id) FROM jobs WHERE status IN (:pending, :running) "
+            "GROUP BY dedupe_key)"
+        ), {
+            "failed": CecilConstants.JOB_FAILED,
+            "message": "Superseded by an identical job.",
+            "pending": CecilConstants.JOB_PENDING,
+            "running": CecilConstants.JOB_RUNNING,
+        })
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_live_dedupe_key ON jobs (dedupe_key) "
+            f"WHERE status IN ('{CecilConstants.JOB_PENDING}', '{CecilConstants.JOB_RUNNING}')"
+        ))
+        # Older databases could register a username twice; indexing them would fail startup.
+        duplicates = conn.execute(text(
+            "SELECT username FROM users GROUP BY username HAVING COUNT(*) > 1"
+        )).scalars().all()
+        if duplicates:
+            logger.error(
+                'Usernames registered more than once: %s. Rename or delete the extra '
+                'accounts; until then usernames are not enforced unique.',
+                ', '.join(duplicates)
+            )
+        else:
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)"
+            ))
+
+
 def _make_conn():
     database = Path(f'./cecil.db')
     engine = create_engine(
-        f'sqlite:///{database}', connect_args={"check_same_thread": False})
+        f'sqlite:///{database}', connect_args={"check_same_thread": False, "timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        # pylint: disable=unused-argument
+        # The job queue polls this DB from every worker; WAL keeps logins from waiting on it.
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        dbapi_connection.execute("PRAGMA synchronous=NORMAL")
     session_factory = sessionmaker(
         autocommit=False, autoflush=False, bind=engine)
     session = scoped_session(
@@ -80,6 +149,7 @@ def _make_conn():
 
     if not database.exists():
         _init_db(database, engine, session)
+    _migrate_db(engine)
 
     return session
 
@@ -88,14 +158,51 @@ def verify_password(plain_password, hashed_password):
     '''
     Verify the provided password matches the stored hash.
     '''
-    return PWD_CONTEXT.verify(plain_password, hashed_password)
+    with metrics.time_bcrypt("verify"):
+        return PWD_CONTEXT.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password):
     '''
     Generate the password hash.
     '''
-    return PWD_CONTEXT.hash(password)
+    with metrics.time_bcrypt("hash"):
+        return PWD_CONTEXT.hash(password)
+
+
+def get_invite_lookup(invite_code: str):
+    '''
+    Keyed digest of an invite code, used to find the code without a bcrypt scan.
+    '''
+    return hmac.new(
+        CONFIG.get(CecilConstants.SECRET_KEY).encode(),
+        invite_code.encode(),
+        hashlib.sha256
+    ).hexdigest()
+
+
+def find_invite(session, invite_code: str):
+    '''
+    Find the unexpired invite matching the code, if there is one.
+    '''
+    now = datetime.utcnow()
+    invite = session.query(orm_models.InviteCode).filter(
+        orm_models.InviteCode.invite_lookup == get_invite_lookup(invite_code),
+        orm_models.InviteCode.expires_at > now,
+    ).first()
+    if invite:
+        return invite if verify_password(invite_code, invite.hashed_invite_code) else None
+
+    # Codes created before lookups existed can only be found by their bcrypt hash.
+    legacy_invites = session.query(orm_models.InviteCode).filter(
+        orm_models.InviteCode.invite_lookup.is_(None),
+        orm_models.InviteCode.expires_at > now,
+    ).all()
+    for legacy_invite in legacy_invites:
+        if verify_password(invite_code, legacy_invite.hashed_invite_code):
+            return legacy_invite
+
+    return None
 
 
 def get_authuser(username: str):
@@ -106,18 +213,38 @@ def get_authuser(username: str):
         return session.query(orm_models.User).filter(orm_models.User.username == username).first()
 
 
+def get_principal(username: str):
+    '''
+    Get the user for an authenticated request, served from cache when possible.
+    '''
+    user = PRINCIPALS.get(username)
+    if user is None:
+        user = get_authuser(username)
+        if user is not None:
+            PRINCIPALS.put(username, user)
+    return user
+
+
+def invalidate_principal(username: str):
+    '''
+    Forget the cached user, e.g. after their role or password changes.
+    '''
+    PRINCIPALS.invalidate(username)
+
+
 def authenticate_user(username: str, password: str):
     '''
     Authenticate the user.
     '''
-    user = get_authuser(username)
-    if not user:
-        return False
-    if user.role == CecilConstants.DEACTIVATED_ROLE:
-        return False
-    if not verify_password(password, user.hashed_password):
-        return False
-    return user
+    with profiling.phase("auth"):
+        user = get_authuser(username)
+        if not user:
+            return False
+        if user.role == CecilConstants.DEACTIVATED_ROLE:
+            return False
+        if not verify_password(password, user.hashed_password):
+            return False
+        return user
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -141,24 +268,35 @@ async def get_current_user(token: str = Depends(OAUTH2_SCHEME)):
     '''
     Get the current user with JWT token.
     '''
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, CONFIG.get(
-            CecilConstants.SECRET_KEY), algorithms=[CecilConstants.HASHING_ALGORITHM])
-        username: str = payload.get("sub")
+    with profiling.phase("auth"):
+        credentials_exception = HTTPException(
+            status_code=401,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        username = TOKENS.get(token)
         if username is None:
+            try:
+                payload = jwt.decode(token, CONFIG.get(
+                    CecilConstants.SECRET_KEY), algorithms=[CecilConstants.HASHING_ALGORITHM])
+                username: str = payload.get("sub")
+                if username is None:
+                    raise credentials_exception
+                token_data = json_models.TokenData(username=username)
+            except JWTError:
+                raise credentials_exception
+            username = token_data.username
+            # Never trust a cached token past its own expiry.
+            ttl = min(
+                CONFIG.get(CecilConstants.PRINCIPAL_CACHE_TTL_SECONDS),
+                payload.get("exp", 0) - time.time()
+            )
+            if ttl > 0:
+                TOKENS.put(token, username, ttl=ttl)
+        user = get_principal(username)
+        if user is None:
             raise credentials_exception
-        token_data = json_models.TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = get_authuser(username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+        return user
 
 
 async def get_current_active_user(current_user: json_models.AuthUser = Depends(get_current_user)):
@@ -181,6 +319,20 @@ async def get_current_admin_user(
     return current_user
 
 
+async def is_admin_token(authorization: str):
+    '''
+    Whether an Authorization header carries the token of an active admin.
+    '''
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        user = await get_current_user(token)
+    except HTTPException:
+        return False
+    return user.role == CecilConstants.ADMIN_ROLE
+
+
 @contextmanager
 def sess():
     '''
@@ -198,3 +350,11 @@ def sess():
 
 CONFIG = helpers.make_config()
 CONN = _make_conn()
+TOKENS = LRUCache(
+    CONFIG.get(CecilConstants.PRINCIPAL_CACHE_SIZE),
+    ttl=CONFIG.get(CecilConstants.PRINCIPAL_CACHE_TTL_SECONDS),
+)
+PRINCIPALS = LRUCache(
+    CONFIG.get(CecilConstants.PRINCIPAL_CACHE_SIZE),
+    ttl=CONFIG.get(CecilConstants.PRINCIPAL_CACHE_TTL_SECONDS),
+)
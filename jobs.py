@@ -0,0 +1,385 @@
+'''
+A durable job queue in cecil.db, worked by a pool of threads in every Cecil process.
+'''
+
+import json
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from fastapi.logger import logger
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+import internal_users
+import json_models
+import orm_models
+import helpers
+import metrics
+import ratelimit
+from constants import CecilConstants
+
+_HANDLERS = {}
+
+
+class JobContext:
+    '''
+    Handed to a running job so it can report how far along it is.
+    '''
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def report(self, progress: int, message: str = None):
+        '''
+        Record progress, as a percentage, and optionally a status message.
+        '''
+        with internal_users.sess() as session:
+            session.query(orm_models.Job).filter(
+                orm_models.Job.job_id == self.job_id
+            ).update({
+                "progress": max(0, min(100, int(progress))),
+                "message": message,
+                "heartbeat_at": datetime.utcnow(),
+            }, synchronize_session=False)
+            session.commit()
+
+
+def job(kind: str, twitter_costs: dict = None):
+    '''
+    Register a function as the handler for a kind of job.
+
+    The handler is called with a JobContext and the job's payload as keyword arguments.
+    twitter_costs estimates the Twitter API requests one run makes, per endpoint family:
+    either a fixed dict, or a function of the payload returning one, for jobs whose cost
+    depends on how big the account or list is. Jobs with costs are Twitter-bound: they
+    count against the twitter_bound_job_limit across all processes, and only start once
+    the rate limit scheduler grants their costs.
+    '''
+    def _register(handler):
+        _HANDLERS[kind] = (handler, twitter_costs or {})
+        return handler
+    return _register
+
+
+def _dedupe_key(kind: str, payload: dict):
+    return hashlib.sha256(
+        json.dumps([kind, payload], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _active_job(session, dedupe_key: str):
+    '''
+    The pending or running job with this dedupe key, of which there is at most one.
+    '''
+    return session.query(orm_models.Job).filter(
+        orm_models.Job.dedupe_key == dedupe_key,
+        orm_models.Job.status.in_([CecilConstants.JOB_PENDING, CecilConstants.JOB_RUNNING])
+    ).first()
+
+
+def enqueue(kind: str, payload: dict, priority: int = CecilConstants.PRIORITY_INTERACTIVE):
+    '''
+    Queue a job, or return the identical job that is already pending or running.
+
+    Interactive jobs run before bulk ones, and may use Twitter capacity reserved for them.
+    '''
+    _, twitter_costs = _HANDLERS[kind]
+    dedupe_key = _dedupe_key(kind, payload)
+    now = datetime.utcnow()
+    with internal_users.sess() as session:
+        existing = _active_job(session, dedupe_key)
+        if existing:
+            return json_models.Job.from_orm(existing)
+
+        new_job = orm_models.Job(
+            kind=kind,
+            payload=json.dumps(payload),
+            dedupe_key=dedupe_key,
+            twitter_bound=bool(twitter_costs),
+            priority=priority,
+            status=CecilConstants.JOB_PENDING,
+            progress=0,
+            attempts=0,
+            max_attempts=CONFIG.get(CecilConstants.JOB_MAX_ATTEMPTS),
+            run_after=now,
+            created_at=now,
+        )
+        session.add(new_job)
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another worker queued the same job between the check and the insert.
+            session.rollback()
+            return json_models.Job.from_orm(_active_job(session, dedupe_key))
+        session.refresh(new_job)
+        return json_models.Job.from_orm(new_job)
+
+
+def _batch_status(batch):
+    job_ids = json.loads(batch.job_ids)
+    counts = {
+        CecilConstants.JOB_PENDING: 0,
+        CecilConstants.JOB_RUNNING: 0,
+        CecilConstants.JOB_SUCCEEDED: 0,
+        CecilConstants.JOB_FAILED: 0,
+    }
+    progress = 0
+    with internal_users.sess() as session:
+        for status, job_progress in session.query(
+                orm_models.Job.status, orm_models.Job.progress
+        ).filter(orm_models.Job.job_id.in_(job_ids)):
+            counts[status] += 1
+            progress += job_progress
+
+    return json_models.JobBatch(
+        batch_id=batch.batch_id,
+        kind=batch.kind,
+        job_ids=job_ids,
+        pending=counts[CecilConstants.JOB_PENDING],
+        running=counts[CecilConstants.JOB_RUNNING],
+        succeeded=counts[CecilConstants.JOB_SUCCEEDED],
+        failed=counts[CecilConstants.JOB_FAILED],
+        progress=progress // len(job_ids) if job_ids else 100,
+        created_at=batch.created_at,
+    )
+
+
+def enqueue_batch(kind: str, payloads: list, priority: int = CecilConstants.PRIORITY_BULK):
+    '''
+    Queue one job per payload, tracked together as a batch.
+    '''
+    job_ids = list(dict.fromkeys(
+        enqueue(kind, payload, priority=priority).job_id for payload in payloads
+    ))
+    batch = orm_models.JobBatch(
+        kind=kind,
+        job_ids=json.dumps(job_ids),
+        created_at=datetime.utcnow(),
+    )
+    with internal_users.sess() as session:
+        session.add(batch)
+        session.commit()
+        session.refresh(batch)
+        session.expunge(batch)
+    return _batch_status(batch)
+
+
+def get_batch(batch_id: int):
+    '''
+    Get a batch's progress. Throw error if it does not exist.
+    '''
+    with internal_users.sess() as session:
+        batch = session.query(orm_models.JobBatch).get(batch_id)
+        if not batch:
+            raise HTTPException(
+                status_code=404, detail=f'Batch: {batch_id}, does not exist.')
+        session.expunge(batch)
+    return _batch_status(batch)
+
+
+def accepted(queued_job: json_models.Job):
+    '''
+    Body for a 202 response to a request that queued a job.
+    '''
+    return {**CecilConstants.MESSAGE_PROCESSING_IN_BACKGROUND, "job_id": queued_job.job_id}
+
+
+def get_job(job_id: int):
+    '''
+    Get a job's status. Throw error if it does not exist.
+    '''
+    with internal_users.sess() as session:
+        queued_job = session.query(orm_models.Job).get(job_id)
+        if not queued_job:
+            raise HTTPException(
+                status_code=404, detail=f'Job: {job_id}, does not exist.')
+        return json_models.Job.from_orm(queued_job)
+
+
+def get_jobs(status: str = None, kind: str = None, page: int = 1, page_size: int = 20):
+    '''
+    List jobs, newest first.
+    '''
+    with internal_users.sess() as session:
+        query = session.query(orm_models.Job)
+        if status:
+            query = query.filter(orm_models.Job.status == status)
+        if kind:
+            query = query.filter(orm_models.Job.kind == kind)
+        return [
+            json_models.Job.from_orm(queued_job) for queued_job in query.order_by(
+                orm_models.Job.job_id.desc()
+            ).offset((page - 1) * page_size).limit(page_size)
+        ]
+
+
+def _recover_abandoned(session):
+    '''
+    Put back jobs whose worker stopped heartbeating, e.g. because Cecil restarted.
+    '''
+    lease_expired = datetime.utcnow() - \
+        timedelta(seconds=CONFIG.get(CecilConstants.JOB_LEASE_SECONDS))
+    abandoned = session.query(orm_models.Job).filter(
+        orm_models.Job.status == CecilConstants.JOB_RUNNING,
+        orm_models.Job.heartbeat_at < lease_expired,
+    ).all()
+    for abandoned_job in abandoned:
+        logger.warning('Recovering abandoned job: %s', abandoned_job.job_id)
+        _finish_attempt(abandoned_job, "Worker stopped before the job finished.")
+    session.commit()
+
+
+def _claim_next():
+    '''
+    Atomically take the oldest runnable job, respecting the Twitter-bound job limit.
+    '''
+    now = datetime.utcnow()
+    with internal_users.sess() as session:
+        _recover_abandoned(session)
+        candidates = session.query(orm_models.Job.job_id).filter(
+            orm_models.Job.status == CecilConstants.JOB_PENDING,
+            orm_models.Job.run_after <= now,
+            orm_models.Job.kind.in_(list(_HANDLERS)),
+        ).order_by(
+            orm_models.Job.priority, orm_models.Job.run_after, orm_models.Job.job_id
+        ).limit(20).all()
+
+        running = aliased(orm_models.Job)
+        twitter_bound_running = session.query(func.count(running.job_id)).filter(
+            running.status == CecilConstants.JOB_RUNNING,
+            running.twitter_bound.is_(True),
+        ).scalar_subquery()
+
+        for (job_id,) in candidates:
+            # A single UPDATE is atomic in SQLite, so only one worker in one process wins.
+            claimed = session.query(orm_models.Job).filter(
+                orm_models.Job.job_id == job_id,
+                orm_models.Job.status == CecilConstants.JOB_PENDING,
+                or_(
+                    orm_models.Job.twitter_bound.is_(False),
+                    twitter_bound_running < CONFIG.get(
+                        CecilConstants.TWITTER_BOUND_JOB_LIMIT)
+                )
+            ).update({
+                "status": CecilConstants.JOB_RUNNING,
+                "attempts": orm_models.Job.attempts + 1,
+                "started_at": now,
+                "heartbeat_at": now,
+            }, synchronize_session=False)
+            session.commit()
+            if claimed:
+                claimed_job = session.query(orm_models.Job).get(job_id)
+                if _granted(session, claimed_job):
+                    return claimed_job
+            session.expire_all()
+    return None
+
+
+def _granted(session, claimed_job):
+    '''
+    Ask the rate limit scheduler for a Twitter-bound job's costs, or put the job back.
+    '''
+    _, twitter_costs = _HANDLERS[claimed_job.kind]
+    if not twitter_costs:
+        return True
+    if callable(twitter_costs):
+        twitter_costs = twitter_costs(**json.loads(claimed_job.payload))
+    wait = ratelimit.try_acquire(twitter_costs, claimed_job.priority)
+    if not wait:
+        return True
+
+    claimed_job.status = CecilConstants.JOB_PENDING
+    claimed_job.attempts -= 1
+    claimed_job.run_after = datetime.utcnow() + timedelta(seconds=wait)
+    session.commit()
+    return False
+
+
+def _finish_attempt(failed_job, message: str):
+    '''
+    Retry a failed job with exponential backoff, or give up on it.
+    '''
+    now = datetime.utcnow()
+    failed_job.message = message
+    if failed_job.attempts < failed_job.max_attempts:
+        failed_job.status = CecilConstants.JOB_PENDING
+        failed_job.run_after = now + timedelta(
+            seconds=CONFIG.get(CecilConstants.JOB_RETRY_BACKOFF_SECONDS) *
+            2 ** (failed_job.attempts - 1)
+        )
+    else:
+        failed_job.status = CecilConstants.JOB_FAILED
+        failed_job.finished_at = now
+
+
+def _run(claimed_job):
+    '''
+    Run a claimed job's handler and record the outcome.
+    '''
+    handler, _ = _HANDLERS[claimed_job.kind]
+    _RUNNING.add(claimed_job.job_id)
+    started = time.perf_counter()
+    try:
+        handler(JobContext(claimed_job.job_id), **json.loads(claimed_job.payload))
+        outcome = None
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception('Job failed: %s %s', claimed_job.job_id, claimed_job.kind)
+        outcome = repr(error)
+    finally:
+        _RUNNING.discard(claimed_job.job_id)
+    metrics.observe_job(
+        claimed_job.kind, "succeeded" if outcome is None else "failed",
+        time.perf_counter() - started)
+
+    with internal_users.sess() as session:
+        finished_job = session.query(orm_models.Job).get(claimed_job.job_id)
+        if outcome is None:
+            finished_job.status = CecilConstants.JOB_SUCCEEDED
+            finished_job.progress = 100
+            finished_job.finished_at = datetime.utcnow()
+        else:
+            _finish_attempt(finished_job, outcome)
+        session.commit()
+
+
+def _worker():
+    while not STOP.is_set():
+        try:
+            claimed_job = _claim_next()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to claim a job.')
+            claimed_job = None
+
+        if claimed_job is None:
+            STOP.wait(1)
+        else:
+            _run(claimed_job)
+
+
+def _heartbeat():
+    while not STOP.wait(CONFIG.get(CecilConstants.JOB_LEASE_SECONDS) / 3):
+        running = list(_RUNNING)
+        if not running:
+            continue
+        with internal_users.sess() as session:
+            session.query(orm_models.Job).filter(
+                orm_models.Job.job_id.in_(running)
+            ).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+            session.commit()
+
+
+def start_workers():
+    '''
+    Start this process's job workers, in daemon threads.
+    '''
+    for number in range(CONFIG.get(CecilConstants.JOB_WORKERS)):
+        threading.Thread(target=_worker, name=f"job-worker-{number}", daemon=True).start()
+    threading.Thread(target=_heartbeat, name="job-heartbeat", daemon=True).start()
+
+
+CONFIG = helpers.make_config()
+STOP = threading.Event()
+_RUNNING = set()
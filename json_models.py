@@ -1,7 +1,8 @@
 '''
 Pydantic models for requests and responses.
 '''
-from typing import List, Any
+from enum import Enum
+from typing import List, Any, Dict
 from datetime import datetime
 from pydantic import BaseModel
 
@@ -56,6 +57,7 @@ class BaseTweet(BaseModel):
     screen_name: str
     name: str
     last_updated: datetime
+    matched_words: List[str] = None
 
     class Config:
         '''Accept SQLAlchemy objects.'''
@@ -94,6 +96,7 @@ class User(BaseModel):
     url: str = None
     verified: bool = None
     last_updated: datetime = None
+    file_size: int = None
 
     class Config:
         '''Accept SQLAlchemy objects.'''
@@ -116,6 +119,13 @@ class AddUser(BaseModel):
     user_id: str
 
 
+class AddUsers(BaseModel):
+    '''
+    Add many users at once.
+    '''
+    user_ids: List[str]
+
+
 class AddWatchlist(BaseModel):
     '''
     Create a watchlist.
@@ -146,6 +156,60 @@ class AuthUserInDB(AuthUser):
     hashed_password: str
 
 
+class CacheStats(BaseModel):
+    '''
+    How well an in-process cache is doing.
+    '''
+    size: int
+    maxsize: int
+    bytes: int = 0
+    maxbytes: int = None
+    hits: int
+    misses: int
+    evictions: int
+
+
+class ExportFormat(str, Enum):
+    '''
+    File formats exports can be streamed in.
+    '''
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class UserSort(str, Enum):
+    '''
+    Orders the user directory can be listed in.
+    '''
+    user_id = "user_id"
+    screen_name = "screen_name"
+    followers_count = "followers_count"
+    friends_count = "friends_count"
+    last_updated = "last_updated"
+    file_size = "file_size"
+
+
+class LeaderboardSort(str, Enum):
+    '''
+    Stats a watchlist leaderboard can be ranked by.
+    '''
+    followers_watchlist_percent = "followers_watchlist_percent"
+    followers_watchlist_completion = "followers_watchlist_completion"
+    friends_watchlist_percent = "friends_watchlist_percent"
+    friends_watchlist_completion = "friends_watchlist_completion"
+    favorite_watchlist_percent = "favorite_watchlist_percent"
+    retweet_watchlist_percent = "retweet_watchlist_percent"
+
+
+class WatchlistSort(str, Enum):
+    '''
+    Orders watchlists can be listed in.
+    '''
+    watchlist_id = "watchlist_id"
+    watchlist_count = "watchlist_count"
+    last_updated = "last_updated"
+
+
 class Favorite(BaseTweet):
     '''
     A favorite is essentiallty a BaseTweet.
@@ -179,6 +243,52 @@ class InviteCode(BaseModel):
         orm_mode = True
 
 
+class Job(BaseModel):
+    '''
+    Status and progress of a background job.
+    '''
+    job_id: int
+    kind: str
+    status: str
+    progress: int
+    message: str = None
+    attempts: int
+    max_attempts: int
+    run_after: datetime
+    created_at: datetime
+    started_at: datetime = None
+    finished_at: datetime = None
+
+    class Config:
+        '''Accept SQLAlchemy objects.'''
+        orm_mode = True
+
+
+class JobBatch(BaseModel):
+    '''
+    Progress of a group of jobs queued together.
+    '''
+    batch_id: int
+    kind: str
+    job_ids: List[int]
+    pending: int
+    running: int
+    succeeded: int
+    failed: int
+    progress: int
+    created_at: datetime
+
+
+class RateLimitBucket(BaseModel):
+    '''
+    Twitter API requests available to an endpoint family right now.
+    '''
+    family: str
+    capacity: int
+    tokens: float
+    resets_in_seconds: float = None
+
+
 class RegistrationData(BaseModel):
     '''
     Information needed for signup.
@@ -188,6 +298,128 @@ class RegistrationData(BaseModel):
     invite_code: str
 
 
+class GraphInfo(BaseModel):
+    '''
+    Size of the directory's relationship graph, as of its last compute.
+    '''
+    nodes: int
+    edges: int
+    mutuals: int
+    components: int
+    computed_at: datetime
+
+
+class GraphNode(BaseModel):
+    '''
+    A directory user's place in the relationship graph.
+    '''
+    user_id: str
+    pagerank: float
+    component: int
+    in_degree: int
+    out_degree: int
+
+
+class GraphComponent(BaseModel):
+    '''
+    A weakly connected component of the relationship graph.
+    '''
+    component: int
+    size: int
+
+
+class LayoutInfo(BaseModel):
+    '''
+    The on-disk layout of the directory, and how far a migration has got.
+    '''
+    layout: str
+    flat: int
+    sharded: int
+
+
+class SearchHit(BaseModel):
+    '''
+    A directory user's tweet matching a search.
+    '''
+    owner_id: str
+    tweet_id: str
+    kind: str
+    created_at: datetime = None
+    screen_name: str = None
+    name: str = None
+    text: str = None
+    rank: float
+
+
+class SimilarUser(BaseModel):
+    '''
+    A directory user with a similar audience, and how similar.
+    '''
+    user_id: str
+    estimated_jaccard: float
+    jaccard: float
+
+
+class Relation(str, Enum):
+    '''
+    Relationships users can be compared on.
+    '''
+    followers = "followers"
+    friends = "friends"
+
+
+class SingleFlightStats(BaseModel):
+    '''
+    How many of a route's requests shared an in-flight computation.
+    '''
+    route: str
+    enabled: bool
+    leaders: int
+    coalesced: int
+    in_flight: int
+
+
+class Profile(BaseModel):
+    '''
+    Where one profiled request spent its time.
+    '''
+    profile_id: str
+    method: str
+    path: str
+    query: str
+    trigger: str
+    status: int = None
+    started_at: datetime
+    seconds: float
+    queries: int
+    phases: Dict[str, float]
+    has_dump: bool
+
+
+class ProfileDetail(Profile):
+    '''
+    A profile with the cProfile dump of its handler, if it was slow enough to keep one.
+    '''
+    dump: str = None
+
+
+class SnapshotInfo(BaseModel):
+    '''
+    What the directory snapshot currently holds.
+    '''
+    finished_at: datetime = None
+    users: int
+    tables: List[str]
+
+
+class StatsMatrixRequest(BaseModel):
+    '''
+    Users and watchlists to compute stats for, every user against every watchlist.
+    '''
+    user_ids: List[str]
+    watchlist_ids: List[str]
+
+
 class Tag(BaseModel):
     '''
     Embedded tag.
@@ -259,6 +491,13 @@ class UserStats(BaseModel):
     retweet_watchlist_percent: float
 
 
+class LeaderboardEntry(UserStats):
+    '''
+    A user's stats against a watchlist, as ranked on its leaderboard.
+    '''
+    user_id: str
+
+
 class WatchlistInfo(BaseModel):
     '''
     Top level info about a watchlist.
@@ -270,6 +509,42 @@ class WatchlistInfo(BaseModel):
 # Gamma Models
 
 
+class CursorPaginate(BaseModel):
+    '''
+    Base class for keyset paginated lists. Total is only counted when asked for.
+    '''
+    next_cursor: str = None
+    total: int = None
+
+
+class CursorFavorites(CursorPaginate):
+    '''
+    Favorites, a cursor at a time.
+    '''
+    items: List[Favorite]
+
+
+class CursorFriendsOrFollowing(CursorPaginate):
+    '''
+    Followers or friends, a cursor at a time.
+    '''
+    items: List[FriendsOrFollowing]
+
+
+class CursorTimeline(CursorPaginate):
+    '''
+    Timeline, a cursor at a time.
+    '''
+    items: List[TimelineTweet]
+
+
+class CursorUser(CursorPaginate):
+    '''
+    Users, a cursor at a time.
+    '''
+    items: List[User]
+
+
 class PaginateFavorites(Paginate):
     '''
     Favorite paginator.
@@ -291,6 +566,13 @@ class PaginateTimeline(Paginate):
     items: List[TimelineTweet]
 
 
+class PaginateSearch(Paginate):
+    '''
+    Search results paginator.
+    '''
+    items: List[SearchHit]
+
+
 class PaginateUser(Paginate):
     '''
     User paginator.
@@ -298,6 +580,45 @@ class PaginateUser(Paginate):
     items: List[User]
 
 
+class PaginateWatchlistUsers(PaginateUser):
+    '''
+    Watchlist user paginator, with how fresh the user data is.
+    '''
+    last_refreshed_at: datetime = None
+    stale: bool = True
+    refreshing: bool = False
+
+
+class PaginateGraphNodes(Paginate):
+    '''
+    Graph node paginator.
+    '''
+    items: List[GraphNode]
+
+
+class PaginateGraphComponents(Paginate):
+    '''
+    Graph component paginator.
+    '''
+    items: List[GraphComponent]
+
+
+class PaginateUserIds(Paginate):
+    '''
+    User id paginator.
+    '''
+    items: List[str]
+
+
+class PaginateLeaderboard(Paginate):
+    '''
+    Watchlist leaderboard paginator, with how fresh the ranking is.
+    '''
+    items: List[LeaderboardEntry]
+    ranked_at: datetime = None
+    stale: bool = True
+
+
 class PaginateUserNotes(Paginate):
     '''
     Paginate user notes.
@@ -0,0 +1,132 @@
+'''
+Keyset (cursor) pagination straight over baquet's tables, for pages deep into big lists.
+
+Each page seeks past the last row of the previous one through the table's ordering,
+instead of an OFFSET scan, and counting the total is optional and cached.
+'''
+
+import json
+import base64
+from contextlib import closing
+
+from fastapi import HTTPException
+
+import helpers
+from cache import LRUCache
+from constants import CecilConstants
+
+# Ordering of each kind of list, newest or lowest first, as (columns, descending).
+TWEET_ORDER = (("created_at", "tweet_id"), True)
+USER_ORDER = (("user_id",), False)
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values):
+    '''
+    Opaque cursor pointing just past a row.
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, arity: int):
+    '''
+    Values of the row a cursor points past. Throw error if it is not a cursor for an
+    ordering of arity columns, e.g. a user cursor handed to a timeline.
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != arity or not all(
+                isinstance(value, (str, int, float)) for value in values
+        ):
+            raise ValueError
+        return values
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'Cursor: {cursor}, is not valid.')
+
+
+def row_dict(cursor, values):
+    '''
+    A fetched row as a dict, with JSON columns decoded the way baquet returns them.
+    '''
+    row = dict(zip([column[0] for column in cursor.description], values))
+    if isinstance(row.get("entities"), str):
+        row["entities"] = json.loads(row["entities"])
+    return row
+
+
+def _count(conn, paths, table, where, params):
+    stamps = tuple((str(path), helpers.db_stamp(path)) for path in paths)
+    key = (stamps, table, where, tuple(params))
+    return TOTALS.get_or_create(
+        key,
+        lambda: conn.execute(f"SELECT COUNT(*) FROM {table} {where}", params).fetchone()[0]
+    )
+
+
+def page(
+        path,
+        table: str,
+        order: tuple,
+        cursor: str = None,
+        page_size: int = 20,
+        watchlist_path=None,
+        member_column: str = "user_id",
+        include_total: bool = False,
+):
+    '''
+    A page of rows from table, seeking past cursor.
+
+    watchlist_path optionally restricts rows to those whose member_column is on the watchlist.
+    '''
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f'Page size: {page_size}, must be 1 to {MAX_PAGE_SIZE}.')
+    columns, descending = order
+    clauses, params = [], []
+    if watchlist_path is not None:
+        clauses.append(
+            f"{member_column} IN "
+            f"(SELECT user_id FROM watchlist_db.{CecilConstants.WATCHLIST_TABLE})"
+        )
+    filters, filter_params = list(clauses), list(params)
+
+    if cursor:
+        key = f"({', '.join(columns)})"
+        clauses.append(f"{key} {'<' if descending else '>'} ({', '.join('?' * len(columns))})")
+        params.extend(decode_cursor(cursor, len(columns)))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    direction = "DESC" if descending else "ASC"
+    order_by = ", ".join(f"{column} {direction}" for column in columns)
+
+    with closing(helpers.read_only(path)) as conn:
+        if watchlist_path is not None:
+            conn.execute(
+                "ATTACH DATABASE ? AS watchlist_db",
+                (f"file:{watchlist_path.resolve()}?mode=ro",)
+            )
+        result = conn.execute(
+            f"SELECT * FROM {table} {where} ORDER BY {order_by} LIMIT ?",
+            params + [page_size + 1]
+        )
+        items = [row_dict(result, values) for values in result.fetchall()]
+        total = None
+        if include_total:
+            total = _count(
+                conn, [path] + ([watchlist_path] if watchlist_path else []), table,
+                f"WHERE {' AND '.join(filters)}" if filters else "", filter_params
+            )
+
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor([items[-1][column] for column in columns])
+
+    return {
+        'items': items,
+        'next_cursor': next_cursor,
+        'total': total,
+    }
+
+
+TOTALS = LRUCache(helpers.make_config().get(CecilConstants.STATS_CACHE_SIZE))
@@ -0,0 +1,117 @@
+'''
+Moves user and watchlist databases between the flat and sharded on-disk layouts.
+
+The sharded layout spreads databases over users/ab/cd/{id}.db, keyed by a hash of the id,
+so no one directory holds more than a few files. baquet only knows the flat path, so
+helpers.open_handle binds each handle's sessions to the sharded file, and moves a database
+baquet has just created there. Cecil resolves the sharded path first and never lists the
+flat directory once fully sharded.
+
+Moving a database another process has open is unsafe: SQLite names its journal after the
+path a connection opened, so two connections could journal one file under two names.
+Migration is therefore offline only. Every running Cecil process holds the directory lock
+shared, and `python layout.py` migrates only if it can take the lock exclusively.
+'''
+
+import os
+from pathlib import Path
+from fastapi.logger import logger
+
+import helpers
+from constants import CecilConstants
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DIRECTORIES = ["users", "watchlists"]
+_LOCK = {}
+
+
+def _busy(path):
+    '''
+    Whether SQLite left a journal beside the database, which must be recovered in place.
+    '''
+    return any(os.path.exists(f"{path}{suffix}") for suffix in ("-journal", "-wal"))
+
+
+def hold():
+    '''
+    Hold the directory lock shared for as long as this process runs, so the layout is
+    never migrated underneath it.
+    '''
+    if fcntl is None or "file" in _LOCK:
+        return
+    # pylint: disable=consider-using-with
+    _LOCK["file"] = open(CecilConstants.LAYOUT_LOCK_PATH, "a", encoding="utf-8")
+    fcntl.flock(_LOCK["file"], fcntl.LOCK_SH)
+
+
+def relocate(directoryname: str, filename: str):
+    '''
+    Move one database into the sharded layout. Returns whether it was moved.
+
+    Only safe while no other process has the database open; see migrate.
+    '''
+    flat = helpers.flat_path(directoryname, filename)
+    if not flat.exists() or _busy(flat):
+        return False
+
+    sharded = helpers.shard_path(directoryname, filename)
+    helpers.HANDLES.invalidate((directoryname, filename))
+    sharded.parent.mkdir(parents=True, exist_ok=True)
+    os.rename(flat, sharded)
+    return True
+
+
+def get_layout():
+    '''
+    The configured layout, and how many databases are in each.
+    '''
+    counts = {'flat': 0, 'sharded': 0}
+    for directoryname in DIRECTORIES:
+        root = Path(f"./{directoryname}")
+        if not root.exists():
+            continue
+        counts['sharded'] += sum(1 for _ in root.glob("*/*/*.db"))
+        counts['flat'] += sum(1 for _ in root.glob("*.db"))
+    return {'layout': CONFIG.get(CecilConstants.DB_LAYOUT), **counts}
+
+
+def migrate():
+    '''
+    Move every flat database into the sharded layout, refusing while Cecil runs.
+    '''
+    if fcntl is None:
+        raise RuntimeError("Migrating the layout needs fcntl to tell whether Cecil is running.")
+    with open(CecilConstants.LAYOUT_LOCK_PATH, "a", encoding="utf-8") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as error:
+            raise RuntimeError("Cecil is running; stop it before migrating the layout.") \
+                from error
+
+        moved, skipped = 0, []
+        for directoryname in DIRECTORIES:
+            for path in sorted(Path(f"./{directoryname}").glob("*.db")):
+                if relocate(directoryname, path.stem):
+                    moved += 1
+                else:
+                    skipped.append(str(path))
+
+    logger.info('Moved %s databases into the sharded layout.', moved)
+    if skipped:
+        logger.warning(
+            'Left databases with a journal beside them, open them once to recover: %s',
+            ", ".join(skipped)
+        )
+    return moved, skipped
+
+
+CONFIG = helpers.make_config()
+
+
+if __name__ == "__main__":
+    MOVED, SKIPPED = migrate()
+    print(f"Moved {MOVED} databases, left {len(SKIPPED)} with a journal beside them.")
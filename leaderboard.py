@@ -0,0 +1,190 @@
+'''
+Materialized per-watchlist leaderboards, ranking every directory user on their UserStats.
+
+A watchlist gets a leaderboard the first time one is asked for. From then on each row
+is recomputed only when its user's database changes, and the whole board only when the
+watchlist's membership does. Boards are keyed on a digest of the members rather than the
+watchlist database, which every refresh of their user data rewrites. Boards are served
+from indexed tables in leaderboard.db.
+'''
+
+from datetime import datetime
+from contextlib import closing
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+import helpers
+import jobs
+import stats
+from constants import CecilConstants
+
+FIELDS = [
+    "followers_watchlist_percent",
+    "followers_watchlist_completion",
+    "friends_watchlist_percent",
+    "friends_watchlist_completion",
+    "favorite_watchlist_percent",
+    "retweet_watchlist_percent",
+]
+
+
+def _create_schema(conn):
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "CREATE TABLE IF NOT EXISTS boards (watchlist_id TEXT PRIMARY KEY, "
+        "members_digest TEXT, ranked_at TEXT);"
+        "CREATE TABLE IF NOT EXISTS entries (watchlist_id TEXT NOT NULL, "
+        "user_id TEXT NOT NULL, user_stamp TEXT, "
+        f"{', '.join(f'{field} REAL' for field in FIELDS)}, "
+        "PRIMARY KEY (watchlist_id, user_id));"
+        + "".join(
+            f"CREATE INDEX IF NOT EXISTS ix_entries_{field} "
+            f"ON entries (watchlist_id, {field}, user_id);"
+            for field in FIELDS
+        )
+    )
+    if not _has_digest(conn):
+        # Boards keyed on the old watchlist stamp are rebuilt the next time they are read.
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not _has_digest(conn):
+                conn.execute("ALTER TABLE boards ADD COLUMN members_digest TEXT")
+
+
+def _connect():
+    return helpers.cecil_db(CecilConstants.LEADERBOARD_DB_PATH, _create_schema)
+
+
+def _has_digest(conn):
+    return "members_digest" in {row[1] for row in conn.execute("PRAGMA table_info(boards)")}
+
+
+def _upsert(conn, watchlist_id: str, user_id: str, user_stamp, user_stats: dict):
+    conn.execute(
+        f"INSERT OR REPLACE INTO entries (watchlist_id, user_id, user_stamp, "
+        f"{', '.join(FIELDS)}) VALUES ({', '.join('?' * (len(FIELDS) + 3))})",
+        [watchlist_id, user_id, str(user_stamp)] + [user_stats[field] for field in FIELDS]
+    )
+
+
+@jobs.job("rank_watchlist")
+def rank_watchlist(context: jobs.JobContext, watchlist_id: str):
+    '''
+    Rebuild a watchlist's leaderboard if its members changed, else catch up changed users.
+    '''
+    members_digest = stats.load_watchlist_set(watchlist_id)['digest']
+    user_stamps = {
+        user_id: str(helpers.db_stamp(helpers.db_path("users", user_id)))
+        for user_id in helpers.db_ids("users")
+    }
+    with closing(_connect()) as conn:
+        board = conn.execute(
+            "SELECT members_digest FROM boards WHERE watchlist_id = ?", (watchlist_id,)
+        ).fetchone()
+        existing = dict(conn.execute(
+            "SELECT user_id, user_stamp FROM entries WHERE watchlist_id = ?", (watchlist_id,)
+        ).fetchall())
+        # New or departed members change every row, so nothing already ranked can be kept.
+        ranked = existing if board and board[0] == members_digest else {}
+        changed = [
+            user_id for user_id, stamp in sorted(user_stamps.items())
+            if ranked.get(user_id) != stamp
+        ]
+
+        with conn:
+            conn.executemany(
+                "DELETE FROM entries WHERE watchlist_id = ? AND user_id = ?",
+                [(watchlist_id, removed) for removed in set(existing) - set(user_stamps)]
+            )
+        # Commit as rows arrive, so rank_user jobs are not locked out of a long rebuild.
+        for done, row in enumerate(
+                stats.matrix_rows(changed, [watchlist_id]), start=1
+        ):
+            _upsert(conn, watchlist_id, row['user_id'], user_stamps[row['user_id']],
+                    row['stats'][watchlist_id])
+            if done % 100 == 0 or done == len(changed):
+                conn.commit()
+                context.report(done * 100 // len(changed))
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO boards (watchlist_id, members_digest, ranked_at) "
+                "VALUES (?, ?, ?)",
+                (watchlist_id, members_digest, datetime.utcnow().isoformat())
+            )
+    logger.info('Ranked %s users for watchlist: %s', len(changed), watchlist_id)
+
+
+@jobs.job("rank_user")
+def rank_user(context: jobs.JobContext, user_id: str):  # pylint: disable=unused-argument
+    '''
+    Update a user's row on every leaderboard, after their database changed.
+    '''
+    user_stamp = str(helpers.db_stamp(helpers.db_path("users", user_id)))
+    with closing(_connect()) as conn:
+        boards = [row[0] for row in conn.execute("SELECT watchlist_id FROM boards")]
+        for watchlist_id in boards:
+            try:
+                helpers.db_path("watchlists", watchlist_id)
+            except HTTPException:
+                logger.warning('Skipping leaderboard of missing watchlist: %s', watchlist_id)
+                continue
+            with conn:
+                _upsert(conn, watchlist_id, user_id, user_stamp,
+                        stats.get_user_stats(user_id, watchlist_id))
+
+
+def queue_rank_user(user_id: str):
+    '''
+    Queue an update of a user's leaderboard rows.
+    '''
+    return jobs.enqueue(
+        "rank_user", {"user_id": user_id}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def queue_rank_watchlist(watchlist_id: str):
+    '''
+    Queue a rebuild or catch up of a watchlist's leaderboard.
+    '''
+    return jobs.enqueue(
+        "rank_watchlist", {"watchlist_id": watchlist_id}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def get_leaderboard(
+        watchlist_id: str,
+        sort: str = FIELDS[0],
+        descending: bool = True,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    A page of a watchlist's leaderboard, queueing a rebuild if it is missing or stale.
+    '''
+    members_digest = stats.load_watchlist_set(watchlist_id)['digest']
+    direction = "DESC" if descending else "ASC"
+    with closing(_connect()) as conn:
+        board = conn.execute(
+            "SELECT members_digest, ranked_at FROM boards WHERE watchlist_id = ?",
+            (watchlist_id,)
+        ).fetchone()
+        total = conn.execute(
+            "SELECT COUNT(*) FROM entries WHERE watchlist_id = ?", (watchlist_id,)
+        ).fetchone()[0]
+        cursor = conn.execute(
+            f"SELECT user_id, {', '.join(FIELDS)} FROM entries WHERE watchlist_id = ? "
+            f"ORDER BY {sort} {direction}, user_id {direction} LIMIT ? OFFSET ?",
+            (watchlist_id, page_size, (page - 1) * page_size)
+        )
+        columns = [column[0] for column in cursor.description]
+        items = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    stale = board is None or board[0] != members_digest
+    if stale:
+        queue_rank_watchlist(watchlist_id)
+    return {
+        **helpers.paginated(items, total, page, page_size),
+        'ranked_at': board[1] if board else None,
+        'stale': stale,
+    }
+
+
+CONFIG = helpers.make_config()
@@ -0,0 +1,283 @@
+'''
+Prometheus metrics: request latency per route, threadpool depth, database queries,
+bcrypt and background jobs.
+
+Queries are timed both through SQLAlchemy, for baquet and cecil.db, and through the
+sqlite3 connection class Cecil opens its other files and direct reads with.
+
+Needs the optional prometheus_client package; without it every recorder does nothing.
+When uvicorn runs several workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+before starting Cecil, so each worker writes its samples there and /metrics sums them.
+'''
+
+import os
+import time
+import asyncio
+import sqlite3
+from pathlib import Path
+from contextlib import contextmanager
+from fastapi import HTTPException
+from anyio import to_thread
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from constants import CecilConstants
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+_DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+_BCRYPT_BUCKETS = (.05, .1, .2, .3, .5, .75, 1, 2, 5)
+_JOB_BUCKETS = (.1, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600)
+_SAMPLER = {}
+
+
+def require_prometheus():
+    '''
+    Throw error if the optional prometheus_client package is missing.
+    '''
+    if prometheus_client is None:
+        raise HTTPException(
+            status_code=501, detail="Metrics need the prometheus_client package installed.")
+
+
+def _multiprocess():
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+if prometheus_client is not None:
+    REQUESTS = prometheus_client.Counter(
+        "cecil_requests_total", "HTTP requests handled.", ["method", "route", "status"])
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        "cecil_request_seconds", "Time to answer an HTTP request.", ["method", "route"])
+    THREADPOOL_BUSY = prometheus_client.Gauge(
+        "cecil_threadpool_busy", "Threadpool threads running a request handler.",
+        multiprocess_mode="livesum")
+    THREADPOOL_WAITING = prometheus_client.Gauge(
+        "cecil_threadpool_waiting", "Request handlers queued for a threadpool thread.",
+        multiprocess_mode="livesum")
+    QUERY_SECONDS = prometheus_client.Histogram(
+        "cecil_db_query_seconds", "Time to execute a statement.", ["database"],
+        buckets=_DB_BUCKETS)
+    FETCH_SECONDS = prometheus_client.Counter(
+        "cecil_db_fetch_seconds", "Time spent fetching rows from sqlite3 cursors.",
+        ["database"])
+    BCRYPT_SECONDS = prometheus_client.Histogram(
+        "cecil_bcrypt_seconds", "Time spent hashing or verifying a secret.", ["operation"],
+        buckets=_BCRYPT_BUCKETS)
+    JOB_SECONDS = prometheus_client.Histogram(
+        "cecil_job_seconds", "Time to run a background job.", ["kind", "outcome"],
+        buckets=_JOB_BUCKETS)
+
+
+def _database(database: str):
+    '''
+    Which family of database a path or sqlite URI names, so labels stay few.
+    '''
+    path = Path((database or "memory").replace("file:", "", 1).split("?")[0])
+    for directoryname in [CecilConstants.USERS_PATH, CecilConstants.WL_PATH]:
+        if Path(directoryname).name in path.parts:
+            return Path(directoryname).name
+    return path.stem
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    started = conn.info["query_started"].pop()
+    QUERY_SECONDS.labels(_database(conn.engine.url.database)).observe(
+        time.perf_counter() - started)
+
+
+def _failed_execute(context):
+    # A failed statement never reaches after_cursor_execute; its start is popped here.
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+if prometheus_client is not None:
+    # Listening on the class catches every engine, baquet's own included.
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+    event.listen(Engine, "handle_error", _failed_execute)
+
+
+@contextmanager
+def _timed(record):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(time.perf_counter() - started)
+
+
+class _TimedCursor(sqlite3.Cursor):
+    '''
+    A cursor that times its statements and its fetches.
+    '''
+
+    def execute(self, *args, **kwargs):
+        with _timed(QUERY_SECONDS.labels(self.connection.database).observe):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with _timed(QUERY_SECONDS.labels(self.connection.database).observe):
+            return super().executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with _timed(FETCH_SECONDS.labels(self.connection.database).inc):
+            return super().fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with _timed(FETCH_SECONDS.labels(self.connection.database).inc):
+            return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with _timed(FETCH_SECONDS.labels(self.connection.database).inc):
+            return super().fetchall()
+
+    def __next__(self):
+        with _timed(FETCH_SECONDS.labels(self.connection.database).inc):
+            return super().__next__()
+
+
+class _TimedConnection(sqlite3.Connection):
+    '''
+    A connection whose statements all run on timed cursors, labelled by database family.
+    '''
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database = _database(str(database))
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
+
+
+# The sqlite3 classes to connect with: timed only when there is somewhere to record to.
+Cursor = _TimedCursor if prometheus_client is not None else sqlite3.Cursor
+Connection = _TimedConnection if prometheus_client is not None else sqlite3.Connection
+
+
+def _route(request):
+    '''
+    The path template that served a request, never the raw path, so labels stay few.
+    '''
+    endpoint = request.scope.get("endpoint")
+    for route in request.app.routes:
+        if getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    return "unmatched"
+
+
+def _sample_threadpool():
+    statistics = to_thread.current_default_thread_limiter().statistics()
+    THREADPOOL_BUSY.set(statistics.borrowed_tokens)
+    THREADPOOL_WAITING.set(statistics.tasks_waiting)
+
+
+async def _sample_periodically(seconds: float):
+    while True:
+        _sample_threadpool()
+        await asyncio.sleep(seconds)
+
+
+def start_sampler(seconds: float):
+    '''
+    Sample the threadpool every few seconds from the running event loop, so a backlog is
+    seen while requests are stuck in it rather than only as they start and finish.
+    '''
+    if prometheus_client is None or "task" in _SAMPLER:
+        return
+    _SAMPLER["task"] = asyncio.get_running_loop().create_task(_sample_periodically(seconds))
+
+
+def stop_sampler():
+    '''
+    Stop sampling the threadpool.
+    '''
+    task = _SAMPLER.pop("task", None)
+    if task is not None:
+        task.cancel()
+
+
+async def middleware(request, call_next):
+    '''
+    Count and time every request.
+    '''
+    if prometheus_client is None:
+        return await call_next(request)
+
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = _route(request)
+        REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - started)
+        REQUESTS.labels(request.method, route, status).inc()
+
+
+@contextmanager
+def time_bcrypt(operation: str):
+    '''
+    Time one bcrypt hash or verify.
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if prometheus_client is not None:
+            BCRYPT_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+
+def observe_job(kind: str, outcome: str, seconds: float):
+    '''
+    Record how long a background job ran and how it ended.
+    '''
+    if prometheus_client is not None:
+        JOB_SECONDS.labels(kind, outcome).observe(seconds)
+
+
+def render():
+    '''
+    Every metric in Prometheus' text format, summed over all workers in multiprocess mode.
+    '''
+    require_prometheus()
+    _sample_threadpool()
+    registry = prometheus_client.REGISTRY
+    if _multiprocess():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
+
+
+def content_type():
+    '''
+    The media type Prometheus expects from /metrics.
+    '''
+    require_prometheus()
+    return prometheus_client.CONTENT_TYPE_LATEST
+
+
+def retire():
+    '''
+    Drop this worker's live gauges when it exits, so they stop counting towards the sum.
+    '''
+    if prometheus_client is not None and _multiprocess():
+        multiprocess.mark_process_dead(os.getpid())
@@ -2,7 +2,7 @@
 This is where Cecil's users are kept.
 '''
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 
 BASE = declarative_base()
@@ -14,7 +14,7 @@ class User(BASE):
     '''
     __tablename__ = 'users'
     user_id = Column(Integer, primary_key=True)
-    username = Column(String, nullable=False)
+    username = Column(String, nullable=False, unique=True, index=True)
     hashed_password = Column(String, nullable=False)
     role = Column(Integer, ForeignKey('roles.role_id'), nullable=False)
     invited_by = Column(Integer, ForeignKey('users.user_id'), nullable=True)
@@ -38,6 +38,51 @@ class InviteCode(BASE):
     __tablename__ = 'invite_codes'
     invite_id = Column(Integer, primary_key=True)
     hashed_invite_code = Column(String, unique=True)
+    invite_lookup = Column(String, unique=True, index=True, nullable=True)
     expires_at = Column(DateTime)
     created_by = Column(Integer, ForeignKey('users.user_id'), nullable=True)
     created_at = Column(DateTime)
+
+
+class WatchlistRefresh(BASE):
+    '''
+    When a watchlist's user data was last refreshed, and whether a refresh is underway.
+    '''
+    __tablename__ = 'watchlist_refreshes'
+    watchlist_id = Column(String, primary_key=True)
+    last_refreshed_at = Column(DateTime, nullable=True)
+    refresh_started_at = Column(DateTime, nullable=True)
+
+
+class Job(BASE):
+    '''
+    Background work, kept in the DB so it survives restarts.
+    '''
+    __tablename__ = 'jobs'
+    job_id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False, index=True)
+    payload = Column(String, nullable=False)
+    dedupe_key = Column(String, nullable=False, index=True)
+    twitter_bound = Column(Boolean, nullable=False, default=False)
+    priority = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False, index=True)
+    progress = Column(Integer, nullable=False, default=0)
+    message = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    run_after = Column(DateTime, nullable=False)
+    heartbeat_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class JobBatch(BASE):
+    '''
+    A group of jobs queued together, tracked as one.
+    '''
+    __tablename__ = 'job_batches'
+    batch_id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    job_ids = Column(String, nullable=False)
+    created_at = Column(DateTime)
@@ -0,0 +1,301 @@
+'''
+Opt-in profiling of single requests.
+
+A profiled request records where its time went, by phase: auth, handle_open, query,
+handler (the route's own Python), serialization (request validation, response models and
+JSON encoding) and other (middleware, routing and waiting for a threadpool thread). Phases
+are exclusive, so a query run while opening a handle counts as query only. Slow requests
+can also keep a cProfile dump of their handler. Profiles are kept, per process, in a
+ring buffer of the most recent ones.
+'''
+
+import io
+import cProfile
+import pstats
+import asyncio
+import threading
+import time
+from uuid import uuid4
+from functools import wraps
+from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+CURRENT = ContextVar("profile", default=None)
+PROFILES = deque()
+_PROFILES_LOCK = threading.Lock()
+_CPROFILE_LOCK = threading.Lock()
+
+
+class Profile:
+    '''
+    Exclusive time per phase of one request.
+    '''
+
+    def __init__(self, dump: bool):
+        self.phases = {}
+        self.queries = 0
+        self.dump = dump
+        self.stats = None
+        self._stack = []
+        self._resumed = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _charge(self, now):
+        if self._stack:
+            name = self._stack[-1]
+            self.phases[name] = self.phases.get(name, 0) + now - self._resumed
+        self._resumed = now
+
+    def enter(self, name: str):
+        '''
+        Start a phase, pausing the one it interrupts.
+        '''
+        with self._lock:
+            self._charge(time.perf_counter())
+            self._stack.append(name)
+
+    def leave(self):
+        '''
+        End the innermost phase and resume the one it interrupted.
+        '''
+        with self._lock:
+            self._charge(time.perf_counter())
+            if self._stack:
+                self._stack.pop()
+
+
+@contextmanager
+def phase(name: str):
+    '''
+    Charge the time spent inside to a phase of the current profile, if there is one.
+    '''
+    current = CURRENT.get()
+    if current is None:
+        yield
+        return
+    current.enter(name)
+    try:
+        yield
+    finally:
+        current.leave()
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    current = CURRENT.get()
+    if current is not None:
+        current.queries += 1
+        current.enter("query")
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    current = CURRENT.get()
+    if current is not None:
+        current.leave()
+
+
+def _failed_execute(context):
+    # pylint: disable=unused-argument
+    current = CURRENT.get()
+    if current is not None:
+        current.leave()
+
+
+# Listening on the class catches every engine, baquet's own included.
+event.listen(Engine, "before_cursor_execute", _before_execute)
+event.listen(Engine, "after_cursor_execute", _after_execute)
+event.listen(Engine, "handle_error", _failed_execute)
+
+
+def _count_query():
+    current = CURRENT.get()
+    if current is not None:
+        current.queries += 1
+
+
+class _ProfiledCursor(metrics.Cursor):
+    '''
+    A cursor that charges executing and fetching to the query phase.
+    '''
+
+    def execute(self, *args, **kwargs):
+        _count_query()
+        with phase("query"):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _count_query()
+        with phase("query"):
+            return super().executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with phase("query"):
+            return super().fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with phase("query"):
+            return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with phase("query"):
+            return super().fetchall()
+
+    def __next__(self):
+        with phase("query"):
+            return super().__next__()
+
+
+class _ProfiledConnection(metrics.Connection):
+    '''
+    A connection whose statements all run on profiled cursors.
+    '''
+
+    def cursor(self, factory=_ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
+
+
+def connection_factory():
+    '''
+    The sqlite3 connection class to use: profiled only while a request is being profiled,
+    and timed for metrics whenever prometheus_client is installed.
+    '''
+    return metrics.Connection if CURRENT.get() is None else _ProfiledConnection
+
+
+def _profiled_endpoint(endpoint):
+    '''
+    Charge an endpoint to the handler phase, under cProfile if a dump may be kept.
+    '''
+    if getattr(endpoint, "__profiled__", False):
+        return endpoint
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            with phase("handler"):
+                return await endpoint(*args, **kwargs)
+        wrapper = async_wrapper
+    else:
+        @wraps(endpoint)
+        def sync_wrapper(*args, **kwargs):
+            current = CURRENT.get()
+            with phase("handler"):
+                # Python 3.12+ allows one active profiler per process, which also sees
+                # other threads. A request profiled while another is, or while some other
+                # profiler runs, goes without a dump rather than failing.
+                if current is None or not current.dump or \
+                        not _CPROFILE_LOCK.acquire(blocking=False):
+                    return endpoint(*args, **kwargs)
+                try:
+                    profiler = cProfile.Profile()
+                    try:
+                        profiler.enable()
+                    except ValueError:
+                        return endpoint(*args, **kwargs)
+                    try:
+                        return endpoint(*args, **kwargs)
+                    finally:
+                        profiler.disable()
+                        current.stats = profiler
+                finally:
+                    _CPROFILE_LOCK.release()
+        wrapper = sync_wrapper
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    '''
+    A route that splits its time into handler and serialization for profiled requests.
+    '''
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _profiled_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            with phase("serialization"):
+                return await handler(request)
+
+        return profiled_handler
+
+
+def _dump(profiler):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(50)
+    return output.getvalue()
+
+
+@contextmanager
+def profiled(request, trigger: str, dump_seconds: float, keep: int):
+    '''
+    Profile the request handled inside, then keep the result in the ring buffer.
+    '''
+    current = Profile(dump=dump_seconds > 0)
+    record = {
+        'profile_id': uuid4().hex,
+        'method': request.method,
+        'path': request.url.path,
+        'query': request.url.query,
+        'trigger': trigger,
+        'started_at': datetime.utcnow(),
+        'status': None,
+    }
+    started = time.perf_counter()
+    token = CURRENT.set(current)
+    try:
+        yield record
+    finally:
+        CURRENT.reset(token)
+        seconds = time.perf_counter() - started
+        phases = dict(current.phases)
+        phases['other'] = max(seconds - sum(phases.values()), 0)
+        keep_dump = current.stats is not None and seconds >= dump_seconds
+        record.update({
+            'seconds': seconds,
+            'queries': current.queries,
+            'phases': phases,
+            'has_dump': keep_dump,
+            'dump': _dump(current.stats) if keep_dump else None,
+        })
+        with _PROFILES_LOCK:
+            PROFILES.append(record)
+            while len(PROFILES) > keep:
+                PROFILES.popleft()
+
+
+def get_profiles(min_seconds: float = 0, limit: int = 50):
+    '''
+    The most recent profiles, newest first.
+    '''
+    with _PROFILES_LOCK:
+        profiles = list(PROFILES)
+    return [
+        profile for profile in reversed(profiles) if profile['seconds'] >= min_seconds
+    ][:limit]
+
+
+def get_profile(profile_id: str):
+    '''
+    One profile with its cProfile dump, or None if it has left the ring buffer.
+    '''
+    with _PROFILES_LOCK:
+        return next(
+            (profile for profile in PROFILES if profile['profile_id'] == profile_id), None)
@@ -0,0 +1,145 @@
+'''
+Twitter API rate limit windows for each endpoint family, shared by every Cecil process.
+
+Twitter allows each endpoint family a number of requests per fixed window that starts
+with the first request after the last reset. A continuous token bucket would let twice
+that through around a reset, so each family here counts what was spent in its current
+window instead. Windows live in a small SQLite file, so uvicorn workers draw on the same
+budget. Bulk work may not dip into the share of each window reserved for interactive
+requests.
+'''
+
+import time
+from math import ceil
+from contextlib import closing
+
+import helpers
+from constants import CecilConstants
+
+
+def _create_schema(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS windows "
+        "(family TEXT PRIMARY KEY, spent REAL NOT NULL, started_at REAL NOT NULL)"
+    )
+
+
+def _connect():
+    return helpers.cecil_db(
+        CecilConstants.RATELIMIT_DB_PATH, _create_schema, isolation_level=None)
+
+
+def _capacity(family: str):
+    return CONFIG.get(CecilConstants.TWITTER_RATE_LIMITS)[family]
+
+
+def _window_seconds():
+    # A granted job's first request reaches Twitter a little after our window opens, so
+    # Twitter's window closes later than ours; ours is held open a grace period longer.
+    return CONFIG.get(CecilConstants.TWITTER_RATE_LIMIT_WINDOW_SECONDS) + \
+        CONFIG.get(CecilConstants.TWITTER_RATE_LIMIT_GRACE_SECONDS)
+
+
+def _floor(family: str, priority: int):
+    '''
+    Requests a caller of this priority must leave unspent in the window.
+    '''
+    if priority == CecilConstants.PRIORITY_INTERACTIVE:
+        return 0
+    return _capacity(family) * CONFIG.get(CecilConstants.INTERACTIVE_RESERVE_FRACTION)
+
+
+def _window(conn, family: str, now: float):
+    '''
+    Requests spent in the family's current window and when it started. What a costly job
+    spent beyond its window is carried into the windows after it; an idle reset window
+    starts now.
+    '''
+    row = conn.execute(
+        "SELECT spent, started_at FROM windows WHERE family = ?", (family,)
+    ).fetchone()
+    if row is None:
+        return 0, now
+    spent, started_at = row
+    elapsed = int((now - started_at) // _window_seconds())
+    if elapsed:
+        spent = max(0, spent - elapsed * _capacity(family))
+        started_at = started_at + elapsed * _window_seconds() if spent else now
+    return spent, started_at
+
+
+def pages(count: int, page_size: int, most: int = None):
+    '''
+    Requests needed to page through count items, at least one.
+    '''
+    count = min(count or 0, most) if most else count or 0
+    return max(1, ceil(count / page_size))
+
+
+def try_acquire(costs: dict, priority: int = CecilConstants.PRIORITY_INTERACTIVE):
+    '''
+    Spend requests from every family in costs, all or nothing. A cost beyond a family's
+    capacity is granted only into an unspent window, and charged to the windows after it.
+
+    Returns 0 on success, otherwise the seconds until the window that blocked it resets.
+    '''
+    now = time.time()
+    with closing(_connect()) as conn:
+        # BEGIN IMMEDIATE takes the write lock up front, serialising all processes.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            wait = 0.0
+            windows = {}
+            for family, cost in costs.items():
+                spent, started_at = _window(conn, family, now)
+                windows[family] = (spent + cost, started_at)
+                # Never reserve so much that a bulk caller could not fit at all; past
+                # capacity, this leaves only an unspent window.
+                floor = min(_floor(family, priority), _capacity(family) - cost)
+                if _capacity(family) - spent - cost < floor:
+                    wait = max(wait, started_at + _window_seconds() - now)
+
+            if wait == 0:
+                for family, (spent, started_at) in windows.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO windows (family, spent, started_at) "
+                        "VALUES (?, ?, ?)",
+                        (family, spent, started_at)
+                    )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+    return wait
+
+
+def acquire(costs: dict, priority: int = CecilConstants.PRIORITY_INTERACTIVE):
+    '''
+    Spend requests from every family in costs, waiting for them if need be.
+    '''
+    while True:
+        wait = try_acquire(costs, priority)
+        if not wait:
+            return
+        time.sleep(min(wait, 5))
+
+
+def get_buckets():
+    '''
+    Requests left in each family's current window, and when it resets.
+    '''
+    now = time.time()
+    buckets = []
+    with closing(_connect()) as conn:
+        for family, capacity in CONFIG.get(CecilConstants.TWITTER_RATE_LIMITS).items():
+            spent, started_at = _window(conn, family, now)
+            buckets.append({
+                'family': family,
+                'capacity': capacity,
+                'tokens': max(0, capacity - spent),
+                'resets_in_seconds': started_at + _window_seconds() - now if spent else None,
+            })
+    return buckets
+
+
+CONFIG = helpers.make_config()
@@ -0,0 +1,155 @@
+'''
+Keeps watchlist user data fresh without making readers wait for it.
+'''
+
+import threading
+from datetime import datetime, timedelta
+from fastapi.logger import logger
+
+import catalog
+import internal_users
+import orm_models
+import helpers
+import jobs
+import ratelimit
+import versions
+from constants import CecilConstants
+
+
+def _stale_after():
+    return timedelta(minutes=CONFIG.get(CecilConstants.WATCHLIST_STALE_AFTER_MINUTES))
+
+
+def _claim(watchlist_id: str):
+    '''
+    Mark a refresh as started, unless another thread or worker already has.
+    '''
+    now = datetime.utcnow()
+    with internal_users.sess() as session:
+        if not session.query(orm_models.WatchlistRefresh).get(watchlist_id):
+            session.add(orm_models.WatchlistRefresh(watchlist_id=watchlist_id))
+            try:
+                session.commit()
+            except Exception:  # pylint: disable=broad-except
+                # Someone else created the row first, which is fine.
+                session.rollback()
+        # An abandoned claim (e.g. the worker died) expires after the stale window.
+        claimed = session.query(orm_models.WatchlistRefresh).filter(
+            orm_models.WatchlistRefresh.watchlist_id == watchlist_id,
+            (orm_models.WatchlistRefresh.refresh_started_at.is_(None)) |
+            (orm_models.WatchlistRefresh.refresh_started_at < now - _stale_after())
+        ).update({"refresh_started_at": now}, synchronize_session=False)
+        session.commit()
+        return claimed == 1
+
+
+def _release(watchlist_id: str, refreshed: bool):
+    with internal_users.sess() as session:
+        refresh = session.query(orm_models.WatchlistRefresh).get(watchlist_id)
+        refresh.refresh_started_at = None
+        if refreshed:
+            refresh.last_refreshed_at = datetime.utcnow()
+        session.commit()
+
+
+def get_refresh_state(watchlist_id: str):
+    '''
+    When the watchlist was last refreshed, and whether that is too long ago.
+    '''
+    with internal_users.sess() as session:
+        refresh = session.query(orm_models.WatchlistRefresh).get(watchlist_id)
+        last_refreshed_at = refresh.last_refreshed_at if refresh else None
+        refreshing = bool(refresh and refresh.refresh_started_at)
+
+    stale = last_refreshed_at is None or \
+        last_refreshed_at < datetime.utcnow() - _stale_after()
+    return {
+        'last_refreshed_at': last_refreshed_at,
+        'stale': stale,
+        'refreshing': refreshing,
+    }
+
+
+def _refresh_costs(watchlist_id: str):
+    '''
+    Twitter requests a refresh makes: one user lookup per hundred members.
+    '''
+    entry = catalog.get_entry("watchlists", watchlist_id) or {}
+    return {"users": ratelimit.pages(entry.get("watchlist_count"), 100)}
+
+
+@jobs.job("refresh_watchlist", twitter_costs=_refresh_costs)
+def refresh_watchlist(context: jobs.JobContext, watchlist_id: str):
+    # pylint: disable=unused-argument
+    '''
+    Refresh the user data of a watchlist, unless a refresh is already underway.
+    '''
+    if not _claim(watchlist_id):
+        logger.info('Refresh already underway for watchlist: %s', watchlist_id)
+        return
+
+    refreshed = False
+    try:
+        helpers.wl_getter(watchlist_id).refresh_watchlist_user_data()
+        refreshed = True
+        logger.info('Successfully refreshed watchlist: %s', watchlist_id)
+    except:
+        logger.error('Failed to refresh watchlist: %s', watchlist_id)
+        raise
+    finally:
+        _release(watchlist_id, refreshed)
+    queue_derive(watchlist_id)
+
+
+@jobs.job("derive_watchlist")
+def derive_watchlist(context: jobs.JobContext, watchlist_id: str):
+    # pylint: disable=unused-argument
+    '''
+    Bring the watchlist's catalog entry and version up to date after a pull from Twitter.
+    '''
+    versions.bump("watchlists", watchlist_id)
+    catalog.catalog_watchlist(watchlist_id)
+
+
+def queue_derive(watchlist_id: str):
+    '''
+    Queue the updates derived from a watchlist, apart from the pull that changed it, so
+    a failure there is retried without pulling from Twitter again.
+    '''
+    return jobs.enqueue("derive_watchlist", {"watchlist_id": watchlist_id})
+
+
+def queue_refresh(watchlist_id: str, priority: int = CecilConstants.PRIORITY_BULK):
+    '''
+    Queue a refresh of the watchlist's user data.
+    '''
+    return jobs.enqueue("refresh_watchlist", {"watchlist_id": watchlist_id}, priority=priority)
+
+
+def refresh_stale_watchlists():
+    '''
+    Queue a refresh for every watchlist whose user data has gone stale.
+    '''
+    for watchlist_id in catalog.get_watchlists():
+        refresh_state = get_refresh_state(watchlist_id)
+        if refresh_state['stale'] and not refresh_state['refreshing']:
+            queue_refresh(watchlist_id)
+
+
+def start_periodic_refresh():
+    '''
+    Refresh stale watchlists on an interval, in a daemon thread.
+    '''
+    interval = CONFIG.get(CecilConstants.WATCHLIST_REFRESH_INTERVAL_MINUTES)
+    if not interval:
+        return
+
+    def _loop():
+        while not STOP.wait(interval * 60):
+            refresh_stale_watchlists()
+
+    threading.Thread(target=_loop, name="watchlist-refresh", daemon=True).start()
+
+
+CONFIG = helpers.make_config()
+STOP = threading.Event()
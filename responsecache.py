@@ -0,0 +1,219 @@
+'''
+Caches the rendered JSON of read endpoints, keyed by route, parameters and data versions.
+
+Keys carry the version of every user and watchlist the request names, so a write
+makes the old entries unreachable instead of having to find and delete them. Entries
+live in an in-memory LRU bounded in bytes and, optionally, in a SQLite file bounded
+in bytes too, which every uvicorn worker shares.
+
+The key doubles as the response's ETag, so a conditional GET whose data is unchanged
+is answered 304 before the cache, baquet or pydantic are touched.
+'''
+
+import json
+import time
+import inspect
+import sqlite3
+import hashlib
+import functools
+import threading
+from enum import Enum
+from contextlib import closing
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.logger import logger
+from pydantic import parse_obj_as
+
+import catalog
+import helpers
+import singleflight
+import versions
+from cache import LRUCache
+from constants import CecilConstants
+
+
+def _versions(kwargs: dict, listing: str):
+    entity_versions = versions.get_versions(kwargs)
+    if listing:
+        entity_versions['catalog'] = catalog.get_stamp()
+    return entity_versions
+
+
+def _key(handler, kwargs: dict, entity_versions: dict):
+    parameters = {
+        name: value.value if isinstance(value, Enum) else value
+        for name, value in sorted(kwargs.items())
+    }
+    return hashlib.sha256(json.dumps(
+        [handler.__module__, handler.__name__, parameters, entity_versions], default=str
+    ).encode()).hexdigest()
+
+
+def _last_modified(kwargs: dict, listing: str, entity_versions: dict):
+    '''
+    The latest of the data's last_updated and its last write, e.g. a note added since,
+    over every entity the request names.
+    '''
+    if listing:
+        changes = [
+            catalog.get_last_updated(listing),
+            datetime.utcfromtimestamp(entity_versions['catalog'][0] // 1_000_000_000),
+        ]
+    else:
+        changes = []
+        for name, directoryname in versions.VERSIONED_PARAMETERS.items():
+            if name not in entity_versions:
+                continue
+            _, written, _, wal_written, _ = entity_versions[name]
+            changes.append(catalog.get_last_updated(directoryname, kwargs[name]))
+            changes.append(
+                datetime.utcfromtimestamp(max(written, wal_written or 0) // 1_000_000_000))
+    changes = [change for change in changes if change is not None]
+    return max(changes) if changes else None
+
+
+def _not_modified(request: Request, etag: str, last_modified: datetime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [
+            tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")
+        ]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return False
+        return last_modified <= since
+    return False
+
+
+def _render(response_model, result):
+    if response_model is not None:
+        result = parse_obj_as(response_model, result)
+    return json.dumps(
+        jsonable_encoder(result),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _disk_enabled():
+    return bool(CONFIG.get(CecilConstants.RESPONSE_CACHE_DISK_BYTES))
+
+
+def _create_schema(conn):
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "CREATE TABLE IF NOT EXISTS responses "
+        "(key TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, used_at REAL);"
+        "CREATE INDEX IF NOT EXISTS ix_responses_used_at ON responses (used_at);"
+    )
+
+
+def _connect():
+    return helpers.cecil_db(CecilConstants.RESPONSE_CACHE_DB_PATH, _create_schema)
+
+
+def _disk_get(key: str):
+    with closing(_connect()) as conn, conn:
+        row = conn.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+    return row[0] if row else None
+
+
+def _disk_put(key: str, body: bytes):
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, body, size, used_at) VALUES (?, ?, ?, ?)",
+            (key, body, len(body), time.time())
+        )
+        with _DISK_LOCK:
+            _DISK_WRITES[0] += 1
+            prune = _DISK_WRITES[0] % 100 == 0
+        if prune:
+            # Least recently used first, until the file is back under its budget.
+            conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                "SELECT key, SUM(size) OVER (ORDER BY used_at DESC) AS kept "
+                "FROM responses) WHERE kept > ?)",
+                (CONFIG.get(CecilConstants.RESPONSE_CACHE_DISK_BYTES),)
+            )
+
+
+def _fill(key: str, response_model, handler, kwargs: dict):
+    body = _render(response_model, handler(**kwargs))
+    MEMORY.put(key, body)
+    if _disk_enabled():
+        try:
+            _disk_put(key, body)
+        except sqlite3.Error:
+            logger.exception('Failed to write the response cache.')
+    return body
+
+
+def cached(response_model=None, listing: str = None):
+    '''
+    Serve a read endpoint's response from cache while the data it names is unchanged,
+    and answer conditional GETs for it.
+
+    response_model should be the route's own, so cached JSON matches what FastAPI
+    would have rendered. listing names the catalog table a directory listing is
+    served from, making the whole catalog part of its version.
+    '''
+    def _decorate(handler):
+        @functools.wraps(handler)
+        def _cached(request: Request, **kwargs):
+            entity_versions = _versions(kwargs, listing)
+            key = _key(handler, kwargs, entity_versions)
+            last_modified = _last_modified(kwargs, listing, entity_versions)
+            headers = {"ETag": f'"{key[:32]}"'}
+            if last_modified:
+                headers["Last-Modified"] = format_datetime(
+                    last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+            if _not_modified(request, headers["ETag"], last_modified):
+                return Response(status_code=304, headers=headers)
+
+            body = MEMORY.get(key)
+            if body is None and _disk_enabled():
+                try:
+                    body = _disk_get(key)
+                except sqlite3.Error:
+                    logger.exception('Failed to read the response cache.')
+                if body is not None:
+                    MEMORY.put(key, body)
+            if body is None:
+                body = singleflight.run(
+                    handler.__name__, key, lambda: _fill(key, response_model, handler, kwargs))
+            return Response(content=body, media_type="application/json", headers=headers)
+
+        # FastAPI reads the handler's parameters, plus the request for its headers.
+        signature = inspect.signature(handler)
+        _cached.__signature__ = signature.replace(parameters=[
+            *signature.parameters.values(),
+            inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+        ])
+        return _cached
+    return _decorate
+
+
+def cache_stats():
+    '''
+    Hit, miss and eviction counters for the in-memory tier.
+    '''
+    return MEMORY.stats()
+
+
+CONFIG = helpers.make_config()
+MEMORY = LRUCache(
+    CONFIG.get(CecilConstants.RESPONSE_CACHE_SIZE),
+    maxbytes=CONFIG.get(CecilConstants.RESPONSE_CACHE_BYTES),
+)
+_DISK_LOCK = threading.Lock()
+_DISK_WRITES = [0]
@@ -4,15 +4,26 @@ This module routes all user operations.
 
 from typing import List
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
 
 import internal_users
 import json_models
 import orm_models
 import helpers
+import graph
+import jobs
+import layout
+import profiling
+import ratelimit
+import responsecache
+# Registers the sign_directory job kind this router queues.
+import similarity  # pylint: disable=unused-import
+import singleflight
+import snapshots
 from constants import CecilConstants
 
-ROUTER = APIRouter()
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
 
 
 @ROUTER.get("/invite_codes/", response_model=List[json_models.InviteCode])
@@ -33,18 +44,25 @@ def post_invite_code(
     '''
     Generate an invite code to create new users.
     '''
-    invite_code_hash = internal_users.PWD_CONTEXT.hash(invite_c.text)
+    invite_code_hash = internal_users.get_password_hash(invite_c.text)
     created_at = datetime.utcnow()
     expires_at = created_at + \
         timedelta(minutes=CONFIG.get(
             CecilConstants.ACCESS_TOKEN_EXPIRE_MINUTES))
+    invite_lookup = internal_users.get_invite_lookup(invite_c.text)
     invite = orm_models.InviteCode(
         hashed_invite_code=invite_code_hash,
+        invite_lookup=invite_lookup,
         created_at=created_at,
         created_by=current_user.user_id,
         expires_at=expires_at,
     )
     with internal_users.sess() as session:
+        if session.query(orm_models.InviteCode).filter(
+                orm_models.InviteCode.invite_lookup == invite_lookup
+        ).first():
+            raise HTTPException(
+                status_code=400, detail="Invite code already exists.")
         session.add(invite)
         session.commit()
 
@@ -68,6 +86,124 @@ def deactivate_user(user_id: int):
             orm_models.User.user_id == user_id).first()
         user.role = CecilConstants.DEACTIVATED_ROLE
         session.commit()
+        internal_users.invalidate_principal(user.username)
+
+
+@ROUTER.get("/handles/", response_model=json_models.CacheStats)
+def get_handle_stats():
+    '''
+    Get counters for the registry of open user and watchlist handles.
+    '''
+    return helpers.handle_stats()
+
+
+@ROUTER.get("/response_cache/", response_model=json_models.CacheStats)
+def get_response_cache_stats():
+    '''
+    Get counters for the in-memory tier of the response cache.
+    '''
+    return responsecache.cache_stats()
+
+
+@ROUTER.get("/singleflight/", response_model=List[json_models.SingleFlightStats])
+def get_single_flight_stats():
+    '''
+    Get, per route, how many requests were coalesced onto an in-flight computation.
+    '''
+    return singleflight.get_stats()
+
+
+@ROUTER.get("/profiles/", response_model=List[json_models.Profile])
+def get_profiles(min_seconds: float = 0, limit: int = 50):
+    '''
+    Get this process's most recent request profiles, newest first.
+    '''
+    return profiling.get_profiles(min_seconds, limit)
+
+
+@ROUTER.get("/profiles/{profile_id}", response_model=json_models.ProfileDetail)
+def get_profile(profile_id: str):
+    '''
+    Get one request profile, with its cProfile dump if it kept one.
+    '''
+    profile = profiling.get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=404, detail=f'Profile: {profile_id}, does not exist.')
+    return profile
+
+
+@ROUTER.get("/ratelimits/", response_model=List[json_models.RateLimitBucket])
+def get_rate_limits():
+    '''
+    Get the Twitter API budget left in each endpoint family's bucket.
+    '''
+    return ratelimit.get_buckets()
+
+
+@ROUTER.get("/layout/", response_model=json_models.LayoutInfo)
+def get_layout():
+    '''
+    Get the on-disk layout of the directory, and how many databases are in each.
+    '''
+    return layout.get_layout()
+
+
+@ROUTER.post("/graph/", status_code=202)
+def accept_graph_directory():
+    '''
+    Bring the relationship graph up to date, re-reading only users that changed.
+    '''
+    graph.require_scipy()
+    return jobs.accepted(jobs.enqueue(
+        "graph_directory", {}, priority=CecilConstants.PRIORITY_BULK))
+
+
+@ROUTER.post("/similarity/", status_code=202)
+def accept_sign_directory():
+    '''
+    Bring every user's similarity signatures up to date, re-signing only users that changed.
+    '''
+    return jobs.accepted(jobs.enqueue(
+        "sign_directory", {}, priority=CecilConstants.PRIORITY_BULK))
+
+
+@ROUTER.get("/snapshots/", response_model=json_models.SnapshotInfo)
+def get_snapshot():
+    '''
+    Get what the Parquet snapshot of the directory currently holds.
+    '''
+    manifest = snapshots.get_manifest()
+    return {
+        'finished_at': manifest['finished_at'],
+        'users': len(manifest['users']),
+        'tables': snapshots.TABLES,
+    }
+
+
+@ROUTER.post("/snapshots/", status_code=202)
+def accept_snapshot():
+    '''
+    Bring the Parquet snapshot up to date, re-exporting only users that changed.
+    '''
+    snapshots.require_pyarrow()
+    return jobs.accepted(jobs.enqueue(
+        "snapshot_directory", {}, priority=CecilConstants.PRIORITY_BULK))
+
+
+@ROUTER.get("/snapshots/{table}/{user_id}")
+def get_snapshot_partition(
+        table: str,
+        user_id: str,
+):
+    '''
+    Download one user's Parquet file for a table.
+    '''
+    return FileResponse(
+        snapshots.get_partition(table, user_id),
+        media_type="application/vnd.apache.parquet",
+        filename=f"{table}_{user_id}.parquet"
+    )
 
 
 @ROUTER.delete("/invite_codes/{invite_code_id}")
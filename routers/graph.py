@@ -0,0 +1,75 @@
+'''
+This module routes all relationship graph operations.
+'''
+
+from fastapi import APIRouter
+
+import json_models
+import graph
+import profiling
+
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
+
+
+@ROUTER.get("/", response_model=json_models.GraphInfo)
+def get_graph():
+    '''
+    Get the size of the directory's relationship graph, as of its last compute.
+    '''
+    return graph.get_info()
+
+
+@ROUTER.get("/pagerank/", response_model=json_models.PaginateGraphNodes)
+def get_pagerank(
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    Get directory users ranked by PageRank within the directory.
+    '''
+    return graph.get_pagerank(page=page, page_size=page_size)
+
+
+@ROUTER.get("/components/", response_model=json_models.PaginateGraphComponents)
+def get_components(
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    Get the connected components of the graph, largest first.
+    '''
+    return graph.get_components(page=page, page_size=page_size)
+
+
+@ROUTER.get("/components/{component}/", response_model=json_models.PaginateUserIds)
+def get_component_members(
+        component: int,
+        page: int = 1,
+        page_size: int = 100,
+):
+    '''
+    Get the users in a connected component.
+    '''
+    return graph.get_component_members(component, page=page, page_size=page_size)
+
+
+@ROUTER.get("/users/{user_id}/", response_model=json_models.GraphNode)
+def get_node(
+        user_id: str,
+):
+    '''
+    Get a user's PageRank, component and degrees within the directory.
+    '''
+    return graph.get_node(user_id)
+
+
+@ROUTER.get("/users/{user_id}/mutuals/", response_model=json_models.PaginateUserIds)
+def get_mutuals(
+        user_id: str,
+        page: int = 1,
+        page_size: int = 100,
+):
+    '''
+    Get the directory users this user follows and is followed back by.
+    '''
+    return graph.get_mutuals(user_id, page=page, page_size=page_size)
@@ -0,0 +1,45 @@
+'''
+This module routes all background job operations.
+'''
+
+from typing import List
+from fastapi import APIRouter
+
+import json_models
+import jobs
+import profiling
+
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
+
+
+@ROUTER.get("/", response_model=List[json_models.Job])
+def get_jobs(
+        status: str = None,
+        kind: str = None,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    List background jobs, newest first.
+    '''
+    return jobs.get_jobs(status=status, kind=kind, page=page, page_size=page_size)
+
+
+@ROUTER.get("/batches/{batch_id}", response_model=json_models.JobBatch)
+def get_batch(
+        batch_id: int,
+):
+    '''
+    Get the progress of a group of jobs queued together.
+    '''
+    return jobs.get_batch(batch_id)
+
+
+@ROUTER.get("/{job_id}", response_model=json_models.Job)
+def get_job(
+        job_id: int,
+):
+    '''
+    Get the status and progress of a background job.
+    '''
+    return jobs.get_job(job_id)
@@ -0,0 +1,48 @@
+'''
+This module routes all search operations.
+'''
+
+from typing import List
+from datetime import datetime
+from fastapi import APIRouter, Query
+
+import json_models
+import jobs
+import profiling
+import search
+import singleflight
+
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
+
+
+@ROUTER.get("/", response_model=json_models.PaginateSearch)
+@singleflight.coalesced
+def search_tweets(
+        q: str,
+        user_id: List[str] = Query(None),
+        kind: str = None,
+        since: datetime = None,
+        until: datetime = None,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    Search the tweets and favorites of every directory user, best match first.
+    '''
+    return search.search(
+        q,
+        user_ids=user_id,
+        kind=kind,
+        since=since,
+        until=until,
+        page=page,
+        page_size=page_size,
+    )
+
+
+@ROUTER.post("/reindex/", status_code=202)
+def accept_reindex():
+    '''
+    Bring the search index up to date with the whole directory.
+    '''
+    return jobs.accepted(jobs.enqueue("index_directory", {}))
@@ -3,39 +3,135 @@ This module routes all user operations.
 '''
 
 from typing import List
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
+from fastapi.logger import logger
+from fastapi.responses import StreamingResponse
 from baquet.user import User
 from baquet.directory import Directory
 
+import catalog
 import json_models
 import helpers
-
-ROUTER = APIRouter()
+import exports
+import graph
+import jobs
+import keyset
+import leaderboard
+import profiling
+import ratelimit
+import responsecache
+import search
+import similarity
+import singleflight
+import stats
+import versions
+import watchwords
+from constants import CecilConstants
+
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
 
 
 @ROUTER.get("/", response_model=json_models.PaginateUser)
+@responsecache.cached(json_models.PaginateUser, listing="users")
 def get_users(
         page: int = 1,
         page_size: int = 20,
+        sort: json_models.UserSort = json_models.UserSort.user_id,
+        descending: bool = False,
+        screen_name: str = None,
 ):
     '''
-    Get a list of users and top level info in the user directory.
+    Get a list of users and top level info in the user directory. Until the catalog
+    has been built, a flat directory itself is listed, unsorted and unfiltered; baquet
+    cannot list a sharded one.
+    '''
+    if not catalog.is_reconciled() and \
+            CONFIG.get(CecilConstants.DB_LAYOUT) != CecilConstants.LAYOUT_SHARDED:
+        return Directory().get_directory(page=page, page_size=page_size)
+    return catalog.get_users(
+        sort=sort.value,
+        descending=descending,
+        screen_name=screen_name,
+        page=page,
+        page_size=page_size,
+    )
+
+
+def _ingest_costs(user_id: str):
+    '''
+    Twitter requests an ingest makes, paged by the user's counts as last catalogued.
+    '''
+    entry = catalog.get_entry("users", user_id) or {}
+    return {
+        "users": 1,
+        "followers": ratelimit.pages(entry.get("followers_count"), 5000),
+        "friends": ratelimit.pages(entry.get("friends_count"), 5000),
+        # A user not catalogued yet is assumed to have a full timeline.
+        "timeline": ratelimit.pages(entry.get("statuses_count", 3200), 200, most=3200),
+        "favorites": ratelimit.pages(entry.get("favorites_count"), 200),
+    }
+
+
+@jobs.job("ingest_user", twitter_costs=_ingest_costs)
+def ingest_user(context: jobs.JobContext, user_id: str):
+    '''
+    Background task pulling a user's data from Twitter into the directory.
+    '''
+    context.report(0, "Pulling user from Twitter")
+    try:
+        helpers.open_handle("users", user_id, User).get_user()
+        logger.info(
+            'Successfully ingested user: %s',
+            user_id,
+        )
+    except:
+        logger.error(
+            'Failed to ingest user: %s',
+            user_id,
+        )
+        raise
+    # A failure deriving from the pull is retried on its own, without pulling again.
+    jobs.enqueue("derive_user", {"user_id": user_id})
+
+
+@jobs.job("derive_user")
+def derive_user(context: jobs.JobContext, user_id: str):  # pylint: disable=unused-argument
     '''
-    directory = Directory()
-    return directory.get_directory(page=page, page_size=page_size)
+    Bring everything derived from a user's database up to date after an ingest.
+    '''
+    versions.bump("users", user_id)
+    catalog.catalog_user(user_id)
+    search.queue_index(user_id)
+    similarity.queue_sign(user_id)
+    graph.queue_graph(user_id)
+    leaderboard.queue_rank_user(user_id)
 
 
-@ROUTER.post("/")
+@ROUTER.post("/", status_code=202)
 def add_user(
         user: json_models.AddUser,
 ):
     '''
     Add a user to the directory.
     '''
-    User(user.user_id).get_user()
+    return jobs.accepted(jobs.enqueue("ingest_user", {"user_id": user.user_id}))
+
+
+@ROUTER.post("/bulk/", status_code=202, response_model=json_models.JobBatch)
+def add_users(
+        users: json_models.AddUsers,
+):
+    '''
+    Add many users to the directory, ingested in parallel by the job workers.
+    '''
+    return jobs.enqueue_batch(
+        "ingest_user",
+        [{"user_id": user_id} for user_id in users.user_ids]
+    )
 
 
 @ROUTER.get("/{user_id}/", response_model=json_models.User)
+@responsecache.cached(json_models.User)
 def get_user(
         user_id: str,
 ):
@@ -47,6 +143,7 @@ def get_user(
 
 
 @ROUTER.get("/{user_id}/favorites/", response_model=json_models.PaginateFavorites)
+@responsecache.cached(json_models.PaginateFavorites)
 def get_favorites(
         user_id: str,
         page: int = 1,
@@ -55,22 +152,72 @@ def get_favorites(
         watchwords_id: str = None,
 ):
     '''
-    Get a user's favorites.
+    Get a user's favorites. Filtering by watchwords reports the words each favorite matched.
     '''
+    if watchwords_id:
+        return watchwords.filter_tweets(
+            user_id,
+            CecilConstants.FAVORITES_TABLE,
+            watchwords_id,
+            page=page,
+            page_size=page_size,
+            watchlist_id=watchlist_id,
+        )
+
     user = helpers.user_getter(user_id)
     if watchlist_id:
         watchlist_id = helpers.wl_getter(watchlist_id)
-    if watchwords_id:
-        watchwords_id = helpers.wl_getter(watchwords_id)
     return user.get_favorites(
         page=page,
         page_size=page_size,
         watchlist=watchlist_id,
-        watchwords=watchwords_id
+    )
+
+
+@ROUTER.get("/{user_id}/favorites/cursor/", response_model=json_models.CursorFavorites)
+def get_favorites_cursor(
+        user_id: str,
+        cursor: str = None,
+        page_size: int = Query(20, ge=1, le=keyset.MAX_PAGE_SIZE),
+        watchlist_id: str = None,
+        include_total: bool = False,
+):
+    '''
+    Get a user's favorites, newest first, a cursor at a time.
+    '''
+    return keyset.page(
+        helpers.db_path("users", user_id),
+        CecilConstants.FAVORITES_TABLE,
+        keyset.TWEET_ORDER,
+        cursor=cursor,
+        page_size=page_size,
+        watchlist_path=helpers.db_path("watchlists", watchlist_id) if watchlist_id else None,
+        include_total=include_total,
+    )
+
+
+@ROUTER.get("/{user_id}/favorites/export/")
+def export_favorites(
+        user_id: str,
+        export_format: json_models.ExportFormat = Query(
+            json_models.ExportFormat.ndjson, alias="format"),
+        gzip: bool = False,
+):
+    '''
+    Download all of a user's favorites as NDJSON or CSV, optionally gzipped.
+    '''
+    return exports.export(
+        helpers.db_path("users", user_id),
+        CecilConstants.FAVORITES_TABLE,
+        "created_at DESC, tweet_id DESC",
+        f"{user_id}_favorites",
+        export_format.value,
+        gzip,
     )
 
 
 @ROUTER.get("/{user_id}/favorites/tags/", response_model=List[json_models.Tag])
+@responsecache.cached(List[json_models.Tag])
 def get_tags_favorites(
         user_id: str,
 ):
@@ -82,6 +229,7 @@ def get_tags_favorites(
 
 
 @ROUTER.get("/{user_id}/favorites/tags/{tag_id}/", response_model=json_models.PaginateFavorites)
+@responsecache.cached(json_models.PaginateFavorites)
 def get_favorites_tagged(
         user_id: str,
         tag_id: int,
@@ -96,6 +244,7 @@ def get_favorites_tagged(
 
 
 @ROUTER.get("/{user_id}/favorites/{tweet_id}/notes/")
+@responsecache.cached()
 def get_notes_favorite(
         user_id: str,
         tweet_id: str,
@@ -118,6 +267,7 @@ def add_note_favorite(
     '''
     user = helpers.user_getter(user_id)
     user.add_note_favorite(tweet_id, note.text)
+    versions.bump("users", user_id)
 
 
 @ROUTER.delete("/{user_id}/favorites/{tweet_id}/notes/{note_id}/")
@@ -131,9 +281,11 @@ def remove_note_favorite(
     '''
     user = helpers.user_getter(user_id)
     user.remove_note_favorite(tweet_id, note_id)
+    versions.bump("users", user_id)
 
 
 @ROUTER.get("/{user_id}/favorites/{tweet_id}/tags/", response_model=List[json_models.Tag])
+@responsecache.cached(List[json_models.Tag])
 def get_tags_favorite(
         user_id: str,
         tweet_id: str,
@@ -156,6 +308,7 @@ def add_tag_favorite(
     '''
     user = helpers.user_getter(user_id)
     user.add_tag_favorite(tweet_id, tag.text)
+    versions.bump("users", user_id)
 
 
 @ROUTER.delete("/{user_id}/favorites/{tweet_id}/tags/{tag_id}/")
@@ -169,9 +322,11 @@ def remove_tag_favorite(
     '''
     user = helpers.user_getter(user_id)
     user.remove_tag_favorite(tweet_id, tag_id)
+    versions.bump("users", user_id)
 
 
 @ROUTER.get("/{user_id}/followers/", response_model=json_models.PaginateFriendsOrFollowing)
+@responsecache.cached(json_models.PaginateFriendsOrFollowing)
 def get_followers(
         user_id: str,
         page: int = 1,
@@ -189,7 +344,50 @@ def get_followers(
         page=page, page_size=page_size, watchlist=watchlist_id)
 
 
+@ROUTER.get("/{user_id}/followers/cursor/", response_model=json_models.CursorFriendsOrFollowing)
+def get_followers_cursor(
+        user_id: str,
+        cursor: str = None,
+        page_size: int = Query(100, ge=1, le=keyset.MAX_PAGE_SIZE),
+        watchlist_id: str = None,
+        include_total: bool = False,
+):
+    '''
+    Get a user's followers, by user id, a cursor at a time.
+    '''
+    return keyset.page(
+        helpers.db_path("users", user_id),
+        CecilConstants.FOLLOWERS_TABLE,
+        keyset.USER_ORDER,
+        cursor=cursor,
+        page_size=page_size,
+        watchlist_path=helpers.db_path("watchlists", watchlist_id) if watchlist_id else None,
+        include_total=include_total,
+    )
+
+
+@ROUTER.get("/{user_id}/followers/export/")
+def export_followers(
+        user_id: str,
+        export_format: json_models.ExportFormat = Query(
+            json_models.ExportFormat.ndjson, alias="format"),
+        gzip: bool = False,
+):
+    '''
+    Download all of a user's followers as NDJSON or CSV, optionally gzipped.
+    '''
+    return exports.export(
+        helpers.db_path("users", user_id),
+        CecilConstants.FOLLOWERS_TABLE,
+        "user_id",
+        f"{user_id}_followers",
+        export_format.value,
+        gzip,
+    )
+
+
 @ROUTER.get("/{user_id}/friends/", response_model=json_models.PaginateFriendsOrFollowing)
+@responsecache.cached(json_models.PaginateFriendsOrFollowing)
 def get_friends(
         user_id: str,
         page: int = 1,
@@ -207,7 +405,50 @@ def get_friends(
         page=page, page_size=page_size, watchlist=watchlist_id)
 
 
+@ROUTER.get("/{user_id}/friends/cursor/", response_model=json_models.CursorFriendsOrFollowing)
+def get_friends_cursor(
+        user_id: str,
+        cursor: str = None,
+        page_size: int = Query(100, ge=1, le=keyset.MAX_PAGE_SIZE),
+        watchlist_id: str = None,
+        include_total: bool = False,
+):
+    '''
+    Get a user's friends, by user id, a cursor at a time.
+    '''
+    return keyset.page(
+        helpers.db_path("users", user_id),
+        CecilConstants.FRIENDS_TABLE,
+        keyset.USER_ORDER,
+        cursor=cursor,
+        page_size=page_size,
+        watchlist_path=helpers.db_path("watchlists", watchlist_id) if watchlist_id else None,
+        include_total=include_total,
+    )
+
+
+@ROUTER.get("/{user_id}/friends/export/")
+def export_friends(
+        user_id: str,
+        export_format: json_models.ExportFormat = Query(
+            json_models.ExportFormat.ndjson, alias="format"),
+        gzip: bool = False,
+):
+    '''
+    Download all of a user's friends as NDJSON or CSV, optionally gzipped.
+    '''
+    return exports.export(
+        helpers.db_path("users", user_id),
+        CecilConstants.FRIENDS_TABLE,
+        "user_id",
+        f"{user_id}_friends",
+        export_format.value,
+        gzip,
+    )
+
+
 @ROUTER.get("/{user_id}/notes/", response_model=json_models.PaginateUserNotes)
+@responsecache.cached(json_models.PaginateUserNotes)
 def get_notes_user(
         user_id: str,
         page: int = 1,
@@ -230,6 +471,7 @@ def add_note_user(
     '''
     user = helpers.user_getter(user_id)
     user.add_note_user(note.text)
+    versions.bump("users", user_id)
 
 
 @ROUTER.delete("/{user_id}/notes/{note_id}/")
@@ -242,31 +484,49 @@ def remove_note_user(
     '''
     user = helpers.user_getter(user_id)
     user.remove_note_user(note_id)
+    versions.bump("users", user_id)
+
+
+@ROUTER.get("/{user_id}/similar/", response_model=List[json_models.SimilarUser])
+@singleflight.coalesced
+def get_similar(
+        user_id: str,
+        relation: json_models.Relation = json_models.Relation.followers,
+        limit: int = Query(10, ge=1, le=100),
+):
+    '''
+    Get the directory users whose followers or friends overlap most with this user's.
+    '''
+    return similarity.get_similar(user_id, relation.value, limit)
 
 
 @ROUTER.get("/{user_id}/stats/{watchlist_id}/", response_model=json_models.UserStats)
+@singleflight.coalesced
 def get_stats(
         user_id: str,
         watchlist_id: str,
 ):
     '''
-    Get a user's friends.
+    Get a user's stats against a watchlist.
     '''
-    user = helpers.user_getter(user_id)
-    watchlist = helpers.wl_getter(watchlist_id)
-    return {
-        'followers_watchlist_percent': user.get_followers_watchlist_percent(watchlist=watchlist),
-        'followers_watchlist_completion': user.get_followers_watchlist_completion(
-            watchlist=watchlist
-        ),
-        'friends_watchlist_percent': user.get_friends_watchlist_percent(watchlist=watchlist),
-        'friends_watchlist_completion': user.get_friends_watchlist_completion(watchlist=watchlist),
-        'favorite_watchlist_percent': user.get_favorite_watchlist_percent(watchlist=watchlist),
-        'retweet_watchlist_percent': user.get_retweet_watchlist_percent(watchlist=watchlist)
-    }
+    return stats.get_user_stats(user_id, watchlist_id)
+
+
+@ROUTER.post("/stats/")
+def get_stats_matrix(
+        matrix: json_models.StatsMatrixRequest,
+):
+    '''
+    Stream stats for many users against many watchlists, one NDJSON row per user.
+    '''
+    return StreamingResponse(
+        stats.stats_matrix(matrix.user_ids, matrix.watchlist_ids),
+        media_type="application/x-ndjson"
+    )
 
 
 @ROUTER.get("/{user_id}/timeline/", response_model=json_models.PaginateTimeline)
+@responsecache.cached(json_models.PaginateTimeline)
 def get_timeline(
         user_id: str,
         page: int = 1,
@@ -275,19 +535,70 @@ def get_timeline(
         watchwords_id: str = None,
 ):
     '''
-    Get a user's timeline.
+    Get a user's timeline. Filtering by watchwords reports the words each tweet matched.
     '''
+    if watchwords_id:
+        return watchwords.filter_tweets(
+            user_id,
+            CecilConstants.TIMELINE_TABLE,
+            watchwords_id,
+            page=page,
+            page_size=page_size,
+            watchlist_id=watchlist_id,
+            member_column="retweet_user_id",
+        )
+
     user = helpers.user_getter(user_id)
     if watchlist_id:
         watchlist_id = helpers.wl_getter(watchlist_id)
-    if watchwords_id:
-        watchwords_id = helpers.wl_getter(watchwords_id)
-    return user.get_timeline(
-        page, page_size, watchlist=watchlist_id, watchwords=watchwords_id
+    return user.get_timeline(page, page_size, watchlist=watchlist_id)
+
+
+@ROUTER.get("/{user_id}/timeline/cursor/", response_model=json_models.CursorTimeline)
+def get_timeline_cursor(
+        user_id: str,
+        cursor: str = None,
+        page_size: int = Query(20, ge=1, le=keyset.MAX_PAGE_SIZE),
+        watchlist_id: str = None,
+        include_total: bool = False,
+):
+    '''
+    Get a user's timeline, newest first, a cursor at a time.
+    '''
+    return keyset.page(
+        helpers.db_path("users", user_id),
+        CecilConstants.TIMELINE_TABLE,
+        keyset.TWEET_ORDER,
+        cursor=cursor,
+        page_size=page_size,
+        watchlist_path=helpers.db_path("watchlists", watchlist_id) if watchlist_id else None,
+        member_column="retweet_user_id",
+        include_total=include_total,
+    )
+
+
+@ROUTER.get("/{user_id}/timeline/export/")
+def export_timeline(
+        user_id: str,
+        export_format: json_models.ExportFormat = Query(
+            json_models.ExportFormat.ndjson, alias="format"),
+        gzip: bool = False,
+):
+    '''
+    Download a user's whole timeline as NDJSON or CSV, optionally gzipped.
+    '''
+    return exports.export(
+        helpers.db_path("users", user_id),
+        CecilConstants.TIMELINE_TABLE,
+        "created_at DESC, tweet_id DESC",
+        f"{user_id}_timeline",
+        export_format.value,
+        gzip,
     )
 
 
 @ROUTER.get("/{user_id}/timeline/tags/")
+@responsecache.cached()
 def get_tags_timelines(
         user_id: str,
 ):
@@ -299,6 +610,7 @@ def get_tags_timelines(
 
 
 @ROUTER.get("/{user_id}/timeline/tags/{tag_id}/")
+@responsecache.cached()
 def get_timeline_tagged(
         user_id: str,
         tag_id: int,
@@ -313,6 +625,7 @@ def get_timeline_tagged(
 
 
 @ROUTER.get("/{user_id}/timeline/{tweet_id}/notes/")
+@responsecache.cached()
 def get_notes_timeline(
         user_id: str,
         tweet_id: str,
@@ -335,6 +648,7 @@ def add_note_timeline(
     '''
     user = helpers.user_getter(user_id)
     user.add_note_timeline(tweet_id, note.text)
+    versions.bump("users", user_id)
 
 
 @ROUTER.delete("/{user_id}/timeline/{tweet_id}/notes/{note_id}/")
@@ -348,9 +662,11 @@ def remove_note_timeline(
     '''
     user = helpers.user_getter(user_id)
     user.remove_note_timeline(tweet_id, note_id)
+    versions.bump("users", user_id)
 
 
 @ROUTER.get("/{user_id}/timeline/{tweet_id}/tags/", response_model=List[json_models.Tag])
+@responsecache.cached(List[json_models.Tag])
 def get_tags_timeline(
         user_id: str,
         tweet_id: str,
@@ -373,6 +689,7 @@ def add_tag_timeline(
     '''
     user = helpers.user_getter(user_id)
     user.add_tag_timeline(tweet_id, tag.text)
+    versions.bump("users", user_id)
 
 
 @ROUTER.delete("/{user_id}/timeline/{tweet_id}/tags/{tag_id}/")
@@ -386,3 +703,7 @@ def remove_tag_timeline(
     '''
     user = helpers.user_getter(user_id)
     user.remove_tag_timeline(tweet_id, tag_id)
+    versions.bump("users", user_id)
+
+
+CONFIG = helpers.make_config()
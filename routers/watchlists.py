@@ -2,30 +2,43 @@
 This module routes all watchlist operations.
 '''
 
-from os import listdir
 from typing import List
-from fastapi import APIRouter, BackgroundTasks
+from fastapi import APIRouter, Query
 from fastapi.logger import logger
 from baquet.watchlist import Watchlist
 
 from constants import CecilConstants
+import catalog
 import helpers
 import json_models
+import jobs
+import keyset
+import leaderboard
+import profiling
+import refreshes
+import responsecache
+import setops
+import singleflight
+import versions
 
-ROUTER = APIRouter()
+ROUTER = APIRouter(route_class=profiling.ProfiledRoute)
 
 
 @ROUTER.get("/", response_model=List[str])
-def get_watchlists():
+@responsecache.cached(List[str], listing="watchlists")
+def get_watchlists(
+        sort: json_models.WatchlistSort = json_models.WatchlistSort.watchlist_id,
+        descending: bool = False,
+        min_users: int = None,
+):
     '''
-    Get a list of watchlists in the watchlist directory.
+    Get a list of watchlists in the watchlist directory. Until the catalog has been
+    built, the directory itself is listed, unsorted and unfiltered.
     '''
-    if helpers.wl_path().exists():
-        result = [fn.split(".")[0] for fn in listdir(helpers.wl_path())]
-    else:
-        result = []
-
-    return result
+    if not catalog.is_reconciled():
+        return sorted(helpers.db_ids("watchlists"))
+    return catalog.get_watchlists(
+        sort=sort.value, descending=descending, min_users=min_users)
 
 
 @ROUTER.post("/")
@@ -35,10 +48,26 @@ def add_watchlist(
     '''
     Create a watchlist.
     '''
-    Watchlist(watchlist.watchlist_id)
+    helpers.open_handle("watchlists", watchlist.watchlist_id, Watchlist)
+    catalog.catalog_watchlist(watchlist.watchlist_id)
+    versions.bump("watchlists", watchlist.watchlist_id)
+
+
+@ROUTER.get("/ops/evaluate/", response_model=json_models.PaginateUserIds)
+@singleflight.coalesced
+def get_watchlist_ops(
+        expression: str,
+        page: int = 1,
+        page_size: int = 100,
+):
+    '''
+    Get the user ids a set expression over watchlists evaluates to, e.g. "(a & b) - c".
+    '''
+    return setops.evaluate(expression, page=page, page_size=page_size)
 
 
 @ROUTER.get("/{watchlist_id}", response_model=json_models.WatchlistInfo)
+@responsecache.cached(json_models.WatchlistInfo)
 def get_watchlist(
         watchlist_id: str,
 ):
@@ -54,25 +83,91 @@ def get_watchlist(
     }
 
 
-@ROUTER.get("/{watchlist_id}/users/", response_model=json_models.PaginateUser)
+@ROUTER.get("/{watchlist_id}/leaderboard/", response_model=json_models.PaginateLeaderboard)
+@singleflight.coalesced
+def get_leaderboard(
+        watchlist_id: str,
+        sort: json_models.LeaderboardSort = json_models.LeaderboardSort.followers_watchlist_percent,
+        descending: bool = True,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    Get every directory user ranked by their stats against the watchlist.
+    '''
+    return leaderboard.get_leaderboard(
+        watchlist_id,
+        sort=sort.value,
+        descending=descending,
+        page=page,
+        page_size=page_size,
+    )
+
+
+@ROUTER.get("/{watchlist_id}/users/", response_model=json_models.PaginateWatchlistUsers)
+@singleflight.coalesced
 def get_watchlist_users(
         watchlist_id: str,
         page: int = 1,
         page_size: int = 20,
 ):
     '''
-    Get users on the watchlist.
+    Get users on the watchlist, as of the last refresh.
     '''
     watchlist = helpers.wl_getter(watchlist_id)
-    watchlist.refresh_watchlist_user_data()
+    refresh_state = refreshes.get_refresh_state(watchlist_id)
+    if refresh_state['stale'] and not refresh_state['refreshing']:
+        refreshes.queue_refresh(watchlist_id)
+
+    users = json_models.PaginateWatchlistUsers.from_orm(
+        watchlist.get_watchlist_users(page=page, page_size=page_size)
+    )
+    return users.copy(update=refresh_state)
+
+
+@ROUTER.get("/{watchlist_id}/users/cursor/", response_model=json_models.CursorUser)
+def get_watchlist_users_cursor(
+        watchlist_id: str,
+        cursor: str = None,
+        page_size: int = Query(20, ge=1, le=keyset.MAX_PAGE_SIZE),
+        include_total: bool = False,
+):
+    '''
+    Get users on the watchlist, by user id, a cursor at a time, as of the last refresh.
+    '''
+    return keyset.page(
+        helpers.db_path("watchlists", watchlist_id),
+        CecilConstants.WATCHLIST_USERS_TABLE,
+        keyset.USER_ORDER,
+        cursor=cursor,
+        page_size=page_size,
+        include_total=include_total,
+    )
 
-    return watchlist.get_watchlist_users(page=page, page_size=page_size)
+
+@ROUTER.post("/{watchlist_id}/users/refresh/", status_code=202)
+def accept_refresh_watchlist_users(
+        watchlist_id: str,
+):
+    '''
+    Refresh the user data of the watchlist.
+    '''
+    helpers.wl_getter(watchlist_id)
+    return jobs.accepted(
+        refreshes.queue_refresh(watchlist_id, CecilConstants.PRIORITY_INTERACTIVE))
 
 
-def import_blockbot_list(watchlist: Watchlist, import_details: json_models.ImportBlockbotList):
+@jobs.job("import_blockbot_list", twitter_costs={"users": 100})
+def import_blockbot_list(
+        context: jobs.JobContext,  # pylint: disable=unused-argument
+        watchlist_id: str,
+        import_details: dict,
+):
     '''
     Background task specific to importing a blockbot list.
     '''
+    watchlist = helpers.wl_getter(watchlist_id)
+    import_details = json_models.ImportBlockbotList(**import_details)
     try:
         watchlist.import_blockbot_list(
             import_details.blockbot_id,
@@ -88,30 +183,36 @@ def import_blockbot_list(watchlist: Watchlist, import_details: json_models.Impor
             import_details,
         )
         raise
+    refreshes.queue_derive(watchlist_id)
 
 
 @ROUTER.post("/{watchlist_id}/import/blockbot/", status_code=202)
-async def accept_import_blockbot_list(
+def accept_import_blockbot_list(
         watchlist_id: str,
         import_details: json_models.ImportBlockbotList,
-        background_tasks: BackgroundTasks,
 ):
     '''
     Import a blockbot list.
     '''
-    watchlist = helpers.wl_getter(watchlist_id)
-    background_tasks.add_task(
-        import_blockbot_list,
-        watchlist,
-        import_details
-    )
-    return CecilConstants.MESSAGE_PROCESSING_IN_BACKGROUND
+    helpers.wl_getter(watchlist_id)
+    return jobs.accepted(jobs.enqueue(
+        "import_blockbot_list",
+        {"watchlist_id": watchlist_id, "import_details": import_details.dict()},
+        priority=CecilConstants.PRIORITY_BULK
+    ))
 
 
-def import_twitter_list(watchlist: Watchlist, import_details: json_models.ImportBlockbotList):
+@jobs.job("import_twitter_list", twitter_costs={"lists": 10, "users": 100})
+def import_twitter_list(
+        context: jobs.JobContext,  # pylint: disable=unused-argument
+        watchlist_id: str,
+        import_details: dict,
+):
     '''
     Background task specific to importing a Twitter list.
     '''
+    watchlist = helpers.wl_getter(watchlist_id)
+    import_details = json_models.ImportTwitterList(**import_details)
     if import_details.twitter_id:
         import_details.slug = None
         import_details.owner_screen_name = None
@@ -132,27 +233,27 @@ def import_twitter_list(watchlist: Watchlist, import_details: json_models.Import
             import_details,
         )
         raise
+    refreshes.queue_derive(watchlist_id)
 
 
 @ROUTER.post("/{watchlist_id}/import/twitter/", status_code=202)
-async def accept_import_twitter_list(
+def accept_import_twitter_list(
         watchlist_id: str,
         import_details: json_models.ImportTwitterList,
-        background_tasks: BackgroundTasks,
 ):
     '''
     Import a twitter list.
     '''
-    watchlist = helpers.wl_getter(watchlist_id)
-    background_tasks.add_task(
-        import_twitter_list,
-        watchlist,
-        import_details
-    )
-    return CecilConstants.MESSAGE_PROCESSING_IN_BACKGROUND
+    helpers.wl_getter(watchlist_id)
+    return jobs.accepted(jobs.enqueue(
+        "import_twitter_list",
+        {"watchlist_id": watchlist_id, "import_details": import_details.dict()},
+        priority=CecilConstants.PRIORITY_BULK
+    ))
 
 
 @ROUTER.get("/{watchlist_id}/sublists/", response_model=List[json_models.Sublist])
+@responsecache.cached(List[json_models.Sublist])
 def get_sublists(
         watchlist_id: str,
 ):
@@ -167,6 +268,7 @@ def get_sublists(
     "/{watchlist_id}/sublists/{sublist_id}/users/",
     response_model=json_models.PaginateUser
 )
+@responsecache.cached(json_models.PaginateUser)
 def get_sublist_users(
         watchlist_id: str,
         sublist_id: str,
@@ -180,10 +282,16 @@ def get_sublist_users(
     return watchlist.get_sublist_users(sublist_id, page=page, page_size=page_size)
 
 
-def refresh_sublist(watchlist: Watchlist, sublist_id: str):
+@jobs.job("refresh_sublist", twitter_costs={"lists": 10, "users": 100})
+def refresh_sublist(
+        context: jobs.JobContext,  # pylint: disable=unused-argument
+        watchlist_id: str,
+        sublist_id: str,
+):
     '''
     Refresh the sublist.
     '''
+    watchlist = helpers.wl_getter(watchlist_id)
     try:
         watchlist.refresh_sublist(sublist_id)
         logger.info(
@@ -196,20 +304,22 @@ def refresh_sublist(watchlist: Watchlist, sublist_id: str):
             sublist_id,
         )
         raise
+    refreshes.queue_derive(watchlist_id)
 
 
 @ROUTER.post("/{watchlist_id}/sublists/{sublist_id}/refresh/", status_code=202)
 def accept_refresh_sublist(
         watchlist_id: str,
         sublist_id: str,
-        background_tasks: BackgroundTasks,
 ):
     '''
     Refresh a sublist.
     '''
-    watchlist = helpers.wl_getter(watchlist_id)
-    background_tasks.add_task(refresh_sublist, watchlist, sublist_id)
-    return CecilConstants.MESSAGE_PROCESSING_IN_BACKGROUND
+    helpers.wl_getter(watchlist_id)
+    return jobs.accepted(jobs.enqueue(
+        "refresh_sublist",
+        {"watchlist_id": watchlist_id, "sublist_id": sublist_id}
+    ))
 
 
 @ROUTER.delete("/{watchlist_id}/sublists/{sublist_id}")
@@ -222,6 +332,7 @@ def remove_sublist(
     '''
     watchlist = helpers.wl_getter(watchlist_id)
     watchlist.remove_sublist(sublist_id)
+    versions.bump("watchlists", watchlist_id)
 
 
 @ROUTER.get(
@@ -255,6 +366,7 @@ def set_exclusion_status(
         sublist_id,
         exclusion_details.excluded
     )
+    versions.bump("watchlists", watchlist_id)
 
 
 @ROUTER.post("/{watchlist_id}/users/")
@@ -267,6 +379,8 @@ def add_watchlist_users(
     '''
     watchlist = helpers.wl_getter(watchlist_id)
     watchlist.add_watchlist(user.user_id)
+    catalog.catalog_watchlist(watchlist_id)
+    versions.bump("watchlists", watchlist_id)
 
 
 @ROUTER.delete("/{watchlist_id}/users/{user_id}")
@@ -279,9 +393,12 @@ def remove_watchlist_user(
     '''
     watchlist = helpers.wl_getter(watchlist_id)
     watchlist.remove_watchlist(user_id)
+    catalog.catalog_watchlist(watchlist_id)
+    versions.bump("watchlists", watchlist_id)
 
 
 @ROUTER.get("/{watchlist_id}/words/", response_model=List[str])
+@responsecache.cached(List[str])
 def get_watchwords(
         watchlist_id: str,
 ):
@@ -302,6 +419,8 @@ def add_watchword(
     '''
     watchlist = helpers.wl_getter(watchlist_id)
     watchlist.add_watchword(watchword.text)
+    catalog.catalog_watchlist(watchlist_id)
+    versions.bump("watchlists", watchlist_id)
 
 
 @ROUTER.delete("/{watchlist_id}/words/")
@@ -314,3 +433,5 @@ def remove_watchword(
     '''
     watchlist = helpers.wl_getter(watchlist_id)
     watchlist.remove_watchword(watchword.text)
+    catalog.catalog_watchlist(watchlist_id)
+    versions.bump("watchlists", watchlist_id)
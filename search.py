@@ -0,0 +1,187 @@
+'''
+Full-text search over the tweets of every user in the directory, using SQLite FTS5.
+
+The index is a derived copy of the per-user databases. A user is re-indexed whenever
+their database changes, by a background job queued after each ingest.
+'''
+
+import sqlite3
+from datetime import datetime
+from contextlib import closing
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+import helpers
+import jobs
+from constants import CecilConstants
+
+# Tables indexed, and the kind each one's tweets are reported as.
+INDEXED_TABLES = {
+    CecilConstants.TIMELINE_TABLE: "timeline",
+    CecilConstants.FAVORITES_TABLE: "favorite",
+}
+
+
+def _create_schema(conn):
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS tweets USING fts5("
+        "text, screen_name, name, "
+        "owner_id UNINDEXED, tweet_id UNINDEXED, kind UNINDEXED, created_at UNINDEXED)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS indexed_users "
+        "(owner_id TEXT PRIMARY KEY, stamp TEXT NOT NULL, indexed_at TEXT NOT NULL)"
+    )
+    # FTS5 can only find an UNINDEXED owner_id by scanning, so each owner's rowids are
+    # kept here and their rows deleted by rowid.
+    if not _has_table(conn, "indexed_rows"):
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not _has_table(conn, "indexed_rows"):
+                conn.execute(
+                    "CREATE TABLE indexed_rows "
+                    "(rowid INTEGER PRIMARY KEY, owner_id TEXT NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX ix_indexed_rows_owner_id ON indexed_rows (owner_id)")
+                conn.execute("INSERT INTO indexed_rows SELECT rowid, owner_id FROM tweets")
+
+
+def _connect():
+    return helpers.cecil_db(CecilConstants.SEARCH_DB_PATH, _create_schema)
+
+
+def _has_table(conn, name: str):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def _delete_owner(conn, owner_id: str):
+    '''
+    Drop an owner's tweets from the index by rowid.
+    '''
+    rowids = conn.execute(
+        "SELECT rowid FROM indexed_rows WHERE owner_id = ?", (owner_id,)).fetchall()
+    conn.executemany("DELETE FROM tweets WHERE rowid = ?", rowids)
+    conn.execute("DELETE FROM indexed_rows WHERE owner_id = ?", (owner_id,))
+
+
+@jobs.job("index_user")
+def index_user(context: jobs.JobContext, user_id: str):  # pylint: disable=unused-argument
+    '''
+    Bring a user's tweets in the search index up to date with their database.
+    '''
+    path = helpers.db_path("users", user_id)
+    stamp = str(helpers.db_stamp(path))
+    with closing(_connect()) as conn:
+        indexed = conn.execute(
+            "SELECT stamp FROM indexed_users WHERE owner_id = ?", (user_id,)
+        ).fetchone()
+        if indexed and indexed[0] == stamp:
+            return
+
+        conn.execute(
+            "ATTACH DATABASE ? AS user_db", (f"file:{path.resolve()}?mode=ro",))
+        existing = {
+            row[0] for row in conn.execute(
+                "SELECT name FROM user_db.sqlite_master WHERE type = 'table'")
+        }
+        with conn:
+            # Rowids are handed out below, so no other indexer may insert meanwhile.
+            conn.execute("BEGIN IMMEDIATE")
+            _delete_owner(conn, user_id)
+            for table, kind in INDEXED_TABLES.items():
+                if table not in existing:
+                    continue
+                last = conn.execute(
+                    "SELECT rowid FROM tweets ORDER BY rowid DESC LIMIT 1").fetchone()
+                first = (last[0] if last else 0) + 1
+                inserted = conn.execute(
+                    "INSERT INTO tweets "
+                    "(rowid, text, screen_name, name, owner_id, tweet_id, kind, created_at) "
+                    f"SELECT ? + ROW_NUMBER() OVER () - 1, text, screen_name, name, ?, "
+                    f"tweet_id, ?, created_at FROM user_db.{table}",
+                    (first, user_id, kind)
+                ).rowcount
+                conn.executemany(
+                    "INSERT INTO indexed_rows (rowid, owner_id) VALUES (?, ?)",
+                    [(rowid, user_id) for rowid in range(first, first + inserted)]
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO indexed_users (owner_id, stamp, indexed_at) "
+                "VALUES (?, ?, ?)",
+                (user_id, stamp, datetime.utcnow().isoformat())
+            )
+    logger.info('Indexed user for search: %s', user_id)
+
+
+@jobs.job("index_directory")
+def index_directory(context: jobs.JobContext):
+    '''
+    Queue re-indexing of changed users, and drop users no longer in the directory.
+    '''
+    user_ids = helpers.db_ids("users")
+    with closing(_connect()) as conn:
+        indexed = {row[0] for row in conn.execute("SELECT owner_id FROM indexed_users")}
+        with conn:
+            for removed in indexed - user_ids:
+                _delete_owner(conn, removed)
+                conn.execute("DELETE FROM indexed_users WHERE owner_id = ?", (removed,))
+
+    for done, user_id in enumerate(sorted(user_ids), start=1):
+        queue_index(user_id)
+        context.report(done * 100 // len(user_ids))
+
+
+def queue_index(user_id: str):
+    '''
+    Queue a search index update for a user.
+    '''
+    return jobs.enqueue(
+        "index_user", {"user_id": user_id}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def search(
+        query: str,
+        user_ids: list = None,
+        kind: str = None,
+        since: datetime = None,
+        until: datetime = None,
+        page: int = 1,
+        page_size: int = 20,
+):
+    '''
+    Tweets matching an FTS5 query, best match first.
+    '''
+    clauses, params = ["tweets MATCH ?"], [query]
+    if user_ids:
+        clauses.append(f"owner_id IN ({', '.join('?' * len(user_ids))})")
+        params.extend(user_ids)
+    if kind:
+        clauses.append("kind = ?")
+        params.append(kind)
+    if since:
+        clauses.append("created_at >= ?")
+        params.append(since.isoformat(sep=" "))
+    if until:
+        clauses.append("created_at < ?")
+        params.append(until.isoformat(sep=" "))
+    where = " AND ".join(clauses)
+
+    try:
+        with closing(_connect()) as conn:
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM tweets WHERE {where}", params).fetchone()[0]
+            cursor = conn.execute(
+                "SELECT owner_id, tweet_id, kind, created_at, screen_name, name, text, "
+                f"bm25(tweets) AS rank FROM tweets WHERE {where} "
+                "ORDER BY rank LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            )
+            columns = [column[0] for column in cursor.description]
+            items = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    except sqlite3.OperationalError as error:
+        raise HTTPException(status_code=400, detail=f'Query: {query}, {error}.')
+
+    return helpers.paginated(items, total, page, page_size)
@@ -0,0 +1,183 @@
+'''
+Set algebra over watchlist memberships, e.g. "(a & b) - c".
+
+Each watchlist's members are compiled once into a sorted tuple of user ids, kept as the
+strings they are stored as, until the watchlist database changes. Operators are evaluated
+as linear merges of those tuples, so results come out sorted for paging.
+
+Operators are | (union), & (intersection) and - (difference), binding in that order
+from loosest to tightest, with parentheses for grouping. Watchlist ids containing
+spaces, operators or parentheses can be written in double quotes.
+'''
+
+import re
+from contextlib import closing
+from fastapi import HTTPException
+
+import helpers
+from cache import LRUCache
+from constants import CecilConstants
+
+_TOKEN = re.compile(r'\s*(?:(?P<op>[|&()-])|"(?P<quoted>[^"]+)"|(?P<name>[^\s|&()"-]+))')
+
+
+def _tokenize(expression: str):
+    tokens, position = [], 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise HTTPException(
+                status_code=400,
+                detail=f'Expression: {expression}, is invalid at position {position}.'
+            )
+        if match.group("op"):
+            tokens.append(("op", match.group("op")))
+        else:
+            tokens.append(("name", match.group("quoted") or match.group("name")))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    '''
+    Recursive descent parser from an expression to a tree of (op, left, right) tuples.
+    '''
+
+    _PRECEDENCE = ["|", "&", "-"]
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def _error(self):
+        return HTTPException(
+            status_code=400, detail=f'Expression: {self.expression}, is invalid.')
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def parse(self):
+        '''
+        The whole expression as a tree.
+        '''
+        tree = self._binary(0)
+        if self._peek() is not None:
+            raise self._error()
+        return tree
+
+    def _binary(self, level: int):
+        if level == len(self._PRECEDENCE):
+            return self._operand()
+        tree = self._binary(level + 1)
+        while self._peek() == ("op", self._PRECEDENCE[level]):
+            self.position += 1
+            tree = (self._PRECEDENCE[level], tree, self._binary(level + 1))
+        return tree
+
+    def _operand(self):
+        token = self._peek()
+        if token is None:
+            raise self._error()
+        self.position += 1
+        if token == ("op", "("):
+            tree = self._binary(0)
+            if self._peek() != ("op", ")"):
+                raise self._error()
+            self.position += 1
+            return tree
+        if token[0] != "name":
+            raise self._error()
+        return token[1]
+
+
+def parse(expression: str):
+    '''
+    Parse an expression. Throw error if it is malformed.
+    '''
+    return _Parser(expression).parse()
+
+
+def _watchlists(tree):
+    if isinstance(tree, str):
+        return {tree}
+    return _watchlists(tree[1]) | _watchlists(tree[2])
+
+
+def load_members(watchlist_id: str):
+    '''
+    The sorted user ids on a watchlist, reused until its database changes.
+    '''
+    path = helpers.db_path("watchlists", watchlist_id)
+    stamp = helpers.db_stamp(path)
+    cached = MEMBERS.get(watchlist_id)
+    if cached and cached['stamp'] == stamp:
+        return cached
+
+    with closing(helpers.read_only(path)) as conn:
+        members = tuple(sorted({
+            str(row[0]) for row in conn.execute(
+                f"SELECT user_id FROM {CecilConstants.WATCHLIST_TABLE} "
+                "WHERE user_id IS NOT NULL"
+            )
+        }))
+    return MEMBERS.put(watchlist_id, {'stamp': stamp, 'members': members})
+
+
+def _merge(left: tuple, right: tuple, op: str):
+    '''
+    Combine two sorted, duplicate free tuples in one pass.
+    '''
+    result = []
+    i, j = 0, 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            if op != "&":
+                result.append(left[i])
+            i += 1
+        elif left[i] > right[j]:
+            if op == "|":
+                result.append(right[j])
+            j += 1
+        else:
+            if op != "-":
+                result.append(left[i])
+            i += 1
+            j += 1
+    if op != "&":
+        result.extend(left[i:])
+    if op == "|":
+        result.extend(right[j:])
+    return tuple(result)
+
+
+def _evaluate(tree, members: dict):
+    if isinstance(tree, str):
+        return members[tree]
+    op, left, right = tree
+    return _merge(_evaluate(left, members), _evaluate(right, members), op)
+
+
+def evaluate(expression: str, page: int = 1, page_size: int = 100):
+    '''
+    A page of the user ids the expression evaluates to, in ascending string order.
+    '''
+    tree = parse(expression)
+    members = {
+        watchlist_id: load_members(watchlist_id)
+        for watchlist_id in sorted(_watchlists(tree))
+    }
+    key = (repr(tree), tuple((watchlist_id, loaded['stamp'])
+                             for watchlist_id, loaded in members.items()))
+    result = RESULTS.get_or_create(key, lambda: _evaluate(tree, {
+        watchlist_id: loaded['members'] for watchlist_id, loaded in members.items()
+    }))
+
+    window = result[(page - 1) * page_size:page * page_size]
+    return helpers.paginated(list(window), len(result), page, page_size)
+
+
+CONFIG = helpers.make_config()
+MEMBERS = LRUCache(CONFIG.get(CecilConstants.RELATIONSHIP_CACHE_SIZE))
+RESULTS = LRUCache(CONFIG.get(CecilConstants.RELATIONSHIP_CACHE_SIZE))
@@ -0,0 +1,228 @@
+'''
+Finds directory users with similar followers or friends, using MinHash and LSH.
+
+Each user's follower and friend sets are reduced to a MinHash signature when they are
+ingested, in the stats process pool. Signatures are cut into bands, and every band is
+indexed in similarity.db, so candidates for a query are the users sharing at least one
+band with it. Candidates are ranked by Jaccard similarity estimated from their stored
+signatures, bounded by their stored set sizes, and the best are confirmed exactly in the
+stats process pool.
+'''
+
+import random
+import hashlib
+from array import array
+from datetime import datetime
+from contextlib import closing
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+import helpers
+import jobs
+import stats
+from constants import CecilConstants
+
+RELATIONS = ["followers", "friends"]
+PERMUTATIONS = 128
+BANDS = 32
+ROWS = PERMUTATIONS // BANDS
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 64) - 1
+_RANDOM = random.Random(0x5eed)
+_HASHES = [
+    (_RANDOM.randrange(1, _PRIME), _RANDOM.randrange(0, _PRIME)) for _ in range(PERMUTATIONS)
+]
+
+
+def _create_schema(conn):
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS signatures ("
+        "user_id TEXT NOT NULL, relation TEXT NOT NULL, signature BLOB, size INTEGER, "
+        "stamp TEXT, signed_at TEXT, PRIMARY KEY (user_id, relation));"
+        "CREATE TABLE IF NOT EXISTS bands ("
+        "relation TEXT NOT NULL, band INTEGER NOT NULL, bucket BLOB NOT NULL, "
+        "user_id TEXT NOT NULL);"
+        "CREATE INDEX IF NOT EXISTS ix_bands_bucket ON bands (relation, band, bucket);"
+        "CREATE INDEX IF NOT EXISTS ix_bands_user_id ON bands (user_id, relation);"
+    )
+
+
+def _connect():
+    return helpers.cecil_db(CecilConstants.SIMILARITY_DB_PATH, _create_schema)
+
+
+def _element(user_id: str):
+    if user_id.isdigit():
+        return int(user_id) % _PRIME
+    return int.from_bytes(hashlib.sha1(user_id.encode()).digest()[:8], "big") % _PRIME
+
+
+def signature(members):
+    '''
+    MinHash signature of a set of user ids.
+    '''
+    elements = [_element(member) for member in members]
+    if not elements:
+        return array("Q", [_MAX_HASH] * PERMUTATIONS)
+    return array("Q", [
+        min((a * element + b) % _PRIME for element in elements) for a, b in _HASHES
+    ])
+
+
+def _buckets(sig: array):
+    return [sig[band * ROWS:(band + 1) * ROWS].tobytes() for band in range(BANDS)]
+
+
+def _estimate(left: array, right: array):
+    return sum(1 for a, b in zip(left, right) if a == b) / PERMUTATIONS
+
+
+def _bounded(estimated: float, size: int, other_size: int):
+    '''
+    An estimated Jaccard similarity, capped by the most two sets of these sizes can share.
+    '''
+    if not size or not other_size:
+        return 0.0
+    return min(estimated, min(size, other_size) / max(size, other_size))
+
+
+def _jaccard(user_id: str, other_id: str, relation: str):
+    '''
+    Exact Jaccard similarity of two users' sets, in a pool worker that caches them.
+    '''
+    left = stats.load_user_sets(user_id)[relation]
+    right = stats.load_user_sets(other_id)[relation]
+    union = len(left | right)
+    return len(left & right) / union if union else 0.0
+
+
+def _sign(user_id: str, relations: list):
+    '''
+    Signatures and sizes of a user's sets, in a pool worker so signing holds no server GIL.
+    '''
+    user_sets = stats.load_user_sets(user_id)
+    return str(user_sets['stamp']), {
+        relation: (signature(user_sets[relation]).tobytes(), len(user_sets[relation]))
+        for relation in relations
+    }
+
+
+@jobs.job("sign_user")
+def sign_user(context: jobs.JobContext, user_id: str):  # pylint: disable=unused-argument
+    '''
+    Bring a user's signatures and LSH bands up to date with their database.
+    '''
+    stamp = str(helpers.db_stamp(helpers.db_path("users", user_id)))
+    with closing(_connect()) as conn:
+        signed = dict(conn.execute(
+            "SELECT relation, stamp FROM signatures WHERE user_id = ?", (user_id,)))
+    stale = [relation for relation in RELATIONS if signed.get(relation) != stamp]
+    if not stale:
+        return
+
+    pool = helpers.process_pool("stats", CONFIG.get(CecilConstants.STATS_MATRIX_PROCESSES))
+    stamp, signatures = pool.submit(_sign, user_id, stale).result()
+    with closing(_connect()) as conn, conn:
+        for relation, (sig_bytes, size) in signatures.items():
+            sig = array("Q")
+            sig.frombytes(sig_bytes)
+            conn.execute(
+                "DELETE FROM bands WHERE user_id = ? AND relation = ?", (user_id, relation))
+            if size:
+                conn.executemany(
+                    "INSERT INTO bands (relation, band, bucket, user_id) VALUES (?, ?, ?, ?)",
+                    [(relation, band, bucket, user_id)
+                     for band, bucket in enumerate(_buckets(sig))]
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO signatures "
+                "(user_id, relation, signature, size, stamp, signed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, relation, sig_bytes, size, stamp, datetime.utcnow().isoformat())
+            )
+    logger.info('Signed user for similarity: %s', user_id)
+
+
+@jobs.job("sign_directory")
+def sign_directory(context: jobs.JobContext):
+    '''
+    Queue signing of changed users, and drop users no longer in the directory.
+    '''
+    user_ids = helpers.db_ids("users")
+    with closing(_connect()) as conn, conn:
+        signed = {row[0] for row in conn.execute("SELECT DISTINCT user_id FROM signatures")}
+        for removed in signed - user_ids:
+            conn.execute("DELETE FROM bands WHERE user_id = ?", (removed,))
+            conn.execute("DELETE FROM signatures WHERE user_id = ?", (removed,))
+
+    for done, user_id in enumerate(sorted(user_ids), start=1):
+        queue_sign(user_id)
+        context.report(done * 100 // len(user_ids))
+
+
+def queue_sign(user_id: str):
+    '''
+    Queue a signature update for a user.
+    '''
+    return jobs.enqueue(
+        "sign_user", {"user_id": user_id}, priority=CecilConstants.PRIORITY_BULK)
+
+
+def get_similar(user_id: str, relation: str, limit: int = 10):
+    '''
+    The directory users whose followers or friends are most like this user's.
+    '''
+    helpers.db_path("users", user_id)
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT signature, size FROM signatures WHERE user_id = ? AND relation = ?",
+            (user_id, relation)
+        ).fetchone()
+        if row is None:
+            raise HTTPException(
+                status_code=404, detail=f'Signature: {user_id}, does not exist.')
+        sig = array("Q")
+        sig.frombytes(row[0])
+        size = row[1]
+
+        candidates = {}
+        for band, bucket in enumerate(_buckets(sig)):
+            for (candidate_id, candidate_sig, candidate_size) in conn.execute(
+                    "SELECT bands.user_id, signatures.signature, signatures.size FROM bands "
+                    "JOIN signatures ON signatures.user_id = bands.user_id "
+                    "AND signatures.relation = bands.relation "
+                    "WHERE bands.relation = ? AND bands.band = ? AND bands.bucket = ? "
+                    "AND bands.user_id != ?",
+                    (relation, band, bucket, user_id)
+            ):
+                if candidate_id not in candidates:
+                    candidate = array("Q")
+                    candidate.frombytes(candidate_sig)
+                    candidates[candidate_id] = _bounded(
+                        _estimate(sig, candidate), size, candidate_size)
+
+    # Only the most promising candidates pay for loading their full sets.
+    shortlist = sorted(candidates.items(), key=lambda item: (-item[1], item[0]))[
+        :limit * CONFIG.get(CecilConstants.SIMILARITY_RERANK_FACTOR)]
+    pool = helpers.process_pool("stats", CONFIG.get(CecilConstants.STATS_MATRIX_PROCESSES))
+    futures = [
+        pool.submit(_jaccard, user_id, candidate_id, relation)
+        for candidate_id, _ in shortlist
+    ]
+    try:
+        similar = [
+            {
+                'user_id': candidate_id,
+                'estimated_jaccard': estimated,
+                'jaccard': future.result(),
+            }
+            for (candidate_id, estimated), future in zip(shortlist, futures)
+        ]
+    finally:
+        for future in futures:
+            future.cancel()
+    similar.sort(key=lambda item: (-item['jaccard'], item['user_id']))
+    return similar[:limit]
+
+
+CONFIG = helpers.make_config()
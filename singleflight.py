@@ -0,0 +1,111 @@
+'''
+Coalesces concurrent identical requests in a process onto one in-flight computation.
+
+The first request for a key computes it; identical requests arriving before it is
+done wait for it and share its result, or its error. Keys carry the version of every
+user and watchlist the request names, so a request arriving after a write never shares
+a computation that started before it. Coalescing is on for every
+route unless the single_flight_routes setting maps the route's name to false.
+'''
+
+import json
+import functools
+import threading
+from collections import defaultdict
+from enum import Enum
+
+import helpers
+import versions
+from constants import CecilConstants
+
+
+class _Flight:
+    '''
+    One in-flight computation, and what came of it.
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def enabled(route: str):
+    '''
+    Whether a route's requests are coalesced.
+    '''
+    return CONFIG.get(CecilConstants.SINGLE_FLIGHT_ROUTES).get(route, True)
+
+
+def run(route: str, key, function):
+    '''
+    Return function(), sharing one call among concurrent callers with the same key.
+    '''
+    if not enabled(route):
+        return function()
+
+    with _LOCK:
+        flight = _FLIGHTS.get((route, key))
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[(route, key)] = _Flight()
+            _COUNTS[route]['leaders'] += 1
+        else:
+            _COUNTS[route]['coalesced'] += 1
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = function()
+        return flight.result
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _LOCK:
+            del _FLIGHTS[(route, key)]
+        flight.done.set()
+
+
+def coalesced(handler):
+    '''
+    Coalesce concurrent calls of an endpoint with identical parameters.
+    '''
+    @functools.wraps(handler)
+    def _coalesced(**kwargs):
+        key = json.dumps([{
+            name: value.value if isinstance(value, Enum) else value
+            for name, value in kwargs.items()
+        }, versions.get_versions(kwargs)], sort_keys=True, default=str)
+        return run(handler.__name__, key, lambda: handler(**kwargs))
+    return _coalesced
+
+
+def get_stats():
+    '''
+    Per route, how many computations ran and how many requests shared one instead.
+    '''
+    with _LOCK:
+        in_flight = defaultdict(int)
+        for route, _ in _FLIGHTS:
+            in_flight[route] += 1
+        return [
+            {
+                'route': route,
+                'enabled': enabled(route),
+                'leaders': counts['leaders'],
+                'coalesced': counts['coalesced'],
+                'in_flight': in_flight[route],
+            }
+            for route, counts in sorted(_COUNTS.items())
+        ]
+
+
+CONFIG = helpers.make_config()
+_LOCK = threading.Lock()
+_FLIGHTS = {}
+_COUNTS = defaultdict(lambda: {'leaders': 0, 'coalesced': 0})
@@ -0,0 +1,160 @@
+'''
+Columnar snapshot of the whole directory, as Parquet files partitioned by owner_id.
+
+Needs the optional pyarrow package. Only users whose database changed since the last
+snapshot are re-exported.
+'''
+
+import json
+import shutil
+from pathlib import Path
+from datetime import datetime
+from contextlib import closing
+from concurrent.futures import as_completed
+from fastapi import HTTPException
+from fastapi.logger import logger
+
+import helpers
+import jobs
+from constants import CecilConstants
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TABLES = [
+    CecilConstants.USER_TABLE,
+    CecilConstants.TIMELINE_TABLE,
+    CecilConstants.FAVORITES_TABLE,
+    CecilConstants.FOLLOWERS_TABLE,
+    CecilConstants.FRIENDS_TABLE,
+]
+
+
+def require_pyarrow():
+    '''
+    Throw error if the optional pyarrow package is missing.
+    '''
+    if pyarrow is None:
+        raise HTTPException(
+            status_code=501, detail="Snapshots need the pyarrow package installed.")
+
+
+def _snapshot_path():
+    return Path(CecilConstants.SNAPSHOT_PATH)
+
+
+def _manifest_path():
+    return _snapshot_path() / "manifest.json"
+
+
+def _partition(table: str, user_id: str):
+    return _snapshot_path() / table / f"owner_id={user_id}"
+
+
+def get_manifest():
+    '''
+    What the last snapshot holds: each user's DB stamp as of their export.
+    '''
+    if not _manifest_path().exists():
+        return {'finished_at': None, 'users': {}}
+    with open(_manifest_path()) as manifest:
+        return json.load(manifest)
+
+
+def _write_manifest(manifest: dict):
+    temporary = _manifest_path().with_suffix(".tmp")
+    with open(temporary, "w") as output:
+        json.dump(manifest, output)
+    temporary.replace(_manifest_path())
+
+
+def _export_user(user_id: str):
+    '''
+    Write every table of one user's database as a Parquet partition.
+    '''
+    path = helpers.db_path("users", user_id)
+    stamp = helpers.db_stamp(path)
+    with closing(helpers.read_only(path)) as conn:
+        existing = {
+            row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        for table in TABLES:
+            if table not in existing:
+                continue
+            cursor = conn.execute(f"SELECT * FROM {table}")
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            # Stored as text so every partition shares a schema, whatever SQLite held.
+            arrow_table = pyarrow.table({
+                column: pyarrow.array(
+                    [str(row[index]) if row[index] is not None else None for row in rows],
+                    type=pyarrow.string()
+                )
+                for index, column in enumerate(columns)
+            })
+            partition = _partition(table, user_id)
+            partition.mkdir(parents=True, exist_ok=True)
+            pyarrow.parquet.write_table(
+                arrow_table, partition / "part-0.parquet", compression="zstd")
+    return user_id, list(stamp)
+
+
+@jobs.job("snapshot_directory")
+def snapshot_directory(context: jobs.JobContext):
+    '''
+    Bring the snapshot up to date with the user directory.
+    '''
+    require_pyarrow()
+    manifest = get_manifest()
+    current = {
+        user_id: list(helpers.db_stamp(helpers.db_path("users", user_id)))
+        for user_id in helpers.db_ids("users")
+    }
+
+    for removed in set(manifest['users']) - set(current):
+        for table in TABLES:
+            shutil.rmtree(_partition(table, removed), ignore_errors=True)
+        del manifest['users'][removed]
+
+    changed = [
+        user_id for user_id, stamp in current.items()
+        if manifest['users'].get(user_id) != stamp
+    ]
+    logger.info('Snapshotting %s of %s users.', len(changed), len(current))
+
+    pool = helpers.process_pool("snapshots", CONFIG.get(CecilConstants.SNAPSHOT_PROCESSES))
+    futures = [pool.submit(_export_user, user_id) for user_id in changed]
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            user_id, stamp = future.result()
+            manifest['users'][user_id] = stamp
+            if done % 100 == 0 or done == len(futures):
+                _write_manifest(manifest)
+                context.report(done * 100 // len(futures), f"{done} of {len(futures)} users")
+    finally:
+        for future in futures:
+            future.cancel()
+
+    manifest['finished_at'] = datetime.utcnow().isoformat()
+    _snapshot_path().mkdir(parents=True, exist_ok=True)
+    _write_manifest(manifest)
+
+
+def get_partition(table: str, user_id: str):
+    '''
+    Path to one user's Parquet file for a table. Throw error if it was not snapshotted.
+    '''
+    require_pyarrow()
+    path = _partition(table, user_id) / "part-0.parquet"
+    if table not in TABLES or not path.exists():
+        raise HTTPException(
+            status_code=404,
+            detail=f'Snapshot: {table}/{user_id}, does not exist.'
+        )
+    return path
+
+
+CONFIG = helpers.make_config()
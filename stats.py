@@ -0,0 +1,172 @@
+'''
+Computes a user's watchlist stats with one read of each relationship set.
+'''
+
+import json
+import hashlib
+from collections import Counter
+from concurrent.futures import as_completed
+from contextlib import closing
+from math import ceil
+
+import helpers
+from cache import LRUCache
+from constants import CecilConstants
+
+
+def _column(conn, table, column):
+    return [
+        row[0] for row in conn.execute(
+            f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL"
+        )
+    ]
+
+
+def _percent(part, whole):
+    return part / whole * 100 if whole else 0.0
+
+
+def load_user_sets(user_id: str):
+    '''
+    Followers, friends, favorited authors and retweeted authors of a user.
+    '''
+    path = helpers.db_path("users", user_id)
+    stamp = helpers.db_stamp(path)
+    cached = USER_SETS.get(user_id)
+    if cached and cached['stamp'] == stamp:
+        return cached
+
+    with closing(helpers.read_only(path)) as conn:
+        user_sets = {
+            'stamp': stamp,
+            'followers': frozenset(_column(conn, CecilConstants.FOLLOWERS_TABLE, "user_id")),
+            'friends': frozenset(_column(conn, CecilConstants.FRIENDS_TABLE, "user_id")),
+            'favorites': Counter(_column(conn, CecilConstants.FAVORITES_TABLE, "user_id")),
+            'retweets': Counter(
+                _column(conn, CecilConstants.TIMELINE_TABLE, "retweet_user_id")
+            ),
+        }
+    return USER_SETS.put(user_id, user_sets)
+
+
+def load_watchlist_set(watchlist_id: str):
+    '''
+    The user ids on a watchlist, and a digest of them.
+    '''
+    path = helpers.db_path("watchlists", watchlist_id)
+    stamp = helpers.db_stamp(path)
+    cached = WATCHLIST_SETS.get(watchlist_id)
+    if cached and cached['stamp'] == stamp:
+        return cached
+
+    with closing(helpers.read_only(path)) as conn:
+        users = frozenset(_column(conn, CecilConstants.WATCHLIST_TABLE, "user_id"))
+    watchlist_set = {
+        'stamp': stamp,
+        'users': users,
+        # Refreshing members' user data rewrites the file, but leaves this unchanged.
+        'digest': hashlib.sha256("\n".join(sorted(users)).encode()).hexdigest(),
+    }
+    return WATCHLIST_SETS.put(watchlist_id, watchlist_set)
+
+
+def compute_stats(user_sets: dict, watchlist: frozenset):
+    '''
+    All of the UserStats ratios in a single pass over the user's sets.
+    '''
+    followers = len(user_sets['followers'] & watchlist)
+    friends = len(user_sets['friends'] & watchlist)
+    favorites = sum(
+        count for user_id, count in user_sets['favorites'].items() if user_id in watchlist
+    )
+    retweets = sum(
+        count for user_id, count in user_sets['retweets'].items() if user_id in watchlist
+    )
+    return {
+        'followers_watchlist_percent': _percent(followers, len(user_sets['followers'])),
+        'followers_watchlist_completion': _percent(followers, len(watchlist)),
+        'friends_watchlist_percent': _percent(friends, len(user_sets['friends'])),
+        'friends_watchlist_completion': _percent(friends, len(watchlist)),
+        'favorite_watchlist_percent': _percent(
+            favorites, sum(user_sets['favorites'].values())),
+        'retweet_watchlist_percent': _percent(
+            retweets, sum(user_sets['retweets'].values())),
+    }
+
+
+def get_user_stats(user_id: str, watchlist_id: str):
+    '''
+    A user's stats against a watchlist, reused until either database changes.
+    '''
+    user_sets = load_user_sets(user_id)
+    watchlist_set = load_watchlist_set(watchlist_id)
+    key = (user_id, user_sets['stamp'], watchlist_id, watchlist_set['stamp'])
+    return STATS.get_or_create(
+        key, lambda: compute_stats(user_sets, watchlist_set['users'])
+    )
+
+
+def _matrix_rows(user_ids: list, watchlists: dict):
+    rows = []
+    for user_id in user_ids:
+        user_sets = load_user_sets(user_id)
+        rows.append({
+            'user_id': user_id,
+            'stats': {
+                watchlist_id: compute_stats(user_sets, users)
+                for watchlist_id, users in watchlists.items()
+            }
+        })
+    return rows
+
+
+def matrix_rows(user_ids: list, watchlist_ids: list):
+    '''
+    Stats for every user against every watchlist, as dicts in completion order.
+
+    Rows are computed in the shared stats process pool, a batch of users per task. The
+    watchlist sets are loaded once, here, and sent along with each batch, so no worker
+    reads a watchlist database.
+    '''
+    processes = CONFIG.get(CecilConstants.STATS_MATRIX_PROCESSES)
+    pool = helpers.process_pool("stats", processes)
+    watchlists = {
+        watchlist_id: load_watchlist_set(watchlist_id)['users']
+        for watchlist_id in watchlist_ids
+    }
+    # A few batches per process keeps them all busy while rows still stream steadily.
+    size = max(1, ceil(len(user_ids) / (processes * 4)))
+    futures = [
+        pool.submit(_matrix_rows, user_ids[start:start + size], watchlists)
+        for start in range(0, len(user_ids), size)
+    ]
+    try:
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def stats_matrix(user_ids: list, watchlist_ids: list):
+    '''
+    Stats for every user against every watchlist, as NDJSON lines in completion order.
+    '''
+    watchlist_ids = list(dict.fromkeys(watchlist_ids))
+    user_ids = list(dict.fromkeys(user_ids))
+    for watchlist_id in watchlist_ids:
+        helpers.db_path("watchlists", watchlist_id)
+    for user_id in user_ids:
+        helpers.db_path("users", user_id)
+
+    def _rows():
+        for row in matrix_rows(user_ids, watchlist_ids):
+            yield json.dumps(row) + "\n"
+
+    return _rows()
+
+
+CONFIG = helpers.make_config()
+USER_SETS = LRUCache(CONFIG.get(CecilConstants.RELATIONSHIP_CACHE_SIZE))
+WATCHLIST_SETS = LRUCache(CONFIG.get(CecilConstants.RELATIONSHIP_CACHE_SIZE))
+STATS = LRUCache(CONFIG.get(CecilConstants.STATS_CACHE_SIZE))
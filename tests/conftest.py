@@ -0,0 +1,17 @@
+'''
+Runs the tests from a scratch directory: Cecil reads config.json and creates its databases
+in the working directory as its modules are imported.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRATCH = tempfile.mkdtemp(prefix="cecil-tests-")
+
+sys.path.insert(0, str(ROOT))
+shutil.copy(ROOT / "config.json", SCRATCH)
+os.chdir(SCRATCH)
@@ -0,0 +1,83 @@
+'''
+A local stand-in for the Twitter API, for exercising the rate limit scheduler.
+
+Each endpoint family allows a number of requests per fixed window that starts with the
+first request after a reset, as Twitter does, and answers 429 once the window is spent.
+'''
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAMILIES = {
+    "/1.1/users/lookup.json": "users",
+    "/1.1/followers/ids.json": "followers",
+    "/1.1/friends/ids.json": "friends",
+    "/1.1/statuses/user_timeline.json": "timeline",
+    "/1.1/favorites/list.json": "favorites",
+    "/1.1/lists/members.json": "lists",
+}
+
+
+class StubTwitter:
+    '''
+    Serve the stub on a free local port until stopped.
+    '''
+
+    def __init__(self, limits: dict, window_seconds: float):
+        self.limits = limits
+        self.window_seconds = window_seconds
+        self.served = 0
+        self.limited = 0
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def _take(self, family: str):
+        now = time.monotonic()
+        with self._lock:
+            started_at, spent = self._windows.get(family, (None, 0))
+            if started_at is None or now >= started_at + self.window_seconds:
+                started_at, spent = now, 0
+            if spent >= self.limits[family]:
+                self.limited += 1
+                return False
+            self._windows[family] = (started_at, spent + 1)
+            self.served += 1
+            return True
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''
+            Answer every known endpoint with an empty page, or 429 when rate limited.
+            '''
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                family = FAMILIES.get(self.path.split("?")[0])
+                if family is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                allowed = stub._take(family)  # pylint: disable=protected-access
+                body = json.dumps({"ids": []} if allowed else {"errors": [{"code": 88}]})
+                self.send_response(200 if allowed else 429)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
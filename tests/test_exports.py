@@ -0,0 +1,45 @@
+'''
+Streaming exports, read batch by batch on whichever threadpool thread is free.
+'''
+
+import json
+import sqlite3
+import threading
+from contextlib import closing
+
+import anyio
+from anyio import to_thread
+
+import exports
+
+ROWS = exports.BATCH_SIZE * 20
+
+
+def _make_database(path):
+    with closing(sqlite3.connect(path)) as conn, conn:
+        conn.execute("CREATE TABLE followers (user_id TEXT)")
+        conn.executemany(
+            "INSERT INTO followers VALUES (?)", [(str(row),) for row in range(ROWS)])
+
+
+def test_an_export_streams_while_other_threadpool_work_runs():
+    _make_database("export.db")
+    response = exports.export("export.db", "followers", "user_id", "followers", "ndjson", False)
+    chunks = []
+
+    def busy():
+        threading.Event().wait(.001)
+
+    async def stream():
+        async with anyio.create_task_group() as group:
+            for _ in range(200):
+                group.start_soon(to_thread.run_sync, busy)
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+
+    anyio.run(stream)
+
+    lines = b"".join(chunks).decode().splitlines()
+    assert len(lines) == ROWS
+    assert json.loads(lines[-1]) == {"user_id": "9999"}
+    assert len(chunks) == 20
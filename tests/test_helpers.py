@@ -0,0 +1,46 @@
+'''
+The registry of open baquet handles, shared by every threadpool thread.
+'''
+
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import helpers
+
+
+class _Handle:
+    '''
+    Stands in for a baquet object: a scoped session on the flat database it is named for.
+    '''
+
+    def __init__(self, filename):
+        self.session = scoped_session(
+            sessionmaker(bind=create_engine(f"sqlite:///./users/{filename}.db")))
+
+
+def test_evicting_a_handle_closes_the_connection_of_every_thread():
+    Path("./users").mkdir(exist_ok=True)
+    sqlite3.connect("./users/evicted.db").close()
+    connections = []
+
+    def use():
+        handle = helpers._handle("users", "evicted", _Handle)  # pylint: disable=protected-access
+        handle.session.execute(text("SELECT 1"))
+        connections.append(handle.session.connection().connection.connection)
+
+    threads = [threading.Thread(target=use) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(connections) == 2 and connections[0] is not connections[1]
+
+    helpers.HANDLES.invalidate(("users", "evicted"))
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError, match="closed"):
+            connection.execute("SELECT 1")
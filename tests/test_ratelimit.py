@@ -0,0 +1,134 @@
+'''
+The rate limit scheduler, run against a stub Twitter API that enforces its windows.
+'''
+
+import threading
+import time
+from contextlib import closing
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+import catalog
+import jobs
+import ratelimit
+from constants import CecilConstants
+from stub_twitter import StubTwitter
+
+WINDOW_SECONDS = 1.0
+
+
+@pytest.fixture(autouse=True)
+def short_windows(monkeypatch):
+    '''
+    Shrink Twitter's limits and windows so a test spans several windows in seconds.
+    '''
+    monkeypatch.setitem(ratelimit.CONFIG, CecilConstants.TWITTER_RATE_LIMITS, {
+        "users": 10, "followers": 3, "friends": 3,
+        "timeline": 10, "favorites": 10, "lists": 10,
+    })
+    monkeypatch.setitem(
+        ratelimit.CONFIG, CecilConstants.TWITTER_RATE_LIMIT_WINDOW_SECONDS, WINDOW_SECONDS)
+    monkeypatch.setitem(ratelimit.CONFIG, CecilConstants.TWITTER_RATE_LIMIT_GRACE_SECONDS, .2)
+    monkeypatch.setitem(ratelimit.CONFIG, CecilConstants.INTERACTIVE_RESERVE_FRACTION, .2)
+    with closing(ratelimit._connect()) as conn:  # pylint: disable=protected-access
+        conn.execute("DELETE FROM windows")
+
+
+def _fetch(url: str):
+    try:
+        with urlopen(url) as response:
+            return response.status
+    except HTTPError as error:
+        return error.code
+
+
+@jobs.job("stub_followers", twitter_costs=lambda url, pages, job_number: {"followers": pages})
+def stub_followers(context: jobs.JobContext, url: str, pages: int, job_number: int):
+    # pylint: disable=unused-argument
+    '''
+    Page through a user's followers on the stub, as an ingest would.
+    '''
+    statuses = [_fetch(f"{url}/1.1/followers/ids.json") for _ in range(pages)]
+    if 429 in statuses:
+        raise RuntimeError("Rate limited by the stub.")
+
+
+def _work_queue(until: float):
+    while time.monotonic() < until:
+        claimed_job = jobs._claim_next()  # pylint: disable=protected-access
+        if claimed_job is None:
+            time.sleep(.05)
+        else:
+            jobs._run(claimed_job)  # pylint: disable=protected-access
+
+
+def test_scheduled_jobs_stay_within_the_stub_windows():
+    with StubTwitter({"followers": 3}, WINDOW_SECONDS) as stub:
+        queued = [
+            jobs.enqueue("stub_followers", {"url": stub.url, "pages": 2, "job_number": number})
+            for number in range(4)
+        ]
+        workers = [
+            threading.Thread(target=_work_queue, args=(time.monotonic() + 8,))
+            for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    assert stub.limited == 0
+    assert stub.served == 8
+    assert all(
+        jobs.get_job(queued_job.job_id).status == CecilConstants.JOB_SUCCEEDED
+        for queued_job in queued
+    )
+
+
+def test_a_spent_window_waits_for_its_reset():
+    assert ratelimit.try_acquire({"followers": 3}) == 0
+    wait = ratelimit.try_acquire({"followers": 1})
+    assert 0 < wait <= WINDOW_SECONDS + .2
+
+    time.sleep(wait)
+    assert ratelimit.try_acquire({"followers": 1}) == 0
+
+
+def test_a_cost_over_capacity_is_charged_to_the_windows_after_it():
+    assert ratelimit.try_acquire({"followers": 7}) == 0
+    # Seven requests fill this window and the next, and one of the third.
+    for _ in range(2):
+        wait = ratelimit.try_acquire({"followers": 1})
+        assert 0 < wait <= WINDOW_SECONDS + .2
+        time.sleep(wait)
+
+    assert ratelimit.try_acquire({"followers": 7}) > 0
+    assert ratelimit.try_acquire({"followers": 2}) == 0
+    assert ratelimit.try_acquire({"followers": 1}) > 0
+
+
+def test_bulk_work_leaves_the_interactive_reserve():
+    for _ in range(8):
+        assert ratelimit.try_acquire({"users": 1}, CecilConstants.PRIORITY_BULK) == 0
+    assert ratelimit.try_acquire({"users": 1}, CecilConstants.PRIORITY_BULK) > 0
+
+    assert ratelimit.try_acquire({"users": 2}, CecilConstants.PRIORITY_INTERACTIVE) == 0
+    assert ratelimit.try_acquire({"users": 1}, CecilConstants.PRIORITY_INTERACTIVE) > 0
+
+
+def test_ingest_costs_follow_the_catalogued_counts():
+    from routers import users  # pylint: disable=import-outside-toplevel
+
+    with closing(catalog._connect()) as conn, conn:  # pylint: disable=protected-access
+        conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, followers_count, friends_count, "
+            "statuses_count, favorites_count) VALUES (?, ?, ?, ?, ?)",
+            ("costly", 12000, 40, 50000, 450)
+        )
+
+    costs = users._ingest_costs("costly")  # pylint: disable=protected-access
+    assert costs == {"users": 1, "followers": 3, "friends": 1, "timeline": 16, "favorites": 3}
+    # Until catalogued, a user is assumed to have a full timeline.
+    assert users._ingest_costs("uncatalogued")["timeline"] == 16  # pylint: disable=protected-access
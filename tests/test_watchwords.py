@@ -0,0 +1,32 @@
+'''
+Watchword matching, for plain words and regular expressions alike.
+'''
+
+from watchwords import Matcher, is_literal
+
+
+def test_plain_words_match_by_substring_ignoring_case():
+    matcher = Matcher(["Cat", "at", "dog"])
+    assert matcher.patterns == []
+    assert matcher.find("The CAT sat") == ["at", "cat"]
+    assert matcher.find("nothing here") == []
+
+
+def test_patterns_are_matched_as_regular_expressions():
+    matcher = Matcher([r"\bcat\b", "colou?r", "dog"])
+    assert [word for word, _ in matcher.patterns] == [r"\bcat\b", "colou?r"]
+    assert matcher.find("A Cat and a dog in color") == [r"\bcat\b", "colou?r", "dog"]
+    # A pattern is never matched literally, nor a plain word as a pattern.
+    assert matcher.find("concatenate colou?r") == []
+
+
+def test_invalid_patterns_are_skipped():
+    matcher = Matcher(["(unclosed", "word"])
+    assert matcher.words == ["word"]
+    assert matcher.find("a word (unclosed") == ["word"]
+
+
+def test_literal_words_are_told_apart_from_patterns():
+    assert is_literal("#hashtag @handle it's")
+    assert not is_literal("a.b")
+    assert not is_literal("a|b")
@@ -0,0 +1,69 @@
+'''
+Cheap data versions for users and watchlists, for keying caches of their responses.
+
+A version is the entity's database stamp plus a write counter that Cecil's mutating
+endpoints bump. The counter catches writes the stamp can miss, e.g. two within the
+file system's timestamp resolution. Counters live in a small SQLite file, so every
+uvicorn worker sees the same versions.
+'''
+
+from contextlib import closing
+
+import helpers
+from constants import CecilConstants
+
+# Parameters naming an entity, and the directory each one's database lives in.
+VERSIONED_PARAMETERS = {
+    "user_id": "users",
+    "watchlist_id": "watchlists",
+    "watchwords_id": "watchlists",
+}
+
+
+def _create_schema(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS versions (directoryname TEXT NOT NULL, "
+        "entity_id TEXT NOT NULL, counter INTEGER NOT NULL, "
+        "PRIMARY KEY (directoryname, entity_id))"
+    )
+
+
+def _connect():
+    return helpers.cecil_db(
+        CecilConstants.VERSIONS_DB_PATH, _create_schema, isolation_level=None)
+
+
+def bump(directoryname: str, entity_id: str):
+    '''
+    Record that Cecil wrote to a user or watchlist.
+    '''
+    with closing(_connect()) as conn:
+        conn.execute(
+            "INSERT INTO versions (directoryname, entity_id, counter) VALUES (?, ?, 1) "
+            "ON CONFLICT (directoryname, entity_id) DO UPDATE SET counter = counter + 1",
+            (directoryname, entity_id)
+        )
+
+
+def get_version(directoryname: str, entity_id: str):
+    '''
+    The current version of a user or watchlist. Throw error if it does not exist.
+    '''
+    stamp = helpers.db_stamp(helpers.db_path(directoryname, entity_id))
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT counter FROM versions WHERE directoryname = ? AND entity_id = ?",
+            (directoryname, entity_id)
+        ).fetchone()
+    return (row[0] if row else 0,) + stamp
+
+
+def get_versions(kwargs: dict):
+    '''
+    The version of every user and watchlist a request's parameters name.
+    '''
+    return {
+        name: get_version(directoryname, kwargs[name])
+        for name, directoryname in VERSIONED_PARAMETERS.items()
+        if isinstance(kwargs.get(name), str)
+    }
@@ -0,0 +1,197 @@
+'''
+Matches tweets against a watchlist's watchwords in one pass over each tweet.
+
+Watchwords are regular expressions. Plain words, the usual case, go into one compiled
+Aho-Corasick automaton, so they cost a single scan of the text no matter how many there
+are; the rest are searched with re. Matching is case-insensitive. The matcher is built
+once per watchlist and kept until its watchwords change.
+'''
+
+import re
+from collections import deque
+from contextlib import closing
+from fastapi.logger import logger
+
+import helpers
+import keyset
+from cache import LRUCache
+from constants import CecilConstants
+
+
+class Automaton:
+    '''
+    Aho-Corasick automaton over a set of words.
+    '''
+
+    def __init__(self, words):
+        self.words = sorted({word.lower() for word in words if word})
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for index, word in enumerate(self.words):
+            state = 0
+            for character in word:
+                if character not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][character] = len(self._goto) - 1
+                state = self._goto[state][character]
+            self._output[state].append(index)
+
+        # Breadth first, so every state's fail link is final before its children need it.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and character not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(character, 0)
+                if self._fail[child] == child:
+                    self._fail[child] = 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str):
+        '''
+        The words found in text, in alphabetical order.
+        '''
+        if not text or not self.words:
+            return []
+        found = set()
+        state = 0
+        for character in text.lower():
+            while state and character not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(character, 0)
+            found.update(self._output[state])
+        return [self.words[index] for index in sorted(found)]
+
+
+_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def is_literal(word: str):
+    '''
+    Whether a watchword matches only itself, so it can go into the automaton.
+    '''
+    return not _METACHARACTERS.intersection(word)
+
+
+class Matcher:
+    '''
+    An automaton over the literal watchwords and compiled patterns for the rest.
+    '''
+
+    def __init__(self, words):
+        literals = {word.lower() for word in words if word and is_literal(word)}
+        self.automaton = Automaton(literals)
+        self.patterns = []
+        for word in sorted({word for word in words if word and not is_literal(word)}):
+            try:
+                self.patterns.append((word, re.compile(word, re.IGNORECASE)))
+            except re.error as error:
+                logger.warning("Watchword: %s, is not a valid pattern: %s", word, error)
+        self.words = sorted(literals.union(word for word, _ in self.patterns))
+
+    def find(self, text: str):
+        '''
+        The watchwords found in text, in alphabetical order.
+        '''
+        if not text:
+            return []
+        found = self.automaton.find(text)
+        found.extend(word for word, pattern in self.patterns if pattern.search(text))
+        return sorted(found)
+
+
+def get_matcher(watchlist_id: str):
+    '''
+    The compiled matcher for a watchlist's watchwords, rebuilt only when they change.
+    '''
+    stamp = helpers.db_stamp(helpers.db_path("watchlists", watchlist_id))
+    cached = MATCHERS.get(watchlist_id)
+    if cached and cached['stamp'] == stamp:
+        return cached['matcher']
+
+    words = sorted(set(helpers.wl_getter(watchlist_id).get_watchwords()))
+    if not cached or cached['words'] != words:
+        matcher = Matcher(words)
+    else:
+        matcher = cached['matcher']
+    MATCHERS.put(watchlist_id, {'stamp': stamp, 'words': words, 'matcher': matcher})
+    return matcher
+
+
+def _matches(path, table, matcher, watchlist_path, member_column):
+    '''
+    Rowids and matched words of every matching tweet, newest first.
+    '''
+    where = ""
+    with closing(helpers.read_only(path)) as conn:
+        if watchlist_path is not None:
+            conn.execute(
+                "ATTACH DATABASE ? AS watchlist_db",
+                (f"file:{watchlist_path.resolve()}?mode=ro",)
+            )
+            where = f"WHERE {member_column} IN " \
+                f"(SELECT user_id FROM watchlist_db.{CecilConstants.WATCHLIST_TABLE})"
+        matches = []
+        for rowid, text in conn.execute(
+                f"SELECT rowid, text FROM {table} {where} "
+                "ORDER BY created_at DESC, tweet_id DESC"
+        ):
+            found = matcher.find(text)
+            if found:
+                matches.append((rowid, found))
+    return matches
+
+
+def filter_tweets(
+        user_id: str,
+        table: str,
+        watchwords_id: str,
+        page: int = 1,
+        page_size: int = 20,
+        watchlist_id: str = None,
+        member_column: str = "user_id",
+):
+    '''
+    A page of a user's tweets matching the watchwords, each with the words it matched.
+    '''
+    path = helpers.db_path("users", user_id)
+    watchlist_path = helpers.db_path("watchlists", watchlist_id) if watchlist_id else None
+    matcher = get_matcher(watchwords_id)
+    key = (
+        user_id, helpers.db_stamp(path), table, tuple(matcher.words),
+        watchlist_id, helpers.db_stamp(watchlist_path) if watchlist_path else None,
+    )
+    matches = MATCHES.get(key)
+    if matches is None:
+        matches = MATCHES.put(
+            key, _matches(path, table, matcher, watchlist_path, member_column))
+
+    window = matches[(page - 1) * page_size:page * page_size]
+    items = []
+    if window:
+        with closing(helpers.read_only(path)) as conn:
+            cursor = conn.execute(
+                f"SELECT rowid AS _rowid, * FROM {table} "
+                f"WHERE rowid IN ({', '.join('?' * len(window))})",
+                [rowid for rowid, _ in window]
+            )
+            rows = {row[0]: keyset.row_dict(cursor, row) for row in cursor.fetchall()}
+        for rowid, found in window:
+            row = rows[rowid]
+            row.pop("_rowid")
+            row["matched_words"] = found
+            items.append(row)
+
+    return helpers.paginated(items, len(matches), page, page_size)
+
+
+CONFIG = helpers.make_config()
+MATCHERS = LRUCache(CONFIG.get(CecilConstants.STATS_CACHE_SIZE))
+MATCHES = LRUCache(CONFIG.get(CecilConstants.RELATIONSHIP_CACHE_SIZE))